@@ -0,0 +1,252 @@
+# rdserialtool
+# Copyright (C) 2019 Ryan Finnie
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# Micro-benchmarks of the per-sample hot paths, plus full poll/format
+# loops over an in-memory emulated device (rdserial.emulator.Loopback).
+#
+#   $ python3 -m rdserial.bench --output bench.json
+#   $ python3 -m rdserial.bench --compare bench.json
+#
+# Results are per operation; --compare exits non-zero if any benchmark
+# got slower than the given threshold.
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+import rdserial
+import rdserial.um
+import rdserial.um.tool
+import rdserial.dps
+import rdserial.dps.tool
+import rdserial.modbus
+import rdserial.emulator
+
+
+def timeit(func, min_time=0.2, repeat=5):
+    """Time func, returning the per-call seconds of each repeat"""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+    results = [elapsed / number]
+    for i in range(repeat - 1):
+        start = time.perf_counter()
+        for i in range(number):
+            func()
+        results.append((time.perf_counter() - start) / number)
+    return results
+
+
+def tool_args(command, **kwargs):
+    args = argparse.Namespace(
+        command=command, watch=True, json=False, trend_points=5,
+        watch_seconds=1.0, watch_policy='skip',
+    )
+    for k, v in kwargs.items():
+        setattr(args, k, v)
+    return args
+
+
+def um_benchmarks():
+    emulator = rdserial.emulator.UMEmulator('UM25C')
+    emulator.update()
+    frame = emulator.state.dump()
+    response = rdserial.um.Response(frame, device_type='UM25C')
+
+    tool = rdserial.um.tool.Tool()
+    tool.args = tool_args('um25c')
+    tool.socket = rdserial.emulator.Loopback(emulator)
+    stdout = io.StringIO()
+
+    def print_human():
+        with contextlib.redirect_stdout(stdout):
+            tool.print_human(response)
+        stdout.seek(0)
+        stdout.truncate()
+
+    def loop():
+        sample = tool.poll()
+        tool.get_json(sample)
+        with contextlib.redirect_stdout(stdout):
+            tool.print_human(sample)
+        stdout.seek(0)
+        stdout.truncate()
+
+    return [
+        ('um.load', lambda: rdserial.um.Response(frame, device_type='UM25C')),
+        ('um.dump', response.dump),
+        ('um.get_json', lambda: tool.get_json(response)),
+        ('um.print_human', print_human),
+        ('um.trend_s', lambda: tool.trend_s('volts', response.volts)),
+        ('um.poll', tool.poll),
+        ('um.loop', loop),
+    ]
+
+
+def dps_benchmarks():
+    emulator = rdserial.emulator.DPSEmulator()
+    socket = rdserial.emulator.Loopback(emulator)
+    modbus_client = rdserial.modbus.RTUClient(socket, baudrate=9600)
+    # Nothing is on a wire, so don't measure the inter-frame quiet period
+    modbus_client._silent_interval = 0
+    client = rdserial.dps.Client(modbus_client, settings_ttl=10.0)
+
+    tool = rdserial.dps.tool.Tool()
+    tool.args = tool_args('dps', all_groups=False, group=[0])
+    tool.socket = socket
+    tool.client = client
+    device_state = tool.assemble_device_state()
+    stdout = io.StringIO()
+
+    request = bytearray(rdserial.modbus.FRAME_SIZE)
+    request_size = rdserial.modbus.encode_read_registers(request, 0x00, 13)
+    socket.send(request[:request_size])
+    response = socket.recv(5 + (2 * 13))
+
+    def print_human():
+        with contextlib.redirect_stdout(stdout):
+            tool.print_human(device_state)
+        stdout.seek(0)
+        stdout.truncate()
+
+    def loop():
+        sample = tool.assemble_device_state()
+        tool.get_json(sample)
+        with contextlib.redirect_stdout(stdout):
+            tool.print_human(sample)
+        stdout.seek(0)
+        stdout.truncate()
+
+    return [
+        ('modbus.crc.request', lambda: rdserial.modbus.modbus_crc(request[:request_size - 2])),
+        ('modbus.crc.response', lambda: rdserial.modbus.modbus_crc(response[:-2])),
+        ('modbus.read_registers', lambda: modbus_client.read_registers(0x00, 13)),
+        ('dps.decode', lambda: rdserial.dps.device_state_from_registers(
+            client.read_registers(rdserial.dps.register_ranges([0])), [0], datetime.datetime.now(),
+        )),
+        ('dps.get_json', lambda: tool.get_json(device_state)),
+        ('dps.print_human', print_human),
+        ('dps.trend_s', lambda: tool.trend_s('volts', device_state.volts)),
+        ('dps.loop', loop),
+    ]
+
+
+def run(only=None, min_time=0.2, repeat=5):
+    results = {}
+    for name, func in um_benchmarks() + dps_benchmarks():
+        if only and not any(name.startswith(prefix) for prefix in only):
+            continue
+        times = timeit(func, min_time=min_time, repeat=repeat)
+        results[name] = {
+            'best_us': min(times) * 1e6,
+            'median_us': statistics.median(times) * 1e6,
+            'ops_per_sec': 1 / min(times),
+        }
+        print('{:24s} {:10.2f} us {:12.0f}/s'.format(name, results[name]['best_us'], results[name]['ops_per_sec']))
+    return {
+        'version': rdserial.__version__,
+        'python': platform.python_implementation() + ' ' + platform.python_version(),
+        'platform': platform.platform(),
+        'time': datetime.datetime.now().isoformat(),
+        'results': results,
+    }
+
+
+def compare(old, new, threshold):
+    """Print changes against an older result, returning the regressed names"""
+    regressions = []
+    for name, result in sorted(new['results'].items()):
+        if name not in old['results']:
+            continue
+        change = (result['best_us'] / old['results'][name]['best_us']) - 1
+        regressed = change > threshold
+        if regressed:
+            regressions.append(name)
+        print('{:24s} {:10.2f} -> {:10.2f} us {:+7.1%}{}'.format(
+            name, old['results'][name]['best_us'], result['best_us'], change,
+            ' REGRESSION' if regressed else '',
+        ))
+    return regressions
+
+
+def parse_args(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    parser = argparse.ArgumentParser(
+        description='rdserialtool benchmarks',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        prog=os.path.basename(argv[0]),
+    )
+    parser.add_argument(
+        'only', nargs='*',
+        help='Only run benchmarks whose names start with these',
+    )
+    parser.add_argument(
+        '--output',
+        help='Write results to this JSON file',
+    )
+    parser.add_argument(
+        '--compare',
+        help='Compare against results in this JSON file',
+    )
+    parser.add_argument(
+        '--threshold', type=float, default=0.1,
+        help='Slowdown (as a fraction) counted as a regression by --compare',
+    )
+    parser.add_argument(
+        '--min-time', type=float, default=0.2,
+        help='Minimum seconds per timing run',
+    )
+    parser.add_argument(
+        '--repeat', type=int, default=5,
+        help='Timing runs per benchmark',
+    )
+    return parser.parse_args(args=argv[1:])
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    result = run(only=args.only, min_time=args.min_time, repeat=args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        print()
+        if compare(old, result, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
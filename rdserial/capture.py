@@ -0,0 +1,284 @@
+# rdserialtool
+# Copyright (C) 2019 Ryan Finnie
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# Binary sample captures, about a tenth the size of JSON history.
+#
+# A capture is a header followed by fixed-width records.  The header
+# is:
+#
+#   magic b'RDCP', version (B), device type (8s, e.g. b'UM25C'),
+#   payload size (H), group count (B), then one B per DPS group
+#
+# and each record (all little-endian) is:
+#
+#   monotonic timestamp (d), wall clock timestamp (d), payload
+#
+# where the payload is the raw 130 byte frame for UM meters, or for DPS
+# power supplies the big-endian register block of
+# rdserial.dps.register_ranges(groups).
+
+import datetime
+import mmap
+import os
+import struct
+import time
+
+try:
+    import numpy
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+import rdserial.um
+import rdserial.dps
+
+MAGIC = b'RDCP'
+VERSION = 1
+UM_PAYLOAD_SIZE = 130
+
+_header = struct.Struct('<4sB8sHB')
+_timestamps = struct.Struct('<dd')
+
+
+class CaptureError(Exception):
+    pass
+
+
+def payload_size(device_type, groups=()):
+    if device_type == 'DPS':
+        return 2 * sum(length for base, length in rdserial.dps.register_ranges(groups))
+    return UM_PAYLOAD_SIZE
+
+
+def encode_header(device_type, groups=()):
+    groups = tuple(groups)
+    return _header.pack(
+        MAGIC, VERSION, device_type.encode('ascii'), payload_size(device_type, groups), len(groups),
+    ) + bytes(groups)
+
+
+def decode_header(data):
+    """Return (device_type, groups, payload_size, header_size)"""
+    if len(data) < _header.size:
+        raise CaptureError('Truncated capture header')
+    magic, version, device_type, size, group_count = _header.unpack_from(data)
+    if magic != MAGIC:
+        raise CaptureError('Not a capture file')
+    if version != VERSION:
+        raise CaptureError('Unsupported capture version', version)
+    header_size = _header.size + group_count
+    if len(data) < header_size:
+        raise CaptureError('Truncated capture header')
+    groups = tuple(data[_header.size:header_size])
+    return device_type.rstrip(b'\0').decode('ascii'), groups, size, header_size
+
+
+class CaptureWriter:
+    """Append samples to a capture file, one write per sample
+
+    Appending to an existing capture is allowed if its device type and
+    groups match.
+    """
+    def __init__(self, filename, device_type, groups=()):
+        self.filename = filename
+        self.device_type = device_type
+        self.groups = tuple(groups)
+        self.payload_size = payload_size(device_type, self.groups)
+        self._ranges = rdserial.dps.register_ranges(self.groups)
+        self._registers_struct = struct.Struct('>{}H'.format(self.payload_size // 2))
+        self._record = bytearray(_timestamps.size + self.payload_size)
+        header = encode_header(device_type, self.groups)
+        # Unbuffered: each record goes to the file in a single write()
+        self.file = open(filename, 'ab', buffering=0)
+        if self.file.tell() == 0:
+            self.file.write(header)
+        else:
+            with open(filename, 'rb') as f:
+                existing = f.read(len(header))
+            if existing != header:
+                self.file.close()
+                raise CaptureError('Existing capture has a different device type or groups', filename)
+
+    def write(self, payload, monotonic=None, wall=None):
+        """Append a raw payload"""
+        if len(payload) != self.payload_size:
+            raise ValueError('Invalid payload length', len(payload))
+        if monotonic is None:
+            monotonic = time.monotonic()
+        if wall is None:
+            wall = time.time()
+        _timestamps.pack_into(self._record, 0, monotonic, wall)
+        self._record[_timestamps.size:] = payload
+        self.file.write(self._record)
+
+    def write_registers(self, registers, monotonic=None, wall=None):
+        """Append a DPS sample from a register:value dict"""
+        self.write(self._registers_struct.pack(*(
+            registers[base + i] for base, length in self._ranges for i in range(length)
+        )), monotonic=monotonic, wall=wall)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class Record:
+    """One captured sample; decode() builds its Response or DeviceState"""
+    __slots__ = ('reader', 'monotonic', 'wall', 'payload')
+
+    def __init__(self, reader, monotonic, wall, payload):
+        self.reader = reader
+        self.monotonic = monotonic
+        self.wall = wall
+        self.payload = payload
+
+    @property
+    def collection_time(self):
+        return datetime.datetime.fromtimestamp(self.wall)
+
+    def registers(self):
+        """The payload of a DPS record, as a register:value dict"""
+        values = iter(self.reader._registers_struct.unpack(self.payload))
+        return {
+            base + i: next(values) for base, length in self.reader._ranges for i in range(length)
+        }
+
+    def decode(self):
+        reader = self.reader
+        if reader.device_type == 'DPS':
+            return rdserial.dps.device_state_from_registers(
+                self.registers(), reader.groups, collection_time=self.collection_time,
+            )
+        return rdserial.um.Response(
+            self.payload, collection_time=self.collection_time, device_type=reader.device_type,
+        )
+
+
+class CaptureReader:
+    """Random access to a capture's records, memory-mapped
+
+    Records are only decoded on request.  A partial trailing record
+    (e.g. from a capture still being written) is ignored.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        self.device_type, self.groups, self.payload_size, self.header_size = decode_header(self._mmap[:_header.size + 255])
+        self.record_size = _timestamps.size + self.payload_size
+        self._ranges = rdserial.dps.register_ranges(self.groups)
+        self._registers_struct = struct.Struct('>{}H'.format(self.payload_size // 2))
+
+    def __len__(self):
+        return (len(self._mmap) - self.header_size) // self.record_size
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Record index out of range')
+        pos = self.header_size + (index * self.record_size)
+        monotonic, wall = _timestamps.unpack_from(self._mmap, pos)
+        pos += _timestamps.size
+        return Record(self, monotonic, wall, self._mmap[pos:pos + self.payload_size])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self):
+        if isinstance(self._mmap, mmap.mmap):
+            self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def numpy_dtype(device_type, groups=()):
+    """NumPy structured dtype of a capture record, with one field per
+    value: the raw (unscaled) integer of each UM field and data group, or
+    each DPS register property"""
+    if not HAS_NUMPY:
+        raise NotImplementedError('numpy not available')
+
+    names = ['monotonic', 'wall']
+    formats = ['<f8', '<f8']
+    offsets = [0, 8]
+    if device_type == 'DPS':
+        positions = {}
+        pos = _timestamps.size
+        for base, length in rdserial.dps.register_ranges(groups):
+            for i in range(length):
+                positions[base + i] = pos
+                pos += 2
+        fields = [(name, properties['register']) for name, properties in rdserial.dps.DeviceState.register_properties.items()]
+        for group in groups:
+            fields += [
+                ('group_{}_{}'.format(group, name), properties['register'])
+                for name, properties in rdserial.dps.GroupState.group_register_properties(group).items()
+            ]
+        for name, register in fields:
+            if register not in positions:
+                continue
+            names.append(name)
+            formats.append('>u2')
+            offsets.append(positions[register])
+    else:
+        for name, properties in rdserial.um.Response.field_properties.items():
+            names.append(name)
+            formats.append({2: '>u2', 4: '>u4'}[properties['length']])
+            offsets.append(_timestamps.size + properties['position'])
+        for group in range(rdserial.um.Response.data_group_count):
+            pos = _timestamps.size + rdserial.um.Response.data_group_position + (group * 8)
+            names += ['dg_{}_amp_hours'.format(group), 'dg_{}_watt_hours'.format(group)]
+            formats += ['>u4', '>u4']
+            offsets += [pos, pos + 4]
+    return numpy.dtype({
+        'names': names,
+        'formats': formats,
+        'offsets': offsets,
+        'itemsize': _timestamps.size + payload_size(device_type, groups),
+    })
+
+
+def load_numpy(filename):
+    """Memory-map a capture's records as a NumPy structured array
+
+    Returns (device_type, groups, records).  Nothing is parsed up front;
+    each field of records is a zero-copy view of the file.
+    """
+    if not HAS_NUMPY:
+        raise NotImplementedError('numpy not available')
+
+    with open(filename, 'rb') as f:
+        device_type, groups, size, header_size = decode_header(f.read(_header.size + 255))
+        file_size = os.fstat(f.fileno()).st_size
+    dtype = numpy_dtype(device_type, groups)
+    count = (file_size - header_size) // dtype.itemsize
+    if not count:
+        return device_type, groups, numpy.zeros(0, dtype=dtype)
+    return device_type, groups, numpy.memmap(filename, dtype=dtype, mode='r', offset=header_size, shape=(count,))
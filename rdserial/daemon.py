@@ -0,0 +1,307 @@
+# rdserialtool
+# Copyright (C) 2019 Ryan Finnie
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# Daemon mode keeps the device connection open and serves samples and
+# commands to short-lived clients over a Unix domain socket, so they
+# don't each pay for connecting:
+#
+#   $ rdserialtool --serial-device=/dev/rfcomm0 --daemon=/tmp/dps.sock dps
+#   $ python3 -m rdserial.daemon /tmp/dps.sock
+#   $ python3 -m rdserial.daemon /tmp/dps.sock dps --set-volts=3.3 --on
+#
+# The protocol is one JSON object per line each way.  Requests are
+#
+#   {"request": "read", "max_age": 1.0}
+#   {"request": "read", "options": {"group": [1, 2]}}
+#   {"request": "set", "options": {"set_volts": 3.3, "set_output_state": true}}
+#
+# where max_age (optional) is how old, in seconds, the latest sample may
+# be and still be answered with, and options are the command's argument
+# names and values.  A read's options (optional) change what is read, in
+# place of the daemon's own (e.g. DPS --group and --all-groups); a set
+# without them reads, and sets group settings of, the daemon's groups.  Responses are {"sample": {...}, "age": seconds}, or
+# {"error": "..."}.  Only one request at a time talks to the device.
+
+import argparse
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+import sys
+import threading
+import time
+
+import rdserial.scheduler
+
+
+class DaemonError(Exception):
+    pass
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = self.server.daemon.handle(json.loads(line.decode('utf-8')))
+            except Exception as e:
+                logging.debug('Daemon: request {} failed: {!r}'.format(line, e))
+                response = {'error': str(e)}
+            self.wfile.write((json.dumps(response, sort_keys=True) + '\n').encode('utf-8'))
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Daemon:
+    """Serve a tool's samples and commands on a Unix domain socket
+
+    tool is a rdserial.um.tool.Tool or rdserial.dps.tool.Tool, already
+    connected.  Reads are answered from the latest sample if it is no
+    older than max_age seconds (or the request's own max_age), and
+    otherwise by collecting a new one.
+    """
+    def __init__(self, tool, path, max_age=1.0, clock=time.monotonic):
+        self.tool = tool
+        self.path = path
+        self.max_age = max_age
+        self.clock = clock
+        # Held while talking to the device
+        self.lock = threading.Lock()
+        self.latest = None
+        self.latest_time = None
+        self.requests = 0
+        self.server = None
+
+    def _collect(self, args=None):
+        """Collect a new sample, returning (sample, age); the lock must be held
+
+        The sample is published unless args' read options differ from the
+        tool's own.
+        """
+        try:
+            sample = self.tool.get_dict(self.tool.collect(args))
+        except Exception as e:
+            # Reconnects (holding the lock) if the link has dropped
+            self.tool.recover(e)
+            raise
+        if not self._own_reads(args):
+            return sample, 0.0
+        self.latest = sample
+        self.latest_time = self.clock()
+        if self.tool.metrics is not None:
+            self.tool.metrics.update(sample)
+        if self.tool.callback:
+            self.tool.callback(json.dumps(sample, sort_keys=True))
+        return sample, self._age()
+
+    def _age(self):
+        return self.clock() - self.latest_time
+
+    def _own_reads(self, args):
+        """Whether args read what the tool's own arguments do"""
+        return args is None or all(
+            getattr(args, name, None) == getattr(self.tool.args, name, None) for name in self.tool.read_options
+        )
+
+    def _args(self, options, names):
+        """The tool's arguments, with options (argument name:value) among names
+        set; read options are left as the tool's own unless one is given"""
+        available = [name for name in names if hasattr(self.tool.args, name)]
+        unknown = sorted(set(options) - set(available))
+        if unknown:
+            raise DaemonError('Unknown option(s): {}'.format(', '.join(unknown)))
+        own_reads = not any(name in options for name in self.tool.read_options)
+        args = argparse.Namespace(**vars(self.tool.args))
+        for name in available:
+            if own_reads and name in self.tool.read_options:
+                continue
+            setattr(args, name, options.get(name))
+        return args
+
+    def read(self, max_age=None, options=None):
+        """Return (sample, age), collecting a new sample if needed
+
+        Given read options (argument name:value), a sample of them is
+        collected, unless they are the tool's own.
+        """
+        if max_age is None:
+            max_age = self.max_age
+        args = self._args(options or {}, self.tool.read_options)
+        with self.lock:
+            if not self._own_reads(args):
+                return self._collect(args)
+            if self.latest is None or self._age() > max_age:
+                self._collect()
+            return self.latest, self._age()
+
+    def command(self, options):
+        """Send commands, given as argument name:value, returning (sample, age)
+        of the sample collected afterwards"""
+        args = self._args(options, self.tool.command_options)
+        with self.lock:
+            self.tool.send_commands(args)
+            return self._collect(args)
+
+    def handle(self, request):
+        self.requests += 1
+        kind = request.get('request', 'read')
+        if kind == 'read':
+            sample, age = self.read(request.get('max_age'), request.get('options'))
+        elif kind == 'set':
+            sample, age = self.command(request.get('options', {}))
+        else:
+            raise DaemonError('Unknown request "{}"'.format(kind))
+        return {'sample': sample, 'age': age}
+
+    def _bind(self):
+        if os.path.exists(self.path) and stat.S_ISSOCK(os.stat(self.path).st_mode):
+            # Remove a socket left behind by a daemon which has gone away
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                    s.connect(self.path)
+            except ConnectionRefusedError:
+                os.unlink(self.path)
+            else:
+                raise DaemonError('A daemon is already serving', self.path)
+        self.server = _Server(self.path, _Handler)
+        self.server.daemon = self
+
+    def serve(self):
+        """Serve until interrupted
+
+        In watch mode, a sample is also collected every --watch-seconds,
+        keeping the latest sample fresh for readers.
+        """
+        self._bind()
+        logging.info('Serving on {}'.format(self.path))
+        thread = None
+        try:
+            if not self.tool.args.watch:
+                self.server.serve_forever()
+                return
+            thread = threading.Thread(target=self.server.serve_forever, name='daemon', daemon=True)
+            thread.start()
+            self.tool.scheduler = rdserial.scheduler.Scheduler(
+                self.tool.args.watch_seconds, policy=self.tool.args.watch_policy,
+            )
+            while True:
+                try:
+                    with self.lock:
+                        self._collect()
+                except EOFError:
+                    return
+                except Exception:
+                    logging.exception('An exception has occurred')
+                self.tool.scheduler.wait()
+        finally:
+            if thread is not None:
+                self.server.shutdown()
+            self.server.server_close()
+            os.unlink(self.path)
+            logging.info('Served {} request(s)'.format(self.requests))
+
+
+def request(path, request, timeout=None):
+    """Send a request to a daemon, returning its response"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(path)
+        s.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        with s.makefile('rb') as f:
+            line = f.readline()
+    if not line:
+        raise DaemonError('No response from daemon', path)
+    response = json.loads(line.decode('utf-8'))
+    if 'error' in response:
+        raise DaemonError(response['error'])
+    return response
+
+
+def parse_args(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    # Imported here; the tools import this module
+    import rdserial.um.tool
+    import rdserial.dps.tool
+
+    parser = argparse.ArgumentParser(
+        description='rdserialtool daemon client',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        prog=os.path.basename(argv[0]),
+        epilog='Give a command and its options to send commands, rather than read',
+    )
+    parser.add_argument(
+        'socket',
+        help='Unix domain socket of the daemon (rdserialtool --daemon)',
+    )
+    parser.add_argument(
+        '--max-age', type=float, default=None,
+        help="Seconds old the daemon's latest sample may be (default: the daemon's --daemon-max-age)",
+    )
+    parser.add_argument(
+        '--timeout', type=float, default=10.0,
+        help='Seconds to wait for the daemon',
+    )
+    subparsers = parser.add_subparsers(dest='command', help='Commands')
+    rdserial.um.tool.add_subparsers(subparsers)
+    rdserial.dps.tool.add_subparsers(subparsers)
+    args = parser.parse_args(args=argv[1:])
+
+    args.options = {}
+    args.read_only = True
+    if args.command is not None:
+        tool = rdserial.dps.tool.Tool if args.command == 'dps' else rdserial.um.tool.Tool
+        # What each option is when not given.  Not get_default(): with
+        # --on/--off sharing a dest, that finds --on's default.
+        defaults = vars(subparsers.choices[args.command].parse_args([]))
+        for name in tool.command_options:
+            value = getattr(args, name, None)
+            # Flags not given; --off and the like are False when given
+            if (value is None) or (value is False and defaults.get(name) is False):
+                continue
+            args.options[name] = value
+            if name not in tool.read_options:
+                args.read_only = False
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not args.read_only:
+        req = {'request': 'set', 'options': args.options}
+    else:
+        req = {'request': 'read'}
+        if args.options:
+            req['options'] = args.options
+        if args.max_age is not None:
+            req['max_age'] = args.max_age
+    try:
+        response = request(args.socket, req, timeout=args.timeout)
+    except (OSError, DaemonError) as e:
+        print('{}: {}'.format(os.path.basename(sys.argv[0]), e), file=sys.stderr)
+        return 1
+    print(json.dumps(response['sample'], sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
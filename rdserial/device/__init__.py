@@ -17,6 +17,8 @@
 # 02110-1301, USA.
 
 import logging
+import select
+import time
 
 try:
     import bluetooth
@@ -30,13 +32,110 @@ except ImportError:
     HAS_SERIAL = False
 
 
+def _deadline(timeout):
+    if timeout is None:
+        return None
+    return time.monotonic() + timeout
+
+
+def wait_ready(socket, probe, timeout=None, probe_timeout=0.25, max_probe_timeout=2.0):
+    """Probe the device until it answers, returning (seconds, probes) taken
+
+    probe(timeout) sends a request and returns whether a valid answer
+    came back within timeout seconds.  A probe which times out or gets a
+    bad answer is retried with double the timeout (up to
+    max_probe_timeout), after giving late answers as long again to
+    arrive and discarding them.  Raises TimeoutError if the device isn't
+    ready within timeout seconds.
+    """
+    start = time.monotonic()
+    deadline = _deadline(timeout)
+    probes = 0
+    while True:
+        probes += 1
+        try:
+            if probe(probe_timeout):
+                return time.monotonic() - start, probes
+            logging.debug('Probe {}: invalid answer'.format(probes))
+        except TimeoutError:
+            logging.debug('Probe {}: no answer within {}s'.format(probes, probe_timeout))
+        if deadline is not None and time.monotonic() + probe_timeout > deadline:
+            raise TimeoutError('Device not ready after {:.2f}s ({} probes)'.format(time.monotonic() - start, probes))
+        time.sleep(probe_timeout)
+        socket.discard_input()
+        probe_timeout = min(probe_timeout * 2, max_probe_timeout)
+
+
+class Reconnector:
+    """Reconnect a transport whose link has dropped
+
+    failure(error) is given each error talking to the device, and
+    success() each success.  A connection error (any OSError other than
+    a timeout, which includes serial and Bluetooth errors) means the link
+    is down, and max_timeouts timeouts in a row that it has most likely
+    gone quietly.  Reconnection attempts start delay seconds apart,
+    doubling up to max_delay, and go on until one connects and ready()
+    (if given, e.g. a readiness probe) succeeds.
+    """
+    def __init__(self, socket, ready=None, delay=0.5, max_delay=30.0, max_timeouts=3, sleep=time.sleep):
+        self.socket = socket
+        self.ready = ready
+        self.delay = delay
+        self.max_delay = max_delay
+        self.max_timeouts = max_timeouts
+        self.sleep = sleep
+        self.timeouts = 0
+        self.reconnects = 0
+
+    def success(self):
+        self.timeouts = 0
+
+    def failure(self, error):
+        """Reconnect if error means the link has dropped, returning whether it did"""
+        if isinstance(error, TimeoutError):
+            self.timeouts += 1
+            if self.timeouts < self.max_timeouts:
+                return False
+        elif not isinstance(error, OSError):
+            return False
+        self.reconnect()
+        return True
+
+    def reconnect(self):
+        """Close and reconnect, returning the number of attempts taken"""
+        delay = min(self.delay, self.max_delay)
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                self.socket.close()
+            except OSError as e:
+                logging.debug('Reconnect: close failed: {!r}'.format(e))
+            logging.warning('Reconnecting to {} in {:.2f}s (attempt {})'.format(self.socket, delay, attempts))
+            self.sleep(delay)
+            try:
+                self.socket.connect()
+                if self.ready is not None:
+                    self.ready()
+            except OSError as e:
+                logging.warning('Reconnecting to {} failed: {!r}'.format(self.socket, e))
+                delay = min(delay * 2, self.max_delay)
+                continue
+            break
+        self.timeouts = 0
+        self.reconnects += 1
+        logging.warning('Reconnected to {} after {} attempt(s)'.format(self.socket, attempts))
+        return attempts
+
+
 class Serial:
-    def __init__(self, port, baudrate=9600):
+    def __init__(self, port, baudrate=9600, timeout=None):
         if not HAS_SERIAL:
             raise NotImplementedError('pyserial not available')
 
         self.port = port
         self.baudrate = baudrate
+        self.timeout = timeout
         self.socket = None
 
     def connect(self):
@@ -51,38 +150,72 @@ class Serial:
         return self.socket is not None
 
     def close(self):
-        if self.socket:
-            self.socket.close()
-        self.socket = None
+        try:
+            if self.socket:
+                self.socket.close()
+        finally:
+            # Forget a socket which failed to close, so connect() makes a new one
+            self.socket = None
 
     def send(self, request):
         if not request:
             return 0
-        logging.debug('Serial: SEND begin ({})'.format(request))
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('Serial: SEND begin ({})'.format(bytes(request)))
         size = self.socket.write(request)
         logging.debug('Serial: SEND end ({} bytes)'.format(size))
         return size
 
-    def recv(self, size):
-        result = b''
+    def recv_into(self, buffer, size=None, timeout=None):
+        """Read exactly size bytes into buffer, within timeout seconds"""
+        if size is None:
+            size = len(buffer)
+        if timeout is None:
+            timeout = self.timeout
+        deadline = _deadline(timeout)
+        view = memoryview(buffer)
+        received = 0
         logging.debug('Serial: RECV begin')
-        while len(result) < size:
-            buf = self.socket.read()
-            result += buf
-        logging.debug('Serial: RECV end ({})'.format(result))
-        return result
+        # pyserial's read() blocks until the requested size or its own
+        # timeout, so one call normally satisfies the whole request.  Its
+        # timeout is only set when it changes, as each change reconfigures
+        # the port (tcgetattr/tcsetattr): the first read of a call waits
+        # the call's whole timeout, and only reads after a short one
+        # need the time remaining.
+        read_timeout = timeout
+        while received < size:
+            if self.socket.timeout != read_timeout:
+                self.socket.timeout = read_timeout
+            received += self.socket.readinto(view[received:size])
+            if received < size and deadline is not None:
+                read_timeout = deadline - time.monotonic()
+                if read_timeout <= 0:
+                    raise TimeoutError('Serial: RECV timed out ({} of {} bytes)'.format(received, size))
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('Serial: RECV end ({})'.format(bytes(view[:size])))
+        return received
+
+    def recv(self, size, timeout=None):
+        result = bytearray(size)
+        self.recv_into(result, size, timeout=timeout)
+        return bytes(result)
+
+    def discard_input(self):
+        """Throw away any received data not yet read"""
+        self.socket.reset_input_buffer()
 
     def __str__(self):
         return '%s' % self.port
 
 
 class Bluetooth:
-    def __init__(self, address, port=1):
+    def __init__(self, address, port=1, timeout=None):
         if not HAS_BLUETOOTH:
             raise NotImplementedError('pybluez not available')
 
         self.address = address
         self.port = port
+        self.timeout = timeout
         self.socket = None
 
     def connect(self):
@@ -94,27 +227,63 @@ class Bluetooth:
         return self.socket is not None
 
     def close(self):
-        if self.socket:
-            self.socket.close()
-        self.socket = None
+        try:
+            if self.socket:
+                self.socket.close()
+        finally:
+            # Forget a socket which failed to close, so connect() makes a new one
+            self.socket = None
 
     def send(self, request):
         if not request:
             return 0
 
-        logging.debug('Bluetooth: SEND begin ({})'.format(request))
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('Bluetooth: SEND begin ({})'.format(bytes(request)))
         size = self.socket.send(request)
         logging.debug('Bluetooth: SEND end ({} bytes)'.format(size))
         return size
 
-    def recv(self, size):
-        result = b''
+    def recv_into(self, buffer, size=None, timeout=None):
+        """Read exactly size bytes into buffer, within timeout seconds"""
+        if size is None:
+            size = len(buffer)
+        if timeout is None:
+            timeout = self.timeout
+        deadline = _deadline(timeout)
+        view = memoryview(buffer)
+        received = 0
+        # Not all PyBluez backends expose recv_into()
+        recv_into = getattr(self.socket, 'recv_into', None)
         logging.debug('Bluetooth: RECV begin')
-        while len(result) < size:
-            buf = self.socket.recv(size)
-            result += buf
-        logging.debug('Bluetooth: RECV end ({})'.format(result))
-        return result
+        while received < size:
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not select.select([self.socket], [], [], remaining)[0]:
+                    raise TimeoutError('Bluetooth: RECV timed out ({} of {} bytes)'.format(received, size))
+            if recv_into is not None:
+                n = recv_into(view[received:size], size - received)
+            else:
+                buf = self.socket.recv(size - received)
+                n = len(buf)
+                view[received:received+n] = buf
+            if n == 0:
+                raise ConnectionError('Bluetooth: connection closed')
+            received += n
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('Bluetooth: RECV end ({})'.format(bytes(view[:size])))
+        return received
+
+    def recv(self, size, timeout=None):
+        result = bytearray(size)
+        self.recv_into(result, size, timeout=timeout)
+        return bytes(result)
+
+    def discard_input(self):
+        """Throw away any received data not yet read"""
+        while select.select([self.socket], [], [], 0)[0]:
+            if not self.socket.recv(1024):
+                break
 
     def __str__(self):
         return '%s:%s' % (self.address, self.port)
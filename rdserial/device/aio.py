@@ -0,0 +1,231 @@
+# rdserialtool
+# Copyright (C) 2019 Ryan Finnie
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# asyncio versions of the rdserial.device transports.  Reads wait for
+# the underlying file descriptor to become readable on the event loop,
+# so many devices can be serviced from one thread.  Requires a
+# selectable file descriptor (i.e. not Windows serial ports).
+
+import asyncio
+import logging
+import select
+import time
+
+try:
+    import bluetooth
+    HAS_BLUETOOTH = True
+except ImportError:
+    HAS_BLUETOOTH = False
+try:
+    import serial
+    HAS_SERIAL = True
+except ImportError:
+    HAS_SERIAL = False
+
+
+async def wait_readable(fd, timeout=None):
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+
+    def ready():
+        if not future.done():
+            future.set_result(None)
+
+    loop.add_reader(fd, ready)
+    try:
+        await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        raise TimeoutError('Timed out waiting for data')
+    finally:
+        loop.remove_reader(fd)
+
+
+async def wait_ready(socket, probe, timeout=None, probe_timeout=0.25, max_probe_timeout=2.0):
+    """Probe the device until it answers, as rdserial.device.wait_ready()
+
+    probe(timeout) is a coroutine function.
+    """
+    start = time.monotonic()
+    deadline = None if timeout is None else start + timeout
+    probes = 0
+    while True:
+        probes += 1
+        try:
+            if await probe(probe_timeout):
+                return time.monotonic() - start, probes
+            logging.debug('{}: probe {}: invalid answer'.format(socket, probes))
+        except TimeoutError:
+            logging.debug('{}: probe {}: no answer within {}s'.format(socket, probes, probe_timeout))
+        if deadline is not None and time.monotonic() + probe_timeout > deadline:
+            raise TimeoutError('Device not ready after {:.2f}s ({} probes)'.format(time.monotonic() - start, probes))
+        await asyncio.sleep(probe_timeout)
+        socket.discard_input()
+        probe_timeout = min(probe_timeout * 2, max_probe_timeout)
+
+
+class Transport:
+    name = 'Transport'
+    timeout = None
+    socket = None
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def _read_into(self, view):
+        raise NotImplementedError()
+
+    def _write(self, data):
+        raise NotImplementedError()
+
+    async def send(self, request):
+        if not request:
+            return 0
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('{}: SEND begin ({})'.format(self.name, bytes(request)))
+        size = self._write(request)
+        logging.debug('{}: SEND end ({} bytes)'.format(self.name, size))
+        return size
+
+    async def recv_into(self, buffer, size=None, timeout=None):
+        """Read exactly size bytes into buffer, within timeout seconds"""
+        if size is None:
+            size = len(buffer)
+        if timeout is None:
+            timeout = self.timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        view = memoryview(buffer)
+        received = 0
+        logging.debug('{}: RECV begin'.format(self.name))
+        while received < size:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError('{}: RECV timed out ({} of {} bytes)'.format(self.name, received, size))
+            try:
+                await wait_readable(self.fileno(), remaining)
+            except TimeoutError:
+                raise TimeoutError('{}: RECV timed out ({} of {} bytes)'.format(self.name, received, size))
+            n = self._read_into(view[received:size])
+            if n == 0:
+                raise ConnectionError('{}: connection closed'.format(self.name))
+            received += n
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('{}: RECV end ({})'.format(self.name, bytes(view[:size])))
+        return received
+
+    async def recv(self, size, timeout=None):
+        result = bytearray(size)
+        await self.recv_into(result, size, timeout=timeout)
+        return bytes(result)
+
+    def discard_input(self):
+        """Throw away any received data not yet read"""
+        buf = bytearray(1024)
+        while select.select([self.fileno()], [], [], 0)[0]:
+            if not self._read_into(memoryview(buf)):
+                break
+
+
+class Serial(Transport):
+    name = 'Serial'
+
+    def __init__(self, port, baudrate=9600, timeout=None):
+        if not HAS_SERIAL:
+            raise NotImplementedError('pyserial not available')
+
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.socket = None
+
+    async def connect(self):
+        if self.socket:
+            return True
+        logging.debug('Serial: Connecting to {}'.format(self.port))
+        self.socket = serial.Serial()
+        self.socket.port = self.port
+        self.socket.baudrate = self.baudrate
+        # Non-blocking in both directions; readiness comes from the event loop
+        self.socket.timeout = 0
+        self.socket.writeTimeout = 0
+        self.socket.open()
+        return self.socket is not None
+
+    def close(self):
+        try:
+            if self.socket:
+                self.socket.close()
+        finally:
+            # Forget a socket which failed to close, so connect() makes a new one
+            self.socket = None
+
+    def _read_into(self, view):
+        buf = self.socket.read(len(view))
+        view[:len(buf)] = buf
+        return len(buf)
+
+    def _write(self, data):
+        return self.socket.write(data)
+
+    def __str__(self):
+        return '%s' % self.port
+
+
+class Bluetooth(Transport):
+    name = 'Bluetooth'
+
+    def __init__(self, address, port=1, timeout=None):
+        if not HAS_BLUETOOTH:
+            raise NotImplementedError('pybluez not available')
+
+        self.address = address
+        self.port = port
+        self.timeout = timeout
+        self.socket = None
+
+    async def connect(self):
+        if self.socket:
+            return True
+        logging.debug('Bluetooth: Connecting to {} port {}'.format(self.address, self.port))
+        self.socket = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+        # PyBluez has no non-blocking connect; only the connect itself
+        # is handed off to the default executor.
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.socket.connect, (self.address, self.port))
+        self.socket.setblocking(False)
+        return self.socket is not None
+
+    def close(self):
+        try:
+            if self.socket:
+                self.socket.close()
+        finally:
+            # Forget a socket which failed to close, so connect() makes a new one
+            self.socket = None
+
+    def _read_into(self, view):
+        buf = self.socket.recv(len(view))
+        view[:len(buf)] = buf
+        return len(buf)
+
+    def _write(self, data):
+        return self.socket.send(data)
+
+    def __str__(self):
+        return '%s:%s' % (self.address, self.port)
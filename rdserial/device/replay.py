@@ -0,0 +1,205 @@
+# rdserialtool
+# Copyright (C) 2019 Ryan Finnie
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# Raw transport recording and replay.  Recorder wraps a live transport
+# and saves every byte sent and received; Replay is a transport which
+# plays a recording back, at the original pace, N times faster, or as
+# fast as possible.  Both have the rdserial.device transport interface.
+#
+# A recording is a header (magic b'RDRW', version (B), command (8s),
+# wall clock start (d), monotonic start (d)) followed by events: seconds
+# since the start (d), direction (c, b'S' or b'R'), length (H), data.
+# All little-endian.
+
+import datetime
+import logging
+import struct
+import time
+
+MAGIC = b'RDRW'
+VERSION = 1
+SEND = b'S'
+RECV = b'R'
+
+_header = struct.Struct('<4sB8sdd')
+_event = struct.Struct('<dcH')
+
+
+class ReplayError(Exception):
+    pass
+
+
+class Recorder:
+    """Pass through to a transport, saving everything sent and received"""
+    def __init__(self, socket, filename, command=''):
+        self.socket = socket
+        self.filename = filename
+        self.start = time.monotonic()
+        self.file = open(filename, 'wb')
+        self.file.write(_header.pack(MAGIC, VERSION, command.encode('ascii'), time.time(), self.start))
+
+    def _record(self, direction, data):
+        self.file.write(_event.pack(time.monotonic() - self.start, direction, len(data)))
+        self.file.write(data)
+
+    def connect(self):
+        if self.file.closed:
+            # Reconnecting; carry on with the same recording
+            self.file = open(self.filename, 'ab')
+        return self.socket.connect()
+
+    def close(self):
+        self.socket.close()
+        self.file.close()
+
+    def send(self, request):
+        size = self.socket.send(request)
+        self._record(SEND, bytes(request))
+        return size
+
+    def recv_into(self, buffer, size=None, timeout=None):
+        if size is None:
+            size = len(buffer)
+        received = self.socket.recv_into(buffer, size, timeout=timeout)
+        self._record(RECV, bytes(memoryview(buffer)[:size]))
+        # One flush per exchange, so a recording survives being killed
+        self.file.flush()
+        return received
+
+    def recv(self, size, timeout=None):
+        result = bytearray(size)
+        self.recv_into(result, size, timeout=timeout)
+        return bytes(result)
+
+    def discard_input(self):
+        self.socket.discard_input()
+
+    def __str__(self):
+        return str(self.socket)
+
+
+class Replay:
+    """Transport playing back a Recorder recording
+
+    speed is a multiple of the recorded pace, or None to replay as fast
+    as possible.  Reads which were never answered in the recording time
+    out immediately, and reading past the end raises EOFError.
+    clock() and now() give the recorded monotonic and wall clock times
+    of the current position, for use in place of the real clocks.
+    """
+    def __init__(self, filename, speed=None):
+        self.filename = filename
+        self.speed = speed
+        self.file = None
+        with open(filename, 'rb') as f:
+            magic, version, command, self.wall_start, self.monotonic_start = _header.unpack(f.read(_header.size))
+        if magic != MAGIC:
+            raise ReplayError('Not a raw recording', filename)
+        if version != VERSION:
+            raise ReplayError('Unsupported raw recording version', version)
+        self.command = command.rstrip(b'\0').decode('ascii')
+        self.offset = 0.0
+        self._pending = bytearray()
+        self._next = None
+        self._started = None
+
+    def connect(self):
+        if self.file:
+            return True
+        self.file = open(self.filename, 'rb')
+        self.file.seek(_header.size)
+        self._started = time.monotonic()
+        return True
+
+    def close(self):
+        if self.file:
+            self.file.close()
+        self.file = None
+
+    def _peek(self):
+        """Return the next (offset, direction, data) event, or None at the end"""
+        if self._next is None:
+            header = self.file.read(_event.size)
+            if len(header) < _event.size:
+                return None
+            offset, direction, length = _event.unpack(header)
+            data = self.file.read(length)
+            if len(data) < length:
+                return None
+            self._next = (offset, direction, data)
+        return self._next
+
+    def _take(self):
+        event = self._peek()
+        self._next = None
+        if event is not None:
+            self.offset = event[0]
+        return event
+
+    def _pace(self, offset):
+        if not self.speed:
+            return
+        delay = self._started + (offset / self.speed) - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def clock(self):
+        return self.monotonic_start + self.offset
+
+    def now(self):
+        return datetime.datetime.fromtimestamp(self.wall_start + self.offset)
+
+    def send(self, request):
+        """Skip past the recorded requests preceding the next response"""
+        request = bytes(request)
+        if self._peek() is None:
+            raise EOFError('End of replay')
+        recorded = []
+        while (self._peek() is not None) and (self._peek()[1] == SEND):
+            recorded.append(self._take()[2])
+        if request not in recorded:
+            logging.warning('Replay: sent {} but the recording has {}'.format(request, recorded))
+        return len(request)
+
+    def recv_into(self, buffer, size=None, timeout=None):
+        if size is None:
+            size = len(buffer)
+        while len(self._pending) < size:
+            event = self._peek()
+            if event is None:
+                raise EOFError('End of replay')
+            if event[1] != RECV:
+                # The recording got no (complete) answer here
+                raise TimeoutError('Replay: RECV timed out ({} of {} bytes)'.format(len(self._pending), size))
+            self._take()
+            self._pace(event[0])
+            self._pending += event[2]
+        buffer[:size] = self._pending[:size]
+        del self._pending[:size]
+        return size
+
+    def recv(self, size, timeout=None):
+        result = bytearray(size)
+        self.recv_into(result, size, timeout=timeout)
+        return bytes(result)
+
+    def discard_input(self):
+        del self._pending[:]
+
+    def __str__(self):
+        return '{} (replay)'.format(self.filename)
@@ -17,187 +17,488 @@
 # 02110-1301, USA.
 
 import datetime
+import logging
+import time
+
+import rdserial.modbus
 
 PROTECTION_GOOD = 0
 PROTECTION_OV = 1
 PROTECTION_OC = 2
 PROTECTION_OP = 3
 
+# Register cache classes
+CACHE_NEVER = 0  # Live measurements, always read from the device
+CACHE_SETTING = 1  # Settings, cached until written
+CACHE_FOREVER = 2  # Device identity, never changes
 
-class DeviceState:
-    def __init__(self, collection_time=None):
-        self.register_properties = {
-            'setting_volts': {
-                'description': 'Voltage setting',
-                'register': 0x00,
-                'from_int': lambda x: x / 100,
-                'to_int': lambda x: int(x * 100),
-            },
-            'setting_amps': {
-                'description': 'Amperage setting',
-                'register': 0x01,
-                'from_int': lambda x: x / 1000,
-                'to_int': lambda x: int(x * 1000),
-            },
-            'volts': {
-                'description': 'Output volts',
-                'register': 0x02,
-                'from_int': lambda x: x / 100,
-                'to_int': lambda x: int(x * 100),
-            },
-            'amps': {
-                'description': 'Output amps',
-                'register': 0x03,
-                'from_int': lambda x: x / 100,
-                'to_int': lambda x: int(x * 100),
-            },
-            'watts': {
-                'description': 'Output watts',
-                'register': 0x04,
-                'from_int': lambda x: x / 100,
-                'to_int': lambda x: int(x * 100),
-            },
-            'input_volts': {
-                'description': 'Input volts',
-                'register': 0x05,
-                'from_int': lambda x: x / 100,
-                'to_int': lambda x: int(x * 100),
-            },
-            'key_lock': {
-                'description': 'Key lock',
-                'register': 0x06,
-                'from_int': lambda x: bool(x),
-                'to_int': lambda x: int(x),
-            },
-            'protection': {
-                'description': 'Protection status',
-                'register': 0x07,
-                'from_int': lambda x: x,
-                'to_int': lambda x: int(x),
-            },
-            'constant_current': {
-                'description': 'Constant current mode',
-                'register': 0x08,
-                'from_int': lambda x: bool(x),
-                'to_int': lambda x: int(x),
-            },
-            'output_state': {
-                'description': 'Output state',
-                'register': 0x09,
-                'from_int': lambda x: bool(x),
-                'to_int': lambda x: int(x),
-            },
-            'brightness': {
-                'description': 'Brightness level',
-                'register': 0x0a,
-                'from_int': lambda x: x,
-                'to_int': lambda x: int(x),
-            },
-            'model': {
-                'description': 'Device model',
-                'register': 0x0b,
-                'from_int': lambda x: x,
-                'to_int': lambda x: int(x),
-            },
-            'firmware': {
-                'description': 'Device firmware',
-                'register': 0x0c,
-                'from_int': lambda x: x,
-                'to_int': lambda x: int(x),
-            },
-            'group_loader': {
-                'description': 'Group loader',
-                'register': 0x23,
-                'from_int': lambda x: 0,
-                'to_int': lambda x: int(x),
-            },
-        }
+# Maximum number of registers read or written in one transaction
+MAX_REGISTERS = 32
+# Number of unwanted registers worth reading to avoid another round trip.
+# Each register costs 2 bytes on the wire; a transaction costs a 8 byte
+# request, 5 bytes of response framing, two 3.5 character silent
+# periods and the device's turnaround time.
+MAX_READ_GAP = 16
+
+GROUP_BASE = 0x50
+GROUP_STRIDE = 0x10
+GROUP_LENGTH = 8
+
+
+def register_ranges(groups=()):
+    """(base, length) register ranges holding the device state and groups"""
+    return [(0x00, 13)] + [(GROUP_BASE + (GROUP_STRIDE * group), GROUP_LENGTH) for group in groups]
+
+
+def device_state_from_registers(registers, groups=(), collection_time=None):
+    """Build a DeviceState, with groups, from a register:value dict"""
+    device_state = DeviceState(collection_time=collection_time)
+    device_state.load_map(registers)
+    for group in groups:
+        device_group_state = GroupState(group)
+        device_group_state.load_map(registers)
+        device_state.groups[group] = device_group_state
+    return device_state
+
+
+def probe(socket, timeout, unit=1, baudrate=9600):
+    """Read the model register, returning whether the unit answers within timeout"""
+    modbus_client = rdserial.modbus.RTUClient(socket, baudrate=baudrate)
+    modbus_client.timeout = timeout
+    try:
+        modbus_client.read_registers(DeviceState.register_properties['model']['register'], 1, unit=unit)
+    except rdserial.modbus.ExceptionResponse:
+        # An answer all the same
+        pass
+    except rdserial.modbus.ModbusError:
+        return False
+    return True
+
+
+def _compile_registers(register_properties):
+    """Compile register properties into (register, name, from_int) tuples"""
+    return tuple(sorted(
+        (properties['register'], name, properties['from_int'])
+        for name, properties in register_properties.items()
+    ))
 
+
+class RegisterState:
+    """Common loading for register-backed state classes
+
+    Subclasses provide a _registers tuple of (register, name, from_int),
+    compiled once from their register properties.
+    """
+    __slots__ = ()
+
+    def _load_defaults(self):
+        for register, name, from_int in self._registers:
+            setattr(self, name, from_int(0))
+
+    def load(self, data, offset=0):
+        length = len(data)
+        for register, name, from_int in self._registers:
+            index = register - offset
+            if 0 <= index < length:
+                setattr(self, name, from_int(data[index]))
+
+    def load_map(self, registers):
+        for register, name, from_int in self._registers:
+            if register in registers:
+                setattr(self, name, from_int(registers[register]))
+
+
+class DeviceState(RegisterState):
+    register_properties = {
+        'setting_volts': {
+            'description': 'Voltage setting',
+            'register': 0x00,
+            'cache': CACHE_SETTING,
+            'from_int': lambda x: x / 100,
+            'to_int': lambda x: int(x * 100),
+        },
+        'setting_amps': {
+            'description': 'Amperage setting',
+            'register': 0x01,
+            'cache': CACHE_SETTING,
+            'from_int': lambda x: x / 1000,
+            'to_int': lambda x: int(x * 1000),
+        },
+        'volts': {
+            'description': 'Output volts',
+            'register': 0x02,
+            'cache': CACHE_NEVER,
+            'from_int': lambda x: x / 100,
+            'to_int': lambda x: int(x * 100),
+        },
+        'amps': {
+            'description': 'Output amps',
+            'register': 0x03,
+            'cache': CACHE_NEVER,
+            'from_int': lambda x: x / 100,
+            'to_int': lambda x: int(x * 100),
+        },
+        'watts': {
+            'description': 'Output watts',
+            'register': 0x04,
+            'cache': CACHE_NEVER,
+            'from_int': lambda x: x / 100,
+            'to_int': lambda x: int(x * 100),
+        },
+        'input_volts': {
+            'description': 'Input volts',
+            'register': 0x05,
+            'cache': CACHE_NEVER,
+            'from_int': lambda x: x / 100,
+            'to_int': lambda x: int(x * 100),
+        },
+        'key_lock': {
+            'description': 'Key lock',
+            'register': 0x06,
+            'cache': CACHE_SETTING,
+            'from_int': lambda x: bool(x),
+            'to_int': lambda x: int(x),
+        },
+        'protection': {
+            'description': 'Protection status',
+            'register': 0x07,
+            'cache': CACHE_NEVER,
+            'from_int': lambda x: x,
+            'to_int': lambda x: int(x),
+        },
+        'constant_current': {
+            'description': 'Constant current mode',
+            'register': 0x08,
+            'cache': CACHE_NEVER,
+            'from_int': lambda x: bool(x),
+            'to_int': lambda x: int(x),
+        },
+        'output_state': {
+            'description': 'Output state',
+            'register': 0x09,
+            'cache': CACHE_NEVER,
+            'from_int': lambda x: bool(x),
+            'to_int': lambda x: int(x),
+        },
+        'brightness': {
+            'description': 'Brightness level',
+            'register': 0x0a,
+            'cache': CACHE_SETTING,
+            'from_int': lambda x: x,
+            'to_int': lambda x: int(x),
+        },
+        'model': {
+            'description': 'Device model',
+            'register': 0x0b,
+            'cache': CACHE_FOREVER,
+            'from_int': lambda x: x,
+            'to_int': lambda x: int(x),
+        },
+        'firmware': {
+            'description': 'Device firmware',
+            'register': 0x0c,
+            'cache': CACHE_FOREVER,
+            'from_int': lambda x: x,
+            'to_int': lambda x: int(x),
+        },
+        'group_loader': {
+            'description': 'Group loader',
+            'register': 0x23,
+            'cache': CACHE_NEVER,
+            'from_int': lambda x: 0,
+            'to_int': lambda x: int(x),
+        },
+    }
+
+    _registers = _compile_registers(register_properties)
+    __slots__ = ('collection_time', 'groups') + tuple(register_properties)
+
+    def __init__(self, collection_time=None):
         if collection_time is None:
             collection_time = datetime.datetime.now()
         self.collection_time = collection_time
-        for name in self.register_properties:
-            setattr(self, name, self.register_properties[name]['from_int'](0))
+        self._load_defaults()
         self.groups = {}
 
-    def load(self, data, offset=0):
-        pos_map = {v['register']: k for k, v in self.register_properties.items()}
-        i = 0
-        for raw_val in data:
-            val_pos = offset + i
-            if val_pos in pos_map:
-                name = pos_map[val_pos]
-                translation = self.register_properties[name]['from_int']
-                val = translation(raw_val)
-                setattr(self, name, val)
-            i = i + 1
-
-
-class GroupState:
+
+class GroupState(RegisterState):
+    # Group n's registers are at GROUP_BASE + (GROUP_STRIDE * n), plus
+    # the offsets below
+    base_register_properties = {
+        'setting_volts': {
+            'description': 'Voltage setting',
+            'register': 0x00,
+            'cache': CACHE_SETTING,
+            'from_int': lambda x: x / 100,
+            'to_int': lambda x: int(x * 100),
+        },
+        'setting_amps': {
+            'description': 'Amperage setting',
+            'register': 0x01,
+            'cache': CACHE_SETTING,
+            'from_int': lambda x: x / 1000,
+            'to_int': lambda x: int(x * 1000),
+        },
+        'cutoff_volts': {
+            'description': 'Volts cutoff',
+            'register': 0x02,
+            'cache': CACHE_SETTING,
+            'from_int': lambda x: x / 100,
+            'to_int': lambda x: int(x * 100),
+        },
+        'cutoff_amps': {
+            'description': 'Amps cutoff',
+            'register': 0x03,
+            'cache': CACHE_SETTING,
+            'from_int': lambda x: x / 1000,
+            'to_int': lambda x: int(x * 1000),
+        },
+        'cutoff_watts': {
+            'description': 'Watts cutoff',
+            'register': 0x04,
+            'cache': CACHE_SETTING,
+            'from_int': lambda x: x / 10,
+            'to_int': lambda x: int(x * 10),
+        },
+        'brightness': {
+            'description': 'Brightness level',
+            'register': 0x05,
+            'cache': CACHE_SETTING,
+            'from_int': lambda x: x,
+            'to_int': lambda x: int(x),
+        },
+        'maintain_output': {
+            'description': 'Maintain output state during group change',
+            'register': 0x06,
+            'cache': CACHE_SETTING,
+            'from_int': lambda x: bool(x),
+            'to_int': lambda x: int(x),
+        },
+        'poweron_output': {
+            'description': 'Enable output on power-on',
+            'register': 0x07,
+            'cache': CACHE_SETTING,
+            'from_int': lambda x: bool(x),
+            'to_int': lambda x: int(x),
+        },
+    }
+
+    __slots__ = ('group', 'register_properties', '_registers') + tuple(base_register_properties)
+    _group_register_properties = {}
+    _group_registers = {}
+
+    @classmethod
+    def group_register_properties(cls, group):
+        """Register properties for group, with absolute register numbers"""
+        if group not in cls._group_registers:
+            cls._compile_group(group)
+        return cls._group_register_properties[group]
+
+    @classmethod
+    def _compile_group(cls, group):
+        base = GROUP_BASE + (GROUP_STRIDE * group)
+        register_properties = {}
+        for name, properties in cls.base_register_properties.items():
+            register_properties[name] = dict(properties, register=(base + properties['register']))
+        cls._group_register_properties[group] = register_properties
+        cls._group_registers[group] = _compile_registers(register_properties)
+
     def __init__(self, group):
         self.group = group
-        self.register_properties = {
-            'setting_volts': {
-                'description': 'Voltage setting',
-                'register': 0x50 + (0x10 * group),
-                'from_int': lambda x: x / 100,
-                'to_int': lambda x: int(x * 100),
-            },
-            'setting_amps': {
-                'description': 'Amperage setting',
-                'register': 0x51 + (0x10 * group),
-                'from_int': lambda x: x / 1000,
-                'to_int': lambda x: int(x * 1000),
-            },
-            'cutoff_volts': {
-                'description': 'Volts cutoff',
-                'register': 0x52 + (0x10 * group),
-                'from_int': lambda x: x / 100,
-                'to_int': lambda x: int(x * 100),
-            },
-            'cutoff_amps': {
-                'description': 'Amps cutoff',
-                'register': 0x53 + (0x10 * group),
-                'from_int': lambda x: x / 1000,
-                'to_int': lambda x: int(x * 1000),
-            },
-            'cutoff_watts': {
-                'description': 'Watts cutoff',
-                'register': 0x54 + (0x10 * group),
-                'from_int': lambda x: x / 10,
-                'to_int': lambda x: int(x * 10),
-            },
-            'brightness': {
-                'description': 'Brightness level',
-                'register': 0x55 + (0x10 * group),
-                'from_int': lambda x: x,
-                'to_int': lambda x: int(x),
-            },
-            'maintain_output': {
-                'description': 'Maintain output state during group change',
-                'register': 0x56 + (0x10 * group),
-                'from_int': lambda x: bool(x),
-                'to_int': lambda x: int(x),
-            },
-            'poweron_output': {
-                'description': 'Enable output on power-on',
-                'register': 0x57 + (0x10 * group),
-                'from_int': lambda x: bool(x),
-                'to_int': lambda x: int(x),
-            },
+        self.register_properties = self.group_register_properties(group)
+        self._registers = self._group_registers[group]
+        self._load_defaults()
+
+
+class Client:
+    """DPS register access, caching registers which rarely change
+
+    Live measurements are always read from the device.  Identity
+    registers are cached forever, and settings are cached until they are
+    written through this client, or for settings_ttl seconds if given
+    (settings can also be changed from the device's front panel).
+    """
+    def __init__(self, modbus_client, unit=1, settings_ttl=None, clock=time.monotonic):
+        self.modbus_client = modbus_client
+        self.unit = unit
+        self.settings_ttl = settings_ttl
+        self.clock = clock
+        self.cache = {}
+
+        self.cache_classes = {}
+        self.group_loader_register = None
+        for register_properties in [DeviceState.register_properties] + [
+            GroupState.group_register_properties(group) for group in range(10)
+        ]:
+            for name, properties in register_properties.items():
+                self.cache_classes[properties['register']] = properties['cache']
+                if name == 'group_loader':
+                    self.group_loader_register = properties['register']
+
+    def invalidate(self, registers=None):
+        """Drop cached registers; all but identity registers if none are given"""
+        if registers is None:
+            registers = [
+                register for register in self.cache
+                if self.cache_classes[register] != CACHE_FOREVER
+            ]
+        for register in registers:
+            self.cache.pop(register, None)
+
+    def _cache_lookup(self, ranges, now):
+        """Split ranges into cached register values and ranges still to read"""
+        registers = {}
+        wanted = []
+        for base, length in ranges:
+            for register in range(base, base + length):
+                if register in self.cache:
+                    value, expires = self.cache[register]
+                    if (expires is None) or (expires > now):
+                        registers[register] = value
+                        continue
+                wanted.append(register)
+
+        wanted_ranges = []
+        for register in sorted(set(wanted)):
+            if wanted_ranges and register == sum(wanted_ranges[-1]):
+                wanted_ranges[-1] = (wanted_ranges[-1][0], wanted_ranges[-1][1] + 1)
+            else:
+                wanted_ranges.append((register, 1))
+        return registers, wanted_ranges
+
+    def _cache_store(self, registers, now):
+        for register, value in registers.items():
+            cache_class = self.cache_classes.get(register, CACHE_NEVER)
+            if cache_class == CACHE_FOREVER:
+                self.cache[register] = (value, None)
+            elif cache_class == CACHE_SETTING:
+                self.cache[register] = (value, None if self.settings_ttl is None else now + self.settings_ttl)
+
+    def _plan_writes(self, register_commands):
+        """Merge a register:value dict into (base, values) writes"""
+        register_commands_opt = {}
+        for register in sorted(register_commands.keys()):
+            found_opt = False
+            for g in register_commands_opt:
+                if (register == g + len(register_commands_opt[g])) and (len(register_commands_opt[g]) < MAX_REGISTERS):
+                    register_commands_opt[g].append(register_commands[register])
+                    found_opt = True
+                    break
+            if not found_opt:
+                register_commands_opt[register] = [register_commands[register]]
+        for register_base in register_commands_opt:
+            logging.debug('Writing {} register(s) ({}) at base {}'.format(
+                len(register_commands_opt[register_base]),
+                register_commands_opt[register_base],
+                register_base,
+            ))
+        return sorted(register_commands_opt.items())
+
+    def _written(self, register_commands):
+        if self.group_loader_register in register_commands:
+            # Loading a group replaces the current settings wholesale
+            self.invalidate()
+        else:
+            self.invalidate(register_commands.keys())
+
+    def read_registers(self, ranges):
+        """Read (base, length) register ranges, returning a register:value dict"""
+        now = self.clock()
+        registers, wanted_ranges = self._cache_lookup(ranges, now)
+        if not wanted_ranges:
+            return registers
+        fresh = self.modbus_client.read_register_map(
+            wanted_ranges, unit=self.unit, max_length=MAX_REGISTERS, max_gap=MAX_READ_GAP,
+        )
+        self._cache_store(fresh, now)
+        registers.update(fresh)
+        return registers
+
+    def _changed(self, register_commands, current):
+        """The commands for registers not already at their value"""
+        changed = {
+            register: value for register, value in register_commands.items()
+            # Loading a group is an action, not a value to compare
+            if register == self.group_loader_register or current.get(register) != value
         }
+        if len(changed) < len(register_commands):
+            logging.debug('Skipping {} register(s) already set: {}'.format(
+                len(register_commands) - len(changed), sorted(set(register_commands) - set(changed)),
+            ))
+        return changed
 
-        for name in self.register_properties:
-            setattr(self, name, self.register_properties[name]['from_int'](0))
+    def _plan_changed(self, register_commands):
+        """The commands still to write once registers known to be at their
+        value are dropped
 
-    def load(self, data, offset=0):
-        pos_map = {v['register']: k for k, v in self.register_properties.items()}
-        i = 0
-        for raw_val in data:
-            val_pos = offset + i
-            if val_pos in pos_map:
-                name = pos_map[val_pos]
-                translation = self.register_properties[name]['from_int']
-                val = translation(raw_val)
-                setattr(self, name, val)
-            i = i + 1
+        Only a cached setting still within its TTL is trusted; one cached
+        without a TTL may since have been changed on the front panel, and
+        writing it costs no more than reading it to compare.
+        """
+        now = self.clock()
+        current = {}
+        for register in register_commands:
+            if self.cache_classes.get(register) != CACHE_SETTING or register not in self.cache:
+                continue
+            value, expires = self.cache[register]
+            if (expires is not None) and (expires > now):
+                current[register] = value
+        return self._changed(register_commands, current)
+
+    def _plan_read_back(self, read_ranges, now):
+        """Split ranges to read back after a write into cached registers
+        and the reads to make; the first read is combined with the last write"""
+        registers, wanted_ranges = self._cache_lookup(read_ranges, now)
+        return registers, rdserial.modbus.plan_reads(wanted_ranges, max_length=MAX_REGISTERS, max_gap=MAX_READ_GAP)
+
+    def write_registers(self, register_commands, read_ranges=None):
+        """Write a register:value dict, merged into as few writes as possible
+
+        If read_ranges are given, they are read back once written, and a
+        register:value dict of them returned.  The last write and the
+        first read are one read/write multiple registers transaction, so
+        a setpoint change and the measurements following it take a
+        single round trip.
+        """
+        writes = self._plan_writes(register_commands)
+        if read_ranges is None:
+            for register_base, values in writes:
+                self.modbus_client.write_registers(register_base, values, unit=self.unit)
+            self._written(register_commands)
+            return None
+        if not writes:
+            return self.read_registers(read_ranges)
+
+        for register_base, values in writes[:-1]:
+            self.modbus_client.write_registers(register_base, values, unit=self.unit)
+        # The written registers must not come from the cache
+        self._written(register_commands)
+        now = self.clock()
+        registers, reads = self._plan_read_back(read_ranges, now)
+        register_base, values = writes[-1]
+        if not reads:
+            self.modbus_client.write_registers(register_base, values, unit=self.unit)
+            return registers
+        (read_base, read_length), reads = reads[0], reads[1:]
+        fresh = dict(zip(range(read_base, read_base + read_length), self.modbus_client.read_write_registers(
+            read_base, read_length, register_base, values, unit=self.unit,
+        )))
+        fresh.update(self.modbus_client.read_register_map(reads, unit=self.unit, max_length=MAX_REGISTERS))
+        self._cache_store(fresh, now)
+        registers.update(fresh)
+        return registers
+
+    def write_changed(self, register_commands, read_ranges=None):
+        """write_registers(), skipping registers already at their value
+
+        Registers not known to be at their value from the cache are
+        written straight away, the read back sharing the last write's
+        round trip.  If nothing needs writing, read_ranges are read
+        instead.
+        """
+        changed = self._plan_changed(register_commands)
+        if changed:
+            return self.write_registers(changed, read_ranges=read_ranges)
+        if read_ranges is None:
+            return None
+        return self.read_registers(read_ranges)
@@ -0,0 +1,114 @@
+# rdserialtool
+# Copyright (C) 2019 Ryan Finnie
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import asyncio
+import datetime
+import logging
+
+import rdserial.dps
+import rdserial.modbus.aio
+import rdserial.scheduler
+
+
+async def probe(socket, timeout, unit=1, baudrate=9600):
+    """Read the model register, returning whether the unit answers within timeout"""
+    modbus_client = rdserial.modbus.aio.RTUClient(socket, baudrate=baudrate)
+    modbus_client.timeout = timeout
+    try:
+        await modbus_client.read_registers(
+            rdserial.dps.DeviceState.register_properties['model']['register'], 1, unit=unit,
+        )
+    except rdserial.modbus.ExceptionResponse:
+        pass
+    except rdserial.modbus.ModbusError:
+        return False
+    return True
+
+
+class Client(rdserial.dps.Client):
+    """rdserial.dps.Client over an rdserial.modbus.aio.RTUClient"""
+    async def read_registers(self, ranges):
+        now = self.clock()
+        registers, wanted_ranges = self._cache_lookup(ranges, now)
+        if not wanted_ranges:
+            return registers
+        fresh = await self.modbus_client.read_register_map(
+            wanted_ranges, unit=self.unit, max_length=rdserial.dps.MAX_REGISTERS, max_gap=rdserial.dps.MAX_READ_GAP,
+        )
+        self._cache_store(fresh, now)
+        registers.update(fresh)
+        return registers
+
+    async def write_registers(self, register_commands, read_ranges=None):
+        writes = self._plan_writes(register_commands)
+        if read_ranges is None:
+            for register_base, values in writes:
+                await self.modbus_client.write_registers(register_base, values, unit=self.unit)
+            self._written(register_commands)
+            return None
+        if not writes:
+            return await self.read_registers(read_ranges)
+
+        for register_base, values in writes[:-1]:
+            await self.modbus_client.write_registers(register_base, values, unit=self.unit)
+        self._written(register_commands)
+        now = self.clock()
+        registers, reads = self._plan_read_back(read_ranges, now)
+        register_base, values = writes[-1]
+        if not reads:
+            await self.modbus_client.write_registers(register_base, values, unit=self.unit)
+            return registers
+        (read_base, read_length), reads = reads[0], reads[1:]
+        fresh = dict(zip(range(read_base, read_base + read_length), await self.modbus_client.read_write_registers(
+            read_base, read_length, register_base, values, unit=self.unit,
+        )))
+        fresh.update(await self.modbus_client.read_register_map(reads, unit=self.unit, max_length=rdserial.dps.MAX_REGISTERS))
+        self._cache_store(fresh, now)
+        registers.update(fresh)
+        return registers
+
+    async def write_changed(self, register_commands, read_ranges=None):
+        changed = self._plan_changed(register_commands)
+        if changed:
+            return await self.write_registers(changed, read_ranges=read_ranges)
+        if read_ranges is None:
+            return None
+        return await self.read_registers(read_ranges)
+
+class Poller:
+    """Poll a DPS series power supply through an rdserial.dps.aio.Client"""
+    def __init__(self, client, groups=()):
+        self.client = client
+        self.groups = groups
+
+    async def poll(self):
+        collection_time = datetime.datetime.now()
+        registers = await self.client.read_registers(rdserial.dps.register_ranges(self.groups))
+        return rdserial.dps.device_state_from_registers(registers, self.groups, collection_time=collection_time)
+
+    async def watch(self, interval, callback, policy=rdserial.scheduler.POLICY_SKIP):
+        """Poll every interval seconds until cancelled, passing each DeviceState to callback"""
+        scheduler = rdserial.scheduler.Scheduler(interval, policy=policy, clock=asyncio.get_event_loop().time)
+        while True:
+            try:
+                callback(await self.poll())
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception('{}: An exception has occurred'.format(self.client.modbus_client.socket))
+            await asyncio.sleep(scheduler.advance())
@@ -20,17 +20,30 @@ import logging
 import json
 import datetime
 import time
-import statistics
 import argparse
 
 import rdserial.dps
+import rdserial.capture
+import rdserial.daemon
+import rdserial.device
+import rdserial.metrics
 import rdserial.modbus
+import rdserial.modbus.bus
+import rdserial.scheduler
+import rdserial.stats
+import rdserial.trend
 
 
 def add_subparsers(subparsers):
     def loose_bool(val):
         return val.lower() in ('on', 'true', 'yes')
 
+    def bus_unit(val):
+        try:
+            return rdserial.modbus.bus.parse_unit(val)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(e.args[0])
+
     parser = subparsers.add_parser(
         'dps',
         help='RDTech DPS series',
@@ -41,6 +54,19 @@ def add_subparsers(subparsers):
         '--modbus-unit', type=int, default=1,
         help='Modbus unit number',
     )
+    parser.add_argument(
+        '--bus-unit', type=bus_unit, action='append', metavar='UNIT[:WEIGHT[:TIMEOUT]]',
+        help='Poll this unit on a multi-drop (RS-485) bus, one unit per collection; '
+             'give once per unit, instead of --modbus-unit',
+    )
+    parser.add_argument(
+        '--bus-policy', choices=rdserial.modbus.bus.POLICIES, default=rdserial.modbus.bus.POLICY_ROUND_ROBIN,
+        help='Order to poll bus units in: in turn, or in proportion to their weights',
+    )
+    parser.add_argument(
+        '--settings-ttl', type=float, default=10.0,
+        help='Seconds to cache setting registers between writes in watch mode (0 to cache until written)',
+    )
     parser.add_argument(
         '--group', type=int, action='append',
         help='Display/set selected group(s)',
@@ -121,55 +147,74 @@ def add_subparsers(subparsers):
 
 
 class Tool:
+    # (argument, register property) of the commands
+    command_map = (
+        ('set_volts', 'setting_volts'),
+        ('set_amps', 'setting_amps'),
+        ('set_output_state', 'output_state'),
+        ('set_key_lock', 'key_lock'),
+        ('set_brightness', 'brightness'),
+        ('load_group', 'group_loader'),
+    )
+    group_command_map = (
+        ('set_group_volts', 'setting_volts'),
+        ('set_group_amps', 'setting_amps'),
+        ('set_group_cutoff_volts', 'cutoff_volts'),
+        ('set_group_cutoff_amps', 'cutoff_amps'),
+        ('set_group_cutoff_watts', 'cutoff_watts'),
+        ('set_group_brightness', 'brightness'),
+        ('set_group_maintain_output', 'maintain_output'),
+        ('set_group_poweron_output', 'poweron_output'),
+    )
+    # Arguments send_commands() acts on
+    command_options = tuple(x for x, _ in command_map + group_command_map) + ('group', 'all_groups')
+    # Arguments changing what collect() reads
+    read_options = ('group', 'all_groups')
+
     def __init__(self, parent=None, callback=None):
-        self.trends = {}
+        self.trends = None
+        self.scheduler = None
+        self.capture = None
+        self.metrics = None
+        self.stats = None
+        self.bus = None
+        # Unit the current sample is from, on a bus
+        self.unit = None
+        # Registers read back after sending commands, by unit, for the
+        # first collection
+        self.read_back = {}
+        self.reconnects = 0
+        self.reconnector = None
+        self.ready = None
         self.callback = callback
+        self.now = datetime.datetime.now
+        self.clock = time.monotonic
         if parent is not None:
             self.args = parent.args
             self.socket = parent.socket
+            # Waits for the device to be ready after reconnecting
+            self.ready = getattr(parent, 'ready', None)
+            # Replayed recordings supply their recorded clocks
+            self.now = getattr(self.socket, 'now', self.now)
+            self.clock = getattr(self.socket, 'clock', self.clock)
 
     def trend_s(self, name, value):
         if not self.args.watch:
             return ''
 
-        if name in self.trends:
-            trend = statistics.mean(self.trends[name])
-            self.trends[name] = self.trends[name][1:] + [value]
-            if value > trend:
-                return '\u2197'
-            elif value < trend:
-                return '\u2198'
-            else:
-                return ' '
-        else:
-            self.trends[name] = [value for x in range(self.args.trend_points)]
-            return ' '
+        if self.trends is None:
+            self.trends = rdserial.trend.Trends(self.args.trend_points)
+        return self.trends.direction(name, value)
 
-    def send_commands(self):
+    def send_commands(self, args=None):
+        """Send the commands given in args (by default, the command line's)"""
+        if args is None:
+            args = self.args
         register_commands = {}
 
         device_state = rdserial.dps.DeviceState()
-        command_map = (
-            ('set_volts', 'setting_volts'),
-            ('set_amps', 'setting_amps'),
-            ('set_output_state', 'output_state'),
-            ('set_key_lock', 'key_lock'),
-            ('set_brightness', 'brightness'),
-            ('load_group', 'group_loader'),
-        )
-        group_command_map = (
-            ('set_group_volts', 'setting_volts'),
-            ('set_group_amps', 'setting_amps'),
-            ('set_group_cutoff_volts', 'cutoff_volts'),
-            ('set_group_cutoff_amps', 'cutoff_amps'),
-            ('set_group_cutoff_watts', 'cutoff_watts'),
-            ('set_group_brightness', 'brightness'),
-            ('set_group_maintain_output', 'maintain_output'),
-            ('set_group_poweron_output', 'poweron_output'),
-        )
-
-        for arg_name, register_name in command_map:
-            arg_val = getattr(self.args, arg_name)
+        for arg_name, register_name in self.command_map:
+            arg_val = getattr(args, arg_name)
             if arg_val is None:
                 continue
             translation = device_state.register_properties[register_name]['to_int']
@@ -184,17 +229,11 @@ class Tool:
             ))
             register_commands[register_num] = register_val
 
-        if self.args.all_groups:
-            groups = range(10)
-        elif self.args.group is not None:
-            groups = self.args.group
-        else:
-            groups = []
-        for group in groups:
+        for group in self.selected_groups(args):
             device_group_state = rdserial.dps.GroupState(group)
 
-            for arg_name, register_name in group_command_map:
-                arg_val = getattr(self.args, arg_name)
+            for arg_name, register_name in self.group_command_map:
+                arg_val = getattr(args, arg_name)
                 if arg_val is None:
                     continue
                 translation = device_group_state.register_properties[register_name]['to_int']
@@ -209,29 +248,26 @@ class Tool:
                 ))
                 register_commands[register_num] = register_val
 
-        if len(register_commands) > 0:
-            logging.info('')
-
-        # Optimize into a set of minimal register writes
-        register_commands_opt = {}
-        for register in sorted(register_commands.keys()):
-            found_opt = False
-            for g in register_commands_opt:
-                if (register == g + len(register_commands_opt[g])) and (len(register_commands_opt[g]) < 32):
-                    register_commands_opt[g].append(register_commands[register])
-                    found_opt = True
-                    break
-            if not found_opt:
-                register_commands_opt[register] = [register_commands[register]]
-        for register_base in register_commands_opt:
-            logging.debug('Writing {} register(s) ({}) at base {}'.format(
-                len(register_commands_opt[register_base]),
-                register_commands_opt[register_base],
-                register_base,
-            ))
-            self.modbus_client.write_registers(
-                register_base, register_commands_opt[register_base], unit=self.args.modbus_unit,
-            )
+        if len(register_commands) == 0:
+            return
+        logging.info('')
+
+        # Only registers not already at their value are written.  The
+        # device state is read back in the same round trip as the (last)
+        # write, or by the read done to compare, and is the first
+        # collection shown.
+        read_ranges = rdserial.dps.register_ranges(self.selected_groups(args))
+        if self.bus is None:
+            self.read_back[self.client.unit] = self.client.write_changed(register_commands, read_ranges=read_ranges)
+            return
+        # One unit failing shouldn't keep the others from being set
+        for unit in self.bus.units:
+            try:
+                self.read_back[unit.unit] = self.bus.run(
+                    unit, lambda: unit.client.write_changed(register_commands, read_ranges=read_ranges),
+                )
+            except Exception as e:
+                logging.error('Setting unit {} failed: {!r}'.format(unit.unit, e))
 
     def print_human(self, device_state):
         protection_map = {
@@ -240,6 +276,8 @@ class Tool:
             rdserial.dps.PROTECTION_OC: 'over-current',
             rdserial.dps.PROTECTION_OP: 'over-power',
         }
+        if self.unit is not None:
+            print('Unit: {}'.format(self.unit))
         print('Setting: {:5.02f}V, {:6.03f}A ({})'.format(
             device_state.setting_volts,
             device_state.setting_amps,
@@ -279,71 +317,205 @@ class Tool:
             print('    Maintain output state: {}'.format(device_group_state.maintain_output))
             print('    Output on power-on: {}'.format(device_group_state.poweron_output))
 
-    def get_json(self, device_state):
+    def get_dict(self, device_state):
         out = {x: getattr(device_state, x) for x in device_state.register_properties}
         out['collection_time'] = (device_state.collection_time - datetime.datetime.fromtimestamp(0)).total_seconds()
         out['groups'] = {}
         for group, device_group_state in device_state.groups.items():
             out['groups'][group] = {x: getattr(device_group_state, x) for x in device_group_state.register_properties}
-        print(json.dumps(out, sort_keys=True))
+        return out
+
+    def get_json(self, device_state):
+        out = self.get_dict(device_state)
+        if self.unit is not None:
+            out['unit'] = self.unit
+        return json.dumps(out, sort_keys=True)
 
     def print_json(self, device_state):
         print(self.get_json(device_state))
 
-    def assemble_device_state(self):
-        device_state = rdserial.dps.DeviceState()
-        registers = self.modbus_client.read_registers(
-            0x00, 13, unit=self.args.modbus_unit,
-        )
-        device_state.load(registers)
-
-        if self.args.all_groups:
-            groups = range(10)
-        elif self.args.group is not None:
-            groups = self.args.group
+    def selected_groups(self, args=None):
+        if args is None:
+            args = self.args
+        if args.all_groups:
+            return range(10)
+        elif args.group is not None:
+            return args.group
         else:
-            groups = []
-        for group in groups:
-            device_group_state = rdserial.dps.GroupState(group)
-            registers = self.modbus_client.read_registers(
-                0x50 + (0x10 * group), 8, unit=self.args.modbus_unit
-            )
-            device_group_state.load(registers, offset=(0x50 + (0x10 * group)))
-            device_state.groups[group] = device_group_state
+            return []
 
+    def assemble_device_state(self, client=None, groups=None):
+        if client is None:
+            client = self.client
+        if groups is None:
+            groups = self.selected_groups()
+        registers = self.read_back.pop(client.unit, None)
+        if registers is None:
+            registers = client.read_registers(rdserial.dps.register_ranges(groups))
+        decode_start = time.perf_counter()
+        device_state = rdserial.dps.device_state_from_registers(registers, groups, collection_time=self.now())
+        if self.stats is not None:
+            self.stats.record('decode', time.perf_counter() - decode_start)
+        # The capture's groups are fixed when it is opened
+        if self.capture is not None and list(groups) == list(self.selected_groups()):
+            self.capture.write_registers(
+                registers, monotonic=self.clock(), wall=device_state.collection_time.timestamp(),
+            )
+        if self.reconnector is not None:
+            self.reconnector.success()
         return device_state
 
     def loop(self):
+        self.scheduler = rdserial.scheduler.Scheduler(self.args.watch_seconds, policy=self.args.watch_policy)
         while True:
             try:
-                device_state = self.assemble_device_state()
-                if self.callback:
-                    self.callback(self.get_json(device_state))
-                if self.args.json:
-                    self.print_json(device_state)
+                if self.bus is None:
+                    self.output(self.assemble_device_state())
                 else:
-                    self.print_human(device_state)
+                    # Watch mode polls one unit per collection, so the
+                    # watch interval is per bus transaction; otherwise
+                    # every unit is polled once.
+                    for unit in ([self.bus.next_unit()] if self.args.watch else self.bus.units):
+                        self.unit = unit.unit
+                        try:
+                            device_state = self.bus.run(unit, lambda: self.assemble_device_state(unit.client))
+                        except (TimeoutError, rdserial.modbus.ModbusError) as e:
+                            # Counted against the unit; the rest of the bus carries on
+                            logging.warning('Unit {}: {!r}'.format(unit.unit, e))
+                            if all(x.consecutive_errors for x in self.bus.units):
+                                # Nothing on the bus is answering; the link may be down
+                                self.recover(e)
+                            continue
+                        self.output(device_state)
             except KeyboardInterrupt:
                 raise
-            except Exception:
+            except EOFError:
+                # End of a replayed recording
+                return
+            except Exception as e:
                 if self.args.watch:
                     logging.exception('An exception has occurred')
+                    self.recover(e)
                 else:
                     raise
             if self.args.watch:
                 if not self.args.json:
                     print()
-                time.sleep(self.args.watch_seconds)
+                if self.stats is not None and self.stats.due():
+                    logging.info('Stats: {}'.format(self.stats.line()))
+                self.scheduler.wait()
             else:
                 return
 
+    def output(self, device_state):
+        callback_start = time.perf_counter()
+        if self.callback:
+            self.callback(self.get_json(device_state))
+        if self.metrics is not None:
+            self.metrics.update(self.get_dict(device_state), labels=(None if self.unit is None else {'unit': self.unit}))
+        format_start = time.perf_counter()
+        if self.args.json:
+            self.print_json(device_state)
+        else:
+            self.print_human(device_state)
+        if self.stats is not None:
+            self.stats.record('callback', format_start - callback_start)
+            self.stats.record('format', time.perf_counter() - format_start)
+
+    def recover(self, error):
+        """Reconnect if error means the link has dropped"""
+        if self.reconnector is None or not self.reconnector.failure(error):
+            return
+        self.reconnects += 1
+        # The device may have been power cycled meanwhile
+        self.read_back.clear()
+        self.client.invalidate()
+        if self.bus is not None:
+            for unit in self.bus.units:
+                unit.client.invalidate()
+
+    def collect(self, args=None):
+        """Collect one sample, of args' groups if given, for rdserial.daemon"""
+        return self.assemble_device_state(groups=self.selected_groups(args))
+
+    def start_metrics(self):
+        self.metrics = rdserial.metrics.Metrics(labels={'device': self.args.command})
+        self.metrics.counter('transactions', 'Modbus transactions', lambda: self.modbus_client.transactions)
+        self.metrics.counter('crc_failures', 'Modbus responses failing their CRC check', lambda: self.modbus_client.crc_errors)
+        self.metrics.counter('reconnects', 'Reconnections to the device', lambda: self.reconnects)
+        self.metrics.counter(
+            'overruns', 'Watch mode collections which overran their interval',
+            lambda: self.scheduler.late if self.scheduler is not None else 0,
+        )
+        if self.bus is not None:
+            for attr, description in (
+                ('errors', 'Failed polls of a bus unit'),
+                ('timeouts', 'Polls of a bus unit which timed out'),
+            ):
+                for unit in self.bus.units:
+                    self.metrics.counter(
+                        'bus_unit_' + attr, description,
+                        lambda unit=unit, attr=attr: getattr(unit, attr), labels={'unit': unit.unit},
+                    )
+        metrics_server = rdserial.metrics.MetricsServer(
+            self.metrics, self.args.metrics_port, address=self.args.metrics_address,
+        )
+        metrics_server.start()
+        return metrics_server
+
     def main(self):
         self.modbus_client = rdserial.modbus.RTUClient(
             self.socket,
             baudrate=self.args.baud,
         )
+        settings_ttl = self.args.settings_ttl if self.args.settings_ttl > 0 else None
+        self.client = rdserial.dps.Client(
+            self.modbus_client,
+            unit=self.args.modbus_unit,
+            settings_ttl=settings_ttl,
+            clock=self.clock,
+        )
+        if self.args.bus_unit:
+            for unit in self.args.bus_unit:
+                unit.client = rdserial.dps.Client(
+                    self.modbus_client, unit=unit.unit, settings_ttl=settings_ttl, clock=self.clock,
+                )
+            self.bus = rdserial.modbus.bus.Bus(self.modbus_client, self.args.bus_unit, policy=self.args.bus_policy)
+            logging.info('Bus of {} unit(s), polled {}'.format(len(self.bus.units), self.bus.policy))
+        if self.args.stats:
+            self.stats = rdserial.stats.Stats(interval=(self.args.stats_interval if self.args.watch else None))
+            self.modbus_client.stats = self.stats
+        if self.args.daemon and self.bus is not None:
+            logging.warning('The daemon serves --modbus-unit {} only, not the bus'.format(self.args.modbus_unit))
+        if self.args.capture and self.bus is not None:
+            logging.warning('Captures hold a single unit; not capturing a bus')
+        elif self.args.capture:
+            self.capture = rdserial.capture.CaptureWriter(self.args.capture, 'DPS', groups=self.selected_groups())
+        metrics_server = None
+        if self.args.metrics_port is not None:
+            metrics_server = self.start_metrics()
+        if (self.args.watch or self.args.daemon) and not self.args.replay and self.args.reconnect_max_delay > 0:
+            self.reconnector = rdserial.device.Reconnector(
+                self.socket, ready=self.ready, max_delay=self.args.reconnect_max_delay,
+            )
         try:
             self.send_commands()
-            self.loop()
+            if self.args.daemon:
+                rdserial.daemon.Daemon(self, self.args.daemon, max_age=self.args.daemon_max_age).serve()
+            else:
+                self.loop()
         except KeyboardInterrupt:
             pass
+        finally:
+            if self.capture is not None:
+                self.capture.close()
+            if metrics_server is not None:
+                metrics_server.stop()
+        if self.args.watch and self.scheduler is not None:
+            logging.info('Schedule: {}'.format(self.scheduler))
+        if self.bus is not None:
+            for unit in self.bus.units:
+                logging.info('Bus {}'.format(unit))
+        if self.stats is not None:
+            for line in self.stats.summary():
+                logging.info(line)
@@ -0,0 +1,425 @@
+# rdserialtool
+# Copyright (C) 2019 Ryan Finnie
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# UM and DPS device emulators, served on a pseudo-terminal so the real
+# rdserial.device.Serial transport can be pointed at them:
+#
+#   $ python3 -m rdserial.emulator um25c --baud 9600 --loss 0.001
+#   /dev/pts/5
+#   $ rdserialtool --serial-device=/dev/pts/5 um25c --watch
+#
+# The emulators themselves are plain protocol handlers (feed() request
+# bytes, get response frames back), usable without a pty; Loopback wraps
+# one as an in-memory transport.
+
+import argparse
+import logging
+import os
+import random
+import select
+import struct
+import sys
+import time
+
+import rdserial.um
+import rdserial.dps
+import rdserial.modbus
+
+
+class UMEmulator:
+    """UM series meter: answers 0xf0 with a 130 byte frame, obeys commands"""
+    def __init__(self, device_type='UM24C', volts=5.1, amps=0.5):
+        self.device_type = device_type
+        self.volts = volts
+        self.amps = amps
+        self.state = rdserial.um.Response(device_type=device_type)
+        self.state.start = rdserial.um.START_MARKERS[device_type]
+        self.state.end = rdserial.um.END_MARKER
+        self.state.temp_c = 25
+        self.state.temp_f = 77
+        self.state.screen_brightness = 4
+        self.state.screen_timeout = 2
+        self.state.record_threshold = 0.13
+        self._last_update = time.monotonic()
+
+    def update(self):
+        now = time.monotonic()
+        hours = (now - self._last_update) / 3600
+        self._last_update = now
+        state = self.state
+        state.volts = round(self.volts + random.gauss(0, 0.005), 3)
+        state.amps = max(round(self.amps + random.gauss(0, 0.005), 4), 0)
+        state.watts = round(state.volts * state.amps, 3)
+        state.resistance = round(state.volts / state.amps, 1) if state.amps else 9999.9
+        data_group = state.data_groups[state.data_group_selected]
+        data_group.amp_hours += state.amps * hours
+        data_group.watt_hours += state.watts * hours
+        if state.amps >= state.record_threshold:
+            state.recording = True
+            state.record_amphours += state.amps * hours
+            state.record_watthours += state.watts * hours
+        else:
+            state.recording = False
+
+    def feed(self, data):
+        """Process request bytes, returning a list of response frames"""
+        responses = []
+        state = self.state
+        for c in data:
+            if c == 0xf0:
+                self.update()
+                responses.append(state.dump())
+            elif c == 0xf1:
+                state.screen_selected = (state.screen_selected + 1) % 6
+            elif c == 0xf3:
+                if self.device_type == 'UM24C':
+                    state.data_group_selected = (state.data_group_selected + 1) % 10
+                else:
+                    state.screen_selected = (state.screen_selected - 1) % 6
+            elif c == 0xf4:
+                data_group = state.data_groups[state.data_group_selected]
+                data_group.amp_hours = 0
+                data_group.watt_hours = 0
+            elif 0xa0 <= c <= 0xa9:
+                state.data_group_selected = c - 0xa0
+            elif 0xb0 <= c <= 0xce:
+                state.record_threshold = (c - 0xb0) / 100
+            elif 0xd0 <= c <= 0xd5:
+                state.screen_brightness = c - 0xd0
+            elif 0xe0 <= c <= 0xe9:
+                state.screen_timeout = c - 0xe0
+        return responses
+
+
+class DPSEmulator:
+    """DPS series power supply: Modbus RTU functions 0x03, 0x06, 0x10 and
+    (unless read_write is False, as on firmware without it) 0x17"""
+    def __init__(self, unit=1, model=5005, firmware=14, load_ohms=10.0, input_volts=20.0, read_write=True):
+        self.unit = unit
+        self.read_write = read_write
+        self.load_ohms = load_ohms
+        self.registers = [0] * 0x100
+        self.registers[0x00] = 500
+        self.registers[0x01] = 1000
+        self.registers[0x05] = int(input_volts * 100)
+        self.registers[0x0a] = 4
+        self.registers[0x0b] = model
+        self.registers[0x0c] = firmware
+        for group in range(10):
+            base = rdserial.dps.GROUP_BASE + (rdserial.dps.GROUP_STRIDE * group)
+            self.registers[base:base+8] = [500, 1000, 5200, 5100, 1000, 4, 0, 0]
+        self._buffer = b''
+
+    def update(self):
+        registers = self.registers
+        if registers[0x09]:
+            volts = registers[0x00] / 100
+            amps = volts / self.load_ohms
+            limit = registers[0x01] / 1000
+            registers[0x08] = int(amps > limit)
+            if amps > limit:
+                amps = limit
+                volts = amps * self.load_ohms
+        else:
+            volts = amps = 0
+            registers[0x08] = 0
+        registers[0x02] = int(volts * 100)
+        registers[0x03] = int(amps * 100)
+        registers[0x04] = int(volts * amps * 100)
+
+    def write(self, register, value):
+        self.registers[register] = value
+        if register == 0x23:
+            # Group loader: copy group value's settings into the current ones
+            base = rdserial.dps.GROUP_BASE + (rdserial.dps.GROUP_STRIDE * value)
+            self.registers[0x00] = self.registers[base]
+            self.registers[0x01] = self.registers[base+1]
+
+    def _response(self, body):
+        return body + struct.pack('<H', rdserial.modbus.modbus_crc(body))
+
+    def _exception(self, function, code):
+        return self._response(struct.pack('>BBB', self.unit, function | 0x80, code))
+
+    def _frame_length(self, buf):
+        function = buf[1]
+        if function in (0x03, 0x06):
+            return 8
+        elif function == 0x10:
+            return (9 + buf[6]) if len(buf) > 6 else None
+        elif function == 0x17:
+            return (13 + buf[10]) if len(buf) > 10 else None
+        return 4
+
+    def feed(self, data):
+        """Process request bytes, returning a list of response frames"""
+        responses = []
+        self._buffer += data
+        while len(self._buffer) >= 2:
+            length = self._frame_length(self._buffer)
+            if (length is None) or (len(self._buffer) < length):
+                break
+            frame, self._buffer = self._buffer[:length], self._buffer[length:]
+            if struct.unpack('<H', frame[-2:])[0] != rdserial.modbus.modbus_crc(frame[:-2]):
+                # Real devices ignore corrupt frames; so do we, and resync
+                logging.debug('Emulator: dropping bad frame {}'.format(frame))
+                self._buffer = b''
+                break
+            if frame[0] != self.unit:
+                continue
+            response = self.handle(frame)
+            if response:
+                responses.append(response)
+        return responses
+
+    def handle(self, frame):
+        function = frame[1]
+        if function == 0x03:
+            base, length = struct.unpack('>HH', frame[2:6])
+            if base + length > len(self.registers):
+                return self._exception(function, 0x02)
+            self.update()
+            return self._response(
+                struct.pack('>BBB', self.unit, function, length * 2) +
+                struct.pack('>{}H'.format(length), *self.registers[base:base+length])
+            )
+        elif function == 0x06:
+            register, value = struct.unpack('>HH', frame[2:6])
+            if register >= len(self.registers):
+                return self._exception(function, 0x02)
+            self.write(register, value)
+            return frame
+        elif function == 0x10:
+            register, length = struct.unpack('>HH', frame[2:6])
+            if register + length > len(self.registers):
+                return self._exception(function, 0x02)
+            for i, value in enumerate(struct.unpack('>{}H'.format(length), frame[7:7+(length*2)])):
+                self.write(register + i, value)
+            return self._response(frame[:6])
+        elif function == 0x17 and self.read_write:
+            base, length, register, write_length = struct.unpack('>HHHH', frame[2:10])
+            if (base + length > len(self.registers)) or (register + write_length > len(self.registers)):
+                return self._exception(function, 0x02)
+            # Writes happen before the read
+            for i, value in enumerate(struct.unpack('>{}H'.format(write_length), frame[11:11+(write_length*2)])):
+                self.write(register + i, value)
+            self.update()
+            return self._response(
+                struct.pack('>BBB', self.unit, function, length * 2) +
+                struct.pack('>{}H'.format(length), *self.registers[base:base+length])
+            )
+        return self._exception(function, 0x01)
+
+
+class MultiDrop:
+    """Several emulators sharing one RS-485 bus
+
+    Every request reaches every emulator; only the addressed unit
+    answers.
+    """
+    def __init__(self, emulators):
+        self.emulators = emulators
+
+    def feed(self, data):
+        responses = []
+        for emulator in self.emulators:
+            responses += emulator.feed(data)
+        return responses
+
+
+class Link:
+    """Characteristics of the emulated link, applied to each response"""
+    def __init__(self, baudrate=9600, latency=0.0, jitter=0.0, loss=0.0, corrupt=0.0):
+        self.baudrate = baudrate
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.corrupt = corrupt
+
+    def delay(self, size):
+        """Seconds to transmit size bytes (8N1 plus start bit), latency and jitter"""
+        delay = self.latency + (size * 10 / self.baudrate if self.baudrate else 0)
+        if self.jitter:
+            delay += random.uniform(0, self.jitter)
+        return delay
+
+    def mangle(self, frame):
+        if self.corrupt and (random.random() < self.corrupt):
+            frame = bytearray(frame)
+            frame[random.randrange(len(frame))] ^= 1 << random.randrange(8)
+        if self.loss:
+            frame = bytes(b for b in frame if random.random() >= self.loss)
+        return bytes(frame)
+
+
+class Loopback:
+    """In-memory transport wired straight to an emulator, for benchmarks
+
+    Has the rdserial.device transport interface.  Responses are
+    available immediately; the link's loss and corruption apply, but not
+    its delays.
+    """
+    def __init__(self, emulator, link=None):
+        self.emulator = emulator
+        self.link = link
+        self._pending = bytearray()
+
+    def connect(self):
+        return True
+
+    def close(self):
+        pass
+
+    def send(self, request):
+        for frame in self.emulator.feed(bytes(request)):
+            if self.link is not None:
+                frame = self.link.mangle(frame)
+            self._pending += frame
+        return len(request)
+
+    def recv_into(self, buffer, size=None, timeout=None):
+        if size is None:
+            size = len(buffer)
+        if len(self._pending) < size:
+            raise TimeoutError('Loopback: RECV timed out ({} of {} bytes)'.format(len(self._pending), size))
+        buffer[:size] = self._pending[:size]
+        del self._pending[:size]
+        return size
+
+    def recv(self, size, timeout=None):
+        result = bytearray(size)
+        self.recv_into(result, size, timeout=timeout)
+        return bytes(result)
+
+    def discard_input(self):
+        del self._pending[:]
+
+    def __str__(self):
+        return 'loopback'
+
+
+class PtyServer:
+    def __init__(self, emulator, link=None):
+        import pty
+        import tty
+
+        self.emulator = emulator
+        self.link = link if link is not None else Link()
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        # The slave stays open here too, so the pty survives clients
+        # closing and reopening it.
+        self.name = os.ttyname(self.slave)
+        self.frames = 0
+
+    def serve_forever(self):
+        while True:
+            select.select([self.master], [], [])
+            data = os.read(self.master, 1024)
+            for frame in self.emulator.feed(data):
+                time.sleep(self.link.delay(len(frame)))
+                os.write(self.master, self.link.mangle(frame))
+                self.frames += 1
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+
+def parse_args(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    parser = argparse.ArgumentParser(
+        description='RDTech UM/DPS device emulator',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        prog=os.path.basename(argv[0]),
+    )
+    parser.add_argument(
+        'device', choices=('um24c', 'um25c', 'um34c', 'dps'),
+        help='Device type to emulate',
+    )
+    parser.add_argument(
+        '--baud', type=float, default=9600,
+        help='Baud rate to emulate the transmission time of (0 for none)',
+    )
+    parser.add_argument(
+        '--latency', type=float, default=0.0,
+        help='Seconds of fixed turnaround latency per response',
+    )
+    parser.add_argument(
+        '--jitter', type=float, default=0.0,
+        help='Maximum seconds of random extra latency per response',
+    )
+    parser.add_argument(
+        '--loss', type=float, default=0.0,
+        help='Probability of each response byte being lost',
+    )
+    parser.add_argument(
+        '--corrupt', type=float, default=0.0,
+        help='Probability of each response having a corrupted byte',
+    )
+    parser.add_argument(
+        '--modbus-unit', type=int, action='append',
+        help='Modbus unit number (DPS); give more than once for a multi-drop bus of units',
+    )
+    parser.add_argument(
+        '--no-read-write', dest='read_write', action='store_false',
+        help='Reject read/write multiple registers (0x17), like older firmware (DPS)',
+    )
+    parser.add_argument(
+        '--symlink',
+        help='Also make the pty available at this path',
+    )
+    parser.add_argument(
+        '--debug', action='store_true',
+        help='Print extra debugging information.',
+    )
+    return parser.parse_args(args=argv[1:])
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=(logging.DEBUG if args.debug else logging.INFO), format='%(message)s')
+
+    if args.device == 'dps':
+        units = args.modbus_unit or [1]
+        if len(units) == 1:
+            emulator = DPSEmulator(unit=units[0], read_write=args.read_write)
+        else:
+            emulator = MultiDrop([DPSEmulator(unit=unit, read_write=args.read_write) for unit in units])
+    else:
+        emulator = UMEmulator(device_type=args.device.upper())
+    link = Link(baudrate=args.baud, latency=args.latency, jitter=args.jitter, loss=args.loss, corrupt=args.corrupt)
+    server = PtyServer(emulator, link)
+    if args.symlink:
+        os.symlink(server.name, args.symlink)
+    print(server.name, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logging.info('{} response(s) sent'.format(server.frames))
+        server.close()
+        if args.symlink:
+            os.unlink(args.symlink)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
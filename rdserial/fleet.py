@@ -0,0 +1,179 @@
+# rdserialtool
+# Copyright (C) 2019 Ryan Finnie
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# Fleet mode polls many devices from one process, on one asyncio event
+# loop.  The fleet file is JSON, either a list of devices or an object
+# with a "devices" list, e.g.:
+#
+#   {"devices": [
+#     {"name": "port1", "type": "um25c", "serial_device": "/dev/rfcomm0"},
+#     {"name": "psu", "type": "dps", "bluetooth_address": "00:BA:68:00:47:3A",
+#      "modbus_unit": 1, "watch_seconds": 0.5, "groups": [0]}
+#   ]}
+#
+# Each device may also set "bluetooth_port", "baud", "timeout" and,
+# for DPS devices, "settings_ttl".  Unset values come from the common
+# command line options.  Output is one JSON object per line, tagged
+# with the device's "device" name and "type".
+
+import asyncio
+import json
+import logging
+
+import rdserial.device.aio
+import rdserial.modbus.aio
+import rdserial.um.aio
+import rdserial.um.tool
+import rdserial.dps.aio
+import rdserial.dps.tool
+
+UM_TYPES = ('um24c', 'um25c', 'um34c')
+DEVICE_TYPES = UM_TYPES + ('dps',)
+
+
+def load_config(filename):
+    with open(filename, 'r') as f:
+        config = json.load(f)
+    if isinstance(config, dict):
+        config = config.get('devices', [])
+    return config
+
+
+class Device:
+    def __init__(self, config, args):
+        self.type = config['type'].lower()
+        if self.type not in DEVICE_TYPES:
+            raise ValueError('Unknown device type', config['type'])
+
+        timeout = config.get('timeout', args.timeout)
+        if not timeout or timeout <= 0:
+            timeout = None
+        baudrate = config.get('baud', args.baud)
+        self.timeout = timeout
+        self.baudrate = baudrate
+        self.unit = config.get('modbus_unit', 1)
+        if config.get('serial_device'):
+            self.socket = rdserial.device.aio.Serial(
+                config['serial_device'],
+                baudrate=baudrate,
+                timeout=timeout,
+            )
+        elif config.get('bluetooth_address'):
+            self.socket = rdserial.device.aio.Bluetooth(
+                config['bluetooth_address'],
+                port=config.get('bluetooth_port', args.bluetooth_port),
+                timeout=timeout,
+            )
+        else:
+            raise ValueError('Device needs a serial_device or bluetooth_address', config)
+        self.name = config.get('name', str(self.socket))
+        self.watch_seconds = config.get('watch_seconds', args.watch_seconds)
+
+        if self.type in UM_TYPES:
+            self.poller = rdserial.um.aio.Poller(self.socket, device_type=self.type.upper())
+            self.formatter = rdserial.um.tool.Tool()
+        else:
+            settings_ttl = config.get('settings_ttl', 10.0)
+            client = rdserial.dps.aio.Client(
+                rdserial.modbus.aio.RTUClient(self.socket, baudrate=baudrate),
+                unit=self.unit,
+                settings_ttl=(settings_ttl if settings_ttl > 0 else None),
+            )
+            self.poller = rdserial.dps.aio.Poller(client, groups=config.get('groups', []))
+            self.formatter = rdserial.dps.tool.Tool()
+
+    async def probe(self, timeout):
+        """Readiness probe, for rdserial.device.aio.wait_ready()"""
+        if self.type in UM_TYPES:
+            return await rdserial.um.aio.probe(self.socket, timeout, device_type=self.type.upper())
+        return await rdserial.dps.aio.probe(self.socket, timeout, unit=self.unit, baudrate=self.baudrate)
+
+    def __str__(self):
+        return '{} ({} {})'.format(self.name, self.type.upper(), self.socket)
+
+
+class Fleet:
+    def __init__(self, devices, args, callback=None):
+        self.devices = devices
+        self.args = args
+        self.callback = callback
+
+    def emit(self, device, sample):
+        out = device.formatter.get_dict(sample)
+        out['device'] = device.name
+        out['type'] = device.type
+        line = json.dumps(out, sort_keys=True)
+        if self.callback:
+            self.callback(line)
+        print(line, flush=True)
+
+    async def run_device(self, device):
+        logging.info('Connecting to {}'.format(device))
+        await device.socket.connect()
+        await asyncio.sleep(self.args.connect_delay)
+        if self.args.probe_timeout > 0:
+            seconds, probes = await rdserial.device.aio.wait_ready(
+                device.socket, device.probe, timeout=device.timeout, probe_timeout=self.args.probe_timeout,
+            )
+            logging.info('{} ready after {:.3f}s ({} probe(s))'.format(device, seconds, probes))
+        logging.info('Connection established to {}'.format(device))
+        try:
+            if self.args.watch:
+                await device.poller.watch(
+                    device.watch_seconds,
+                    lambda sample: self.emit(device, sample),
+                    policy=self.args.watch_policy,
+                )
+            else:
+                self.emit(device, await device.poller.poll())
+        finally:
+            device.socket.close()
+
+    async def run(self):
+        results = await asyncio.gather(
+            *[self.run_device(device) for device in self.devices],
+            return_exceptions=True
+        )
+        ret = 0
+        for device, result in zip(self.devices, results):
+            if isinstance(result, Exception):
+                logging.error('{}: {!r}'.format(device, result))
+                ret = 1
+        return ret
+
+
+def main(args, callback=None):
+    devices = [Device(config, args) for config in load_config(args.fleet)]
+    logging.info('Fleet of {} device(s)'.format(len(devices)))
+    logging.info('')
+    fleet = Fleet(devices, args, callback=callback)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    task = loop.create_task(fleet.run())
+    try:
+        return loop.run_until_complete(task)
+    except KeyboardInterrupt:
+        task.cancel()
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+        return 0
+    finally:
+        loop.close()
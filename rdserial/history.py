@@ -0,0 +1,118 @@
+# rdserialtool
+# Copyright (C) 2019 Ryan Finnie
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# Sample history is stored as JSON Lines: one JSON object per line,
+# appended as it is collected.  The file is never re-read or rewritten
+# by the writer, so the cost of storing a sample does not grow with
+# the size of the capture.
+
+import json
+import os
+import time
+
+FSYNC_NEVER = 'never'
+FSYNC_FLUSH = 'flush'
+FSYNC_ALWAYS = 'always'
+FSYNC_POLICIES = (FSYNC_NEVER, FSYNC_FLUSH, FSYNC_ALWAYS)
+
+
+class HistoryWriter:
+    def __init__(self, filename, flush_samples=10, flush_seconds=5.0, fsync=FSYNC_FLUSH):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('Invalid fsync policy', fsync)
+        self.filename = filename
+        self.flush_samples = flush_samples
+        self.flush_seconds = flush_seconds
+        self.fsync = fsync
+        self.file = open(filename, 'a', encoding='utf-8')
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def write(self, sample):
+        """Append a sample, either a JSON string or a JSON-serializable object"""
+        if not isinstance(sample, str):
+            sample = json.dumps(sample, sort_keys=True)
+        self.file.write(sample)
+        self.file.write('\n')
+        self._pending += 1
+
+        if self.fsync == FSYNC_ALWAYS:
+            self.flush()
+        elif self._pending >= self.flush_samples:
+            self.flush()
+        elif time.monotonic() - self._last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        self.file.flush()
+        if self.fsync != FSYNC_NEVER:
+            os.fsync(self.file.fileno())
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.flush()
+        self.file.close()
+
+    def __call__(self, sample):
+        self.write(sample)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class HistoryReader:
+    """Incremental reader for JSON Lines history files
+
+    Each call to read() returns only the samples appended since the
+    previous call.  A trailing partial line (a sample still being
+    written) is left for the next call.  Legacy history files holding
+    a single JSON array are also accepted, and are read in one go.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.offset = 0
+
+    def read(self):
+        with open(self.filename, 'rb') as f:
+            if self.offset == 0:
+                head = f.read(64).lstrip()
+                if head.startswith(b'['):
+                    f.seek(0)
+                    samples = json.loads(f.read().decode('utf-8'))
+                    self.offset = f.tell()
+                    return samples
+            f.seek(self.offset)
+            data = f.read()
+
+        end = data.rfind(b'\n') + 1
+        self.offset += end
+        return [json.loads(line.decode('utf-8')) for line in data[:end].splitlines() if line.strip()]
+
+    def __iter__(self):
+        return iter(self.read())
+
+
+def read_history(filename):
+    """Read all samples from a history file"""
+    return HistoryReader(filename).read()
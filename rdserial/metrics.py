@@ -0,0 +1,151 @@
+# rdserialtool
+# Copyright (C) 2019 Ryan Finnie
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# Prometheus text format metrics, served over HTTP from a background
+# thread.  The latest sample's numeric fields are gauges; counters are
+# read through callables at scrape time, so the polling loop only pays
+# for keeping its own plain integer counts.  Each scrape is answered
+# from one rendered snapshot, however many clients there are, and never
+# touches the device.
+
+import http.server
+import logging
+import socketserver
+import threading
+
+PREFIX = 'rdserial_'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in sorted(labels.items())
+    ) + '}'
+
+
+def flatten(sample, labels=None, prefix=''):
+    """Yield (name, labels, value) for each numeric value of a get_dict() sample
+
+    Lists and dicts of samples (UM data groups, DPS groups) become a
+    "group" label.  Strings are skipped.
+    """
+    if labels is None:
+        labels = {}
+    for key, value in sorted(sample.items()):
+        if isinstance(value, bool):
+            yield (prefix + key, labels, int(value))
+        elif isinstance(value, (int, float)):
+            yield (prefix + key, labels, value)
+        elif isinstance(value, (list, dict)):
+            items = value.items() if isinstance(value, dict) else enumerate(value)
+            for group, group_sample in items:
+                if isinstance(group_sample, dict):
+                    yield from flatten(group_sample, dict(labels, group=group), prefix=prefix + key + '_')
+
+
+class Metrics:
+    def __init__(self, labels=None):
+        self.labels = labels or {}
+        self.lock = threading.Lock()
+        self.counters = []
+        self._samples = {}
+        self._rendered = None
+
+    def counter(self, name, description, func, labels=None):
+        """Register a counter, read by calling func at scrape time
+
+        A counter may be registered more than once with different
+        labels (e.g. one per bus unit).
+        """
+        self.counters.append((PREFIX + name + '_total', description, func, dict(self.labels, **(labels or {}))))
+
+    def update(self, sample, labels=None):
+        """Set the gauges from a get_dict() sample
+
+        Samples with different labels (e.g. one per bus unit) are kept
+        side by side; each replaces the last one with the same labels.
+        """
+        labels = dict(self.labels, **(labels or {}))
+        with self.lock:
+            self._samples[tuple(sorted(labels.items()))] = (sample, labels)
+            self._rendered = None
+
+    def render(self):
+        with self.lock:
+            if self._rendered is None:
+                lines = []
+                # Each metric's samples must be grouped under one TYPE line
+                gauges = {}
+                for key in sorted(self._samples):
+                    sample, sample_labels = self._samples[key]
+                    for name, labels, value in flatten(sample, sample_labels):
+                        gauges.setdefault(name, []).append((labels, value))
+                for name, values in gauges.items():
+                    lines.append('# TYPE {}{} gauge'.format(PREFIX, name))
+                    for labels, value in values:
+                        lines.append('{}{}{} {}'.format(PREFIX, name, format_labels(labels), value))
+                self._rendered = lines
+            lines = list(self._rendered)
+        seen = set()
+        for name, description, func, labels in self.counters:
+            if name not in seen:
+                lines.append('# HELP {} {}'.format(name, description))
+                lines.append('# TYPE {} counter'.format(name))
+                seen.add(name)
+            lines.append('{}{} {}'.format(name, format_labels(labels), func()))
+        return '\n'.join(lines) + '\n'
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('Metrics: {} {}'.format(self.address_string(), format % args))
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MetricsServer:
+    def __init__(self, metrics, port, address='127.0.0.1'):
+        self.server = _Server((address, port), _Handler)
+        self.server.metrics = metrics
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True)
+        self.thread.start()
+        logging.info('Serving metrics on http://{}:{}/metrics'.format(*self.server.server_address[:2]))
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
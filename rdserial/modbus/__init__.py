@@ -24,125 +24,346 @@ import struct
 import logging
 
 
-def modbus_crc(data):
-    lookup_table = (
-        0x0000, 0xc0c1, 0xc181, 0x0140, 0xc301, 0x03c0, 0x0280, 0xc241,
-        0xc601, 0x06c0, 0x0780, 0xc741, 0x0500, 0xc5c1, 0xc481, 0x0440,
-        0xcc01, 0x0cc0, 0x0d80, 0xcd41, 0x0f00, 0xcfc1, 0xce81, 0x0e40,
-        0x0a00, 0xcac1, 0xcb81, 0x0b40, 0xc901, 0x09c0, 0x0880, 0xc841,
-        0xd801, 0x18c0, 0x1980, 0xd941, 0x1b00, 0xdbc1, 0xda81, 0x1a40,
-        0x1e00, 0xdec1, 0xdf81, 0x1f40, 0xdd01, 0x1dc0, 0x1c80, 0xdc41,
-        0x1400, 0xd4c1, 0xd581, 0x1540, 0xd701, 0x17c0, 0x1680, 0xd641,
-        0xd201, 0x12c0, 0x1380, 0xd341, 0x1100, 0xd1c1, 0xd081, 0x1040,
-        0xf001, 0x30c0, 0x3180, 0xf141, 0x3300, 0xf3c1, 0xf281, 0x3240,
-        0x3600, 0xf6c1, 0xf781, 0x3740, 0xf501, 0x35c0, 0x3480, 0xf441,
-        0x3c00, 0xfcc1, 0xfd81, 0x3d40, 0xff01, 0x3fc0, 0x3e80, 0xfe41,
-        0xfa01, 0x3ac0, 0x3b80, 0xfb41, 0x3900, 0xf9c1, 0xf881, 0x3840,
-        0x2800, 0xe8c1, 0xe981, 0x2940, 0xeb01, 0x2bc0, 0x2a80, 0xea41,
-        0xee01, 0x2ec0, 0x2f80, 0xef41, 0x2d00, 0xedc1, 0xec81, 0x2c40,
-        0xe401, 0x24c0, 0x2580, 0xe541, 0x2700, 0xe7c1, 0xe681, 0x2640,
-        0x2200, 0xe2c1, 0xe381, 0x2340, 0xe101, 0x21c0, 0x2080, 0xe041,
-        0xa001, 0x60c0, 0x6180, 0xa141, 0x6300, 0xa3c1, 0xa281, 0x6240,
-        0x6600, 0xa6c1, 0xa781, 0x6740, 0xa501, 0x65c0, 0x6480, 0xa441,
-        0x6c00, 0xacc1, 0xad81, 0x6d40, 0xaf01, 0x6fc0, 0x6e80, 0xae41,
-        0xaa01, 0x6ac0, 0x6b80, 0xab41, 0x6900, 0xa9c1, 0xa881, 0x6840,
-        0x7800, 0xb8c1, 0xb981, 0x7940, 0xbb01, 0x7bc0, 0x7a80, 0xba41,
-        0xbe01, 0x7ec0, 0x7f80, 0xbf41, 0x7d00, 0xbdc1, 0xbc81, 0x7c40,
-        0xb401, 0x74c0, 0x7580, 0xb541, 0x7700, 0xb7c1, 0xb681, 0x7640,
-        0x7200, 0xb2c1, 0xb381, 0x7340, 0xb101, 0x71c0, 0x7080, 0xb041,
-        0x5000, 0x90c1, 0x9181, 0x5140, 0x9301, 0x53c0, 0x5280, 0x9241,
-        0x9601, 0x56c0, 0x5780, 0x9741, 0x5500, 0x95c1, 0x9481, 0x5440,
-        0x9c01, 0x5cc0, 0x5d80, 0x9d41, 0x5f00, 0x9fc1, 0x9e81, 0x5e40,
-        0x5a00, 0x9ac1, 0x9b81, 0x5b40, 0x9901, 0x59c0, 0x5880, 0x9841,
-        0x8801, 0x48c0, 0x4980, 0x8941, 0x4b00, 0x8bc1, 0x8a81, 0x4a40,
-        0x4e00, 0x8ec1, 0x8f81, 0x4f40, 0x8d01, 0x4dc0, 0x4c80, 0x8c41,
-        0x4400, 0x84c1, 0x8581, 0x4540, 0x8701, 0x47c0, 0x4680, 0x8641,
-        0x8201, 0x42c0, 0x4380, 0x8341, 0x4100, 0x81c1, 0x8081, 0x4040,
-    )
+CRC_TABLE = (
+    0x0000, 0xc0c1, 0xc181, 0x0140, 0xc301, 0x03c0, 0x0280, 0xc241,
+    0xc601, 0x06c0, 0x0780, 0xc741, 0x0500, 0xc5c1, 0xc481, 0x0440,
+    0xcc01, 0x0cc0, 0x0d80, 0xcd41, 0x0f00, 0xcfc1, 0xce81, 0x0e40,
+    0x0a00, 0xcac1, 0xcb81, 0x0b40, 0xc901, 0x09c0, 0x0880, 0xc841,
+    0xd801, 0x18c0, 0x1980, 0xd941, 0x1b00, 0xdbc1, 0xda81, 0x1a40,
+    0x1e00, 0xdec1, 0xdf81, 0x1f40, 0xdd01, 0x1dc0, 0x1c80, 0xdc41,
+    0x1400, 0xd4c1, 0xd581, 0x1540, 0xd701, 0x17c0, 0x1680, 0xd641,
+    0xd201, 0x12c0, 0x1380, 0xd341, 0x1100, 0xd1c1, 0xd081, 0x1040,
+    0xf001, 0x30c0, 0x3180, 0xf141, 0x3300, 0xf3c1, 0xf281, 0x3240,
+    0x3600, 0xf6c1, 0xf781, 0x3740, 0xf501, 0x35c0, 0x3480, 0xf441,
+    0x3c00, 0xfcc1, 0xfd81, 0x3d40, 0xff01, 0x3fc0, 0x3e80, 0xfe41,
+    0xfa01, 0x3ac0, 0x3b80, 0xfb41, 0x3900, 0xf9c1, 0xf881, 0x3840,
+    0x2800, 0xe8c1, 0xe981, 0x2940, 0xeb01, 0x2bc0, 0x2a80, 0xea41,
+    0xee01, 0x2ec0, 0x2f80, 0xef41, 0x2d00, 0xedc1, 0xec81, 0x2c40,
+    0xe401, 0x24c0, 0x2580, 0xe541, 0x2700, 0xe7c1, 0xe681, 0x2640,
+    0x2200, 0xe2c1, 0xe381, 0x2340, 0xe101, 0x21c0, 0x2080, 0xe041,
+    0xa001, 0x60c0, 0x6180, 0xa141, 0x6300, 0xa3c1, 0xa281, 0x6240,
+    0x6600, 0xa6c1, 0xa781, 0x6740, 0xa501, 0x65c0, 0x6480, 0xa441,
+    0x6c00, 0xacc1, 0xad81, 0x6d40, 0xaf01, 0x6fc0, 0x6e80, 0xae41,
+    0xaa01, 0x6ac0, 0x6b80, 0xab41, 0x6900, 0xa9c1, 0xa881, 0x6840,
+    0x7800, 0xb8c1, 0xb981, 0x7940, 0xbb01, 0x7bc0, 0x7a80, 0xba41,
+    0xbe01, 0x7ec0, 0x7f80, 0xbf41, 0x7d00, 0xbdc1, 0xbc81, 0x7c40,
+    0xb401, 0x74c0, 0x7580, 0xb541, 0x7700, 0xb7c1, 0xb681, 0x7640,
+    0x7200, 0xb2c1, 0xb381, 0x7340, 0xb101, 0x71c0, 0x7080, 0xb041,
+    0x5000, 0x90c1, 0x9181, 0x5140, 0x9301, 0x53c0, 0x5280, 0x9241,
+    0x9601, 0x56c0, 0x5780, 0x9741, 0x5500, 0x95c1, 0x9481, 0x5440,
+    0x9c01, 0x5cc0, 0x5d80, 0x9d41, 0x5f00, 0x9fc1, 0x9e81, 0x5e40,
+    0x5a00, 0x9ac1, 0x9b81, 0x5b40, 0x9901, 0x59c0, 0x5880, 0x9841,
+    0x8801, 0x48c0, 0x4980, 0x8941, 0x4b00, 0x8bc1, 0x8a81, 0x4a40,
+    0x4e00, 0x8ec1, 0x8f81, 0x4f40, 0x8d01, 0x4dc0, 0x4c80, 0x8c41,
+    0x4400, 0x84c1, 0x8581, 0x4540, 0x8701, 0x47c0, 0x4680, 0x8641,
+    0x8201, 0x42c0, 0x4380, 0x8341, 0x4100, 0x81c1, 0x8081, 0x4040,
+)
 
+
+def modbus_crc(data):
+    lookup_table = CRC_TABLE
     crc = 0xffff
     for b in data:
-        n = b ^ crc
-        crc >>= 8
-        crc ^= lookup_table[n % 256]
+        crc = (crc >> 8) ^ lookup_table[(b ^ crc) & 0xff]
     return crc
 
 
+class ModbusError(Exception):
+    pass
+
+
+class CRCError(ModbusError):
+    pass
+
+
+class ResponseError(ModbusError):
+    """Response does not match the request"""
+    pass
+
+
+class ExceptionResponse(ModbusError):
+    """Device answered with a Modbus exception code"""
+    def __init__(self, function, code):
+        super().__init__('Function 0x{:02x} returned exception code {}'.format(function, code))
+        self.function = function
+        self.code = code
+
+
+# Largest RTU frame is 256 bytes
+FRAME_SIZE = 256
+# Unit, function, exception code, CRC
+EXCEPTION_RESPONSE_LENGTH = 5
+# Most registers one read/write multiple registers (0x17) request can
+# read, and write
+MAX_READ_WRITE_READ = 125
+MAX_READ_WRITE_WRITE = 121
+# 0x17 timeouts in a row after which a unit is taken not to support it
+READ_WRITE_MAX_TIMEOUTS = 3
+
+_read_header = struct.Struct('>BBHH')
+_write_multiple_header = struct.Struct('>BBHHB')
+_read_write_header = struct.Struct('>BBHHHHB')
+_response_header = struct.Struct('>BB')
+_crc = struct.Struct('<H')
+_register_structs = {}
+
+
+def _registers_struct(length):
+    if length not in _register_structs:
+        _register_structs[length] = struct.Struct('>{}H'.format(length))
+    return _register_structs[length]
+
+
+def _append_crc(buf, size):
+    _crc.pack_into(buf, size, modbus_crc(memoryview(buf)[:size]))
+    return size + 2
+
+
+def encode_read_registers(buf, base, length, unit=1):
+    """Encode a read holding registers (0x03) request into buf, returning its size"""
+    _read_header.pack_into(buf, 0, unit, 0x03, base, length)
+    return _append_crc(buf, 6)
+
+
+def encode_write_register(buf, register, value, unit=1):
+    """Encode a write single register (0x06) request into buf, returning its size"""
+    _read_header.pack_into(buf, 0, unit, 0x06, register, value)
+    return _append_crc(buf, 6)
+
+
+def encode_write_registers(buf, register, values, unit=1):
+    """Encode a write multiple registers (0x10) request into buf, returning its size"""
+    _write_multiple_header.pack_into(buf, 0, unit, 0x10, register, len(values), len(values) * 2)
+    _registers_struct(len(values)).pack_into(buf, 7, *values)
+    return _append_crc(buf, 7 + (len(values) * 2))
+
+
+def encode_read_write_registers(buf, read_base, read_length, write_base, write_values, unit=1):
+    """Encode a read/write multiple registers (0x17) request into buf, returning its size"""
+    _read_write_header.pack_into(
+        buf, 0, unit, 0x17, read_base, read_length, write_base, len(write_values), len(write_values) * 2,
+    )
+    _registers_struct(len(write_values)).pack_into(buf, 11, *write_values)
+    return _append_crc(buf, 11 + (len(write_values) * 2))
+
+
+def check_crc(buf, size):
+    view = memoryview(buf)[:size]
+    if _crc.unpack_from(view, size - 2)[0] != modbus_crc(view[:-2]):
+        raise CRCError('CRC mismatch', bytes(view))
+
+
+def check_exception(buf, function):
+    """Raise ExceptionResponse if the (at least 5 byte) frame in buf is one"""
+    if buf[1] == (function | 0x80):
+        check_crc(buf, EXCEPTION_RESPONSE_LENGTH)
+        raise ExceptionResponse(function, buf[2])
+
+
+def check_response(buf, size, unit, function):
+    check_crc(buf, size)
+    response_unit, response_function = _response_header.unpack_from(buf, 0)
+    if response_unit != unit:
+        raise ResponseError('Unexpected unit {} (expected {})'.format(response_unit, unit))
+    if response_function != function:
+        raise ResponseError('Unexpected function 0x{:02x} (expected 0x{:02x})'.format(response_function, function))
+
+
+def decode_read_registers(buf, length):
+    """Decode the registers from a validated read holding registers response"""
+    if buf[2] != (length * 2):
+        raise ResponseError('Unexpected byte count {} (expected {})'.format(buf[2], length * 2))
+    return list(_registers_struct(length).unpack_from(buf, 3))
+
+
+def check_write_registers(buf, register, length):
+    """Check a validated write multiple registers response echoes the request"""
+    response_register, response_length = struct.unpack_from('>HH', buf, 2)
+    if (response_register, response_length) != (register, length):
+        raise ResponseError('Unexpected write of {} register(s) at {} (expected {} at {})'.format(
+            response_length, response_register, length, register,
+        ))
+
+
+def silent_interval(baudrate):
+    """Inter-frame silent period, in seconds"""
+    if baudrate > 19200:
+        return 1.75/1000
+    else:
+        return 3.5 * (1 + 8 + 2) / baudrate
+
+
+def plan_reads(ranges, max_length=125, max_gap=0):
+    """Coalesce (base, length) register ranges into as few reads as possible
+
+    Neighbouring ranges are merged into one read when the registers
+    between them number no more than max_gap (reading a few unwanted
+    registers is cheaper than another round trip), as long as the
+    merged read stays within max_length registers.
+    """
+    spans = []
+    for base, length in ranges:
+        end = base + length
+        while base < end:
+            spans.append((base, min(end, base + max_length)))
+            base += max_length
+    spans.sort()
+
+    plan = []
+    for start, end in spans:
+        if plan:
+            plan_start, plan_end = plan[-1]
+            if (start - plan_end <= max_gap) and (max(end, plan_end) - plan_start <= max_length):
+                plan[-1] = (plan_start, max(end, plan_end))
+                continue
+        plan.append((start, end))
+    return [(start, end - start) for start, end in plan]
+
+
 class RTUClient:
     def __init__(self, socket, baudrate):
         self.socket = socket
         self._last_frame_end = time.time()
-        if baudrate > 19200:
-            self._silent_interval = 1.75/1000
-        else:
-            self._silent_interval = 3.5 * (1 + 8 + 2) / baudrate
+        self._silent_interval = silent_interval(baudrate)
+        # Requests are encoded into, and responses received into, these
+        # buffers, which are reused for every transaction.
+        self._request = bytearray(FRAME_SIZE)
+        self._response = bytearray(FRAME_SIZE)
+        self._request_view = memoryview(self._request)
+        self._response_view = memoryview(self._response)
+        # Running totals, for metrics
+        self.transactions = 0
+        self.crc_errors = 0
+        # Phase timings are recorded here if set (rdserial.stats.Stats)
+        self.stats = None
+        # Response timeout in seconds, or None for the transport's own
+        self.timeout = None
+        # Units which have rejected read/write multiple registers (0x17),
+        # and units' count of 0x17 timeouts in a row
+        self.read_write_unsupported = set()
+        self._read_write_timeouts = {}
 
     def read_registers(self, base, length, unit=1):
-        request = struct.pack('>B', unit) + \
-            struct.pack('>B', 0x03) + \
-            struct.pack('>H', base) + \
-            struct.pack('>H', length)
-        request += struct.pack('<H', modbus_crc(request))
-        self.send(request)
-
-        expected_response_length = 5 + (2 * length)
-        response = self.recv(expected_response_length)
-
-        assert(struct.unpack('<H', response[-2:])[0] == modbus_crc(response[0:-2]))
-        assert(struct.unpack('>B', response[0:1])[0] == unit)
-        assert(struct.unpack('>B', response[1:2])[0] == 0x03)
-        assert(struct.unpack('>B', response[2:3])[0] == (length * 2))
-
-        registers = []
-        for i in range(length):
-            pos = 3 + (i * 2)
-            registers.append(struct.unpack('>H', response[pos:pos+2])[0])
+        request_size = encode_read_registers(self._request, base, length, unit=unit)
+        self.transaction(request_size, 5 + (2 * length), unit, 0x03)
+        return decode_read_registers(self._response, length)
+
+    def read_register_map(self, ranges, unit=1, max_length=125, max_gap=0):
+        """Read a set of register ranges, returning a register:value dict"""
+        registers = {}
+        for base, length in plan_reads(ranges, max_length=max_length, max_gap=max_gap):
+            logging.debug('Reading {} register(s) at base {}'.format(length, base))
+            for i, value in enumerate(self.read_registers(base, length, unit=unit)):
+                registers[base + i] = value
         return registers
 
     def write_register(self, register, value, unit=1):
-        request = struct.pack('>B', unit) + \
-            struct.pack('>B', 0x06) + \
-            struct.pack('>H', register) + \
-            struct.pack('>H', value)
-        request += struct.pack('<H', modbus_crc(request))
-        self.send(request)
-        expected_response_length = 8
-        response = self.recv(expected_response_length)
-        assert(response == request)
+        request_size = encode_write_register(self._request, register, value, unit=unit)
+        self.transaction(request_size, 8, unit, 0x06)
+        if self._response_view[:8] != self._request_view[:8]:
+            raise ResponseError('Write response does not echo the request')
 
     def write_registers(self, register, values, unit=1):
-        request = struct.pack('>B', unit) + \
-            struct.pack('>B', 0x10) + \
-            struct.pack('>H', register) + \
-            struct.pack('>H', len(values)) + \
-            struct.pack('>B', len(values) * 2)
-        for value in values:
-            request += struct.pack('>H', value)
-        request += struct.pack('<H', modbus_crc(request))
-        self.send(request)
-        expected_response_length = 8
-        response = self.recv(expected_response_length)
-        assert(struct.unpack('<H', response[-2:])[0] == modbus_crc(response[0:-2]))
-        assert(struct.unpack('>B', response[0:1])[0] == unit)
-        assert(struct.unpack('>B', response[1:2])[0] == 0x10)
-        assert(struct.unpack('>H', response[2:4])[0] == register)
-        assert(struct.unpack('>H', response[4:6])[0] == len(values))
+        request_size = encode_write_registers(self._request, register, values, unit=unit)
+        self.transaction(request_size, 8, unit, 0x10)
+        check_write_registers(self._response, register, len(values))
 
-    def send(self, data):
+    def _use_read_write(self, read_length, write_values, unit):
+        """Whether a write and read can be one 0x17 transaction"""
+        return (
+            unit not in self.read_write_unsupported and
+            read_length <= MAX_READ_WRITE_READ and len(write_values) <= MAX_READ_WRITE_WRITE
+        )
+
+    def _read_write_failed(self, unit, error):
+        """Account for a failed 0x17 transaction, before falling back
+
+        Only "illegal function", or READ_WRITE_MAX_TIMEOUTS timeouts in a
+        row, mark the unit as not supporting 0x17; anything else (e.g. a
+        frame lost on a noisy link) only falls back this once.
+        """
+        if isinstance(error, TimeoutError):
+            # Some firmware ignores 0x17 outright.  The writes are of
+            # absolute values, so redoing them is safe whether or not
+            # they happened.
+            self.socket.discard_input()
+            timeouts = self._read_write_timeouts.get(unit, 0) + 1
+            self._read_write_timeouts[unit] = timeouts
+            unsupported = timeouts >= READ_WRITE_MAX_TIMEOUTS
+        else:
+            unsupported = error.code == 0x01
+        logging.debug('Unit {} failed read/write multiple registers ({!r}); falling back'.format(unit, error))
+        if unsupported:
+            logging.debug('Unit {} does not support read/write multiple registers'.format(unit))
+            self.read_write_unsupported.add(unit)
+
+    def read_write_registers(self, read_base, read_length, write_base, write_values, unit=1):
+        """Write registers, then read registers, in one transaction if possible
+
+        Uses read/write multiple registers (0x17), in which the device
+        writes before it reads.  If the unit answers 0x17 with an
+        exception or not at all, this falls back to a write then a read;
+        if the problem wasn't down to 0x17, the write raises it again.  A
+        unit answering "illegal function", or not answering several
+        times in a row, is remembered as not supporting 0x17, and always
+        gets the fallback.
+        """
+        if self._use_read_write(read_length, write_values, unit):
+            request_size = encode_read_write_registers(
+                self._request, read_base, read_length, write_base, write_values, unit=unit,
+            )
+            try:
+                self.transaction(request_size, 5 + (2 * read_length), unit, 0x17)
+                self._read_write_timeouts.pop(unit, None)
+                return decode_read_registers(self._response, read_length)
+            except (ExceptionResponse, TimeoutError) as e:
+                self._read_write_failed(unit, e)
+        self.write_registers(write_base, write_values, unit=unit)
+        return self.read_registers(read_base, read_length, unit=unit)
+
+    def transaction(self, request_size, response_size, unit, function):
+        """Send the encoded request, and receive and validate its response"""
+        self.transactions += 1
+        try:
+            self.send(self._request_view[:request_size])
+            sent = time.perf_counter()
+            self.recv_into(self._response_view[:EXCEPTION_RESPONSE_LENGTH])
+            first_bytes = time.perf_counter()
+            check_exception(self._response, function)
+            self.recv_into(self._response_view[EXCEPTION_RESPONSE_LENGTH:response_size])
+            if self.stats is not None:
+                self.stats.record('first_byte', first_bytes - sent)
+                self.stats.record('receive', time.perf_counter() - sent)
+            check_response(self._response, response_size, unit, function)
+        except CRCError:
+            self.crc_errors += 1
+            raise
+
+    def quiet_period_remaining(self):
         ts = time.time()
         if ts < self._last_frame_end + self._silent_interval:
-            to_sleep = self._last_frame_end + self._silent_interval - ts
+            return self._last_frame_end + self._silent_interval - ts
+        return 0
+
+    def send(self, data):
+        start = time.perf_counter()
+        to_sleep = self.quiet_period_remaining()
+        if to_sleep > 0:
             logging.debug('Sleeping {} for 3.5 char ({}) quiet period'.format(
                 to_sleep,
                 self._silent_interval,
             ))
             time.sleep(to_sleep)
 
+        quiet = time.perf_counter()
         result = self.socket.send(data)
         self._last_frame_end = time.time()
+        if self.stats is not None:
+            self.stats.record('quiet_wait', quiet - start)
+            self.stats.record('send', time.perf_counter() - quiet)
         return result
 
-    def recv(self, size):
-        result = self.socket.recv(size)
+    def recv_into(self, buffer):
+        result = self.socket.recv_into(buffer, timeout=self.timeout)
         self._last_frame_end = time.time()
         return result
@@ -0,0 +1,109 @@
+# rdserialtool
+# Copyright (C) 2019 Ryan Finnie
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# asyncio version of rdserial.modbus.RTUClient, for use with the
+# rdserial.device.aio transports.
+
+import asyncio
+import logging
+import time
+
+import rdserial.modbus
+
+
+class RTUClient(rdserial.modbus.RTUClient):
+    async def read_registers(self, base, length, unit=1):
+        request_size = rdserial.modbus.encode_read_registers(self._request, base, length, unit=unit)
+        await self.transaction(request_size, 5 + (2 * length), unit, 0x03)
+        return rdserial.modbus.decode_read_registers(self._response, length)
+
+    async def read_register_map(self, ranges, unit=1, max_length=125, max_gap=0):
+        """Read a set of register ranges, returning a register:value dict"""
+        registers = {}
+        for base, length in rdserial.modbus.plan_reads(ranges, max_length=max_length, max_gap=max_gap):
+            logging.debug('Reading {} register(s) at base {}'.format(length, base))
+            for i, value in enumerate(await self.read_registers(base, length, unit=unit)):
+                registers[base + i] = value
+        return registers
+
+    async def write_register(self, register, value, unit=1):
+        request_size = rdserial.modbus.encode_write_register(self._request, register, value, unit=unit)
+        await self.transaction(request_size, 8, unit, 0x06)
+        if self._response_view[:8] != self._request_view[:8]:
+            raise rdserial.modbus.ResponseError('Write response does not echo the request')
+
+    async def write_registers(self, register, values, unit=1):
+        request_size = rdserial.modbus.encode_write_registers(self._request, register, values, unit=unit)
+        await self.transaction(request_size, 8, unit, 0x10)
+        rdserial.modbus.check_write_registers(self._response, register, len(values))
+
+    async def read_write_registers(self, read_base, read_length, write_base, write_values, unit=1):
+        """Write registers, then read registers, in one transaction if possible"""
+        if self._use_read_write(read_length, write_values, unit):
+            request_size = rdserial.modbus.encode_read_write_registers(
+                self._request, read_base, read_length, write_base, write_values, unit=unit,
+            )
+            try:
+                await self.transaction(request_size, 5 + (2 * read_length), unit, 0x17)
+                self._read_write_timeouts.pop(unit, None)
+                return rdserial.modbus.decode_read_registers(self._response, read_length)
+            except (rdserial.modbus.ExceptionResponse, TimeoutError) as e:
+                self._read_write_failed(unit, e)
+        await self.write_registers(write_base, write_values, unit=unit)
+        return await self.read_registers(read_base, read_length, unit=unit)
+
+    async def transaction(self, request_size, response_size, unit, function):
+        """Send the encoded request, and receive and validate its response"""
+        self.transactions += 1
+        try:
+            await self.send(self._request_view[:request_size])
+            sent = time.perf_counter()
+            await self.recv_into(self._response_view[:rdserial.modbus.EXCEPTION_RESPONSE_LENGTH])
+            first_bytes = time.perf_counter()
+            rdserial.modbus.check_exception(self._response, function)
+            await self.recv_into(self._response_view[rdserial.modbus.EXCEPTION_RESPONSE_LENGTH:response_size])
+            if self.stats is not None:
+                self.stats.record('first_byte', first_bytes - sent)
+                self.stats.record('receive', time.perf_counter() - sent)
+            rdserial.modbus.check_response(self._response, response_size, unit, function)
+        except rdserial.modbus.CRCError:
+            self.crc_errors += 1
+            raise
+
+    async def send(self, data):
+        start = time.perf_counter()
+        to_sleep = self.quiet_period_remaining()
+        if to_sleep > 0:
+            logging.debug('Sleeping {} for 3.5 char ({}) quiet period'.format(
+                to_sleep,
+                self._silent_interval,
+            ))
+            await asyncio.sleep(to_sleep)
+
+        quiet = time.perf_counter()
+        result = await self.socket.send(data)
+        self._last_frame_end = time.time()
+        if self.stats is not None:
+            self.stats.record('quiet_wait', quiet - start)
+            self.stats.record('send', time.perf_counter() - quiet)
+        return result
+
+    async def recv_into(self, buffer):
+        result = await self.socket.recv_into(buffer, timeout=self.timeout)
+        self._last_frame_end = time.time()
+        return result
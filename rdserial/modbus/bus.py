@@ -0,0 +1,138 @@
+# rdserialtool
+# Copyright (C) 2019 Ryan Finnie
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# RS-485 multi-drop bus scheduling: several Modbus units sharing one
+# link, and so one RTUClient.  Transactions to every unit go through
+# the same client, so the inter-frame silent period is kept across
+# units as well as within them.  Units are polled in round-robin
+# order, or in proportion to their weights (smooth weighted
+# round-robin, so a unit of weight 3 among units of weight 1 is spread
+# out rather than polled 3 times in a row).
+
+import logging
+
+import rdserial.modbus
+
+POLICY_ROUND_ROBIN = 'round-robin'
+POLICY_WEIGHTED = 'weighted'
+POLICIES = (POLICY_ROUND_ROBIN, POLICY_WEIGHTED)
+
+
+def parse_unit(val):
+    """Parse a UNIT[:WEIGHT[:TIMEOUT]] command line unit specification"""
+    parts = val.split(':')
+    if len(parts) > 3:
+        raise ValueError('Expected UNIT[:WEIGHT[:TIMEOUT]]', val)
+    unit = int(parts[0])
+    weight = int(parts[1]) if len(parts) > 1 and parts[1] else 1
+    timeout = float(parts[2]) if len(parts) > 2 and parts[2] else None
+    if not 1 <= unit <= 247:
+        raise ValueError('Modbus unit must be 1 to 247', unit)
+    if weight < 1:
+        raise ValueError('Weight must be at least 1', weight)
+    return BusUnit(unit, weight=weight, timeout=(timeout if timeout and timeout > 0 else None))
+
+
+class BusUnit:
+    """One unit on the bus, with its own timeout and error accounting
+
+    timeout is the response timeout for this unit's transactions, or
+    None for the transport's.  client is free for the caller's use,
+    e.g. a rdserial.dps.Client for the unit.
+    """
+    def __init__(self, unit, weight=1, timeout=None, client=None):
+        self.unit = unit
+        self.weight = weight
+        self.timeout = timeout
+        self.client = client
+        self.polls = 0
+        self.transactions = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.crc_errors = 0
+        self.consecutive_errors = 0
+        self.last_error = None
+        self._current_weight = 0
+
+    def __str__(self):
+        return 'unit {}: {} poll(s), {} transaction(s), {} error(s) ({} timeout(s), {} CRC)'.format(
+            self.unit, self.polls, self.transactions, self.errors, self.timeouts, self.crc_errors,
+        )
+
+
+class Bus:
+    def __init__(self, modbus_client, units, policy=POLICY_ROUND_ROBIN):
+        if not units:
+            raise ValueError('A bus needs at least one unit')
+        if len(set(unit.unit for unit in units)) != len(units):
+            raise ValueError('Duplicate units on the bus', [unit.unit for unit in units])
+        if policy not in POLICIES:
+            raise ValueError('Unknown bus policy', policy)
+        self.modbus_client = modbus_client
+        self.units = list(units)
+        self.policy = policy
+
+    def next_unit(self):
+        """Return the unit to poll next"""
+        total = 0
+        best = None
+        for unit in self.units:
+            weight = unit.weight if self.policy == POLICY_WEIGHTED else 1
+            unit._current_weight += weight
+            total += weight
+            if best is None or unit._current_weight > best._current_weight:
+                best = unit
+        best._current_weight -= total
+        return best
+
+    def run(self, unit, func):
+        """Call func() to talk to unit, with its timeout and accounting
+
+        Errors are counted against the unit and re-raised.  After a
+        timeout or corrupt response, anything still arriving (e.g. a
+        late answer) is discarded, so it can't be taken as the next
+        unit's response.
+        """
+        client = self.modbus_client
+        transactions = client.transactions
+        client.timeout = unit.timeout
+        unit.polls += 1
+        try:
+            result = func()
+        except Exception as e:
+            unit.errors += 1
+            unit.consecutive_errors += 1
+            unit.last_error = e
+            if isinstance(e, TimeoutError):
+                unit.timeouts += 1
+            elif isinstance(e, rdserial.modbus.CRCError):
+                unit.crc_errors += 1
+            if isinstance(e, (TimeoutError, rdserial.modbus.CRCError, rdserial.modbus.ResponseError)):
+                logging.debug('Bus: discarding input after unit {} error: {!r}'.format(unit.unit, e))
+                client.socket.discard_input()
+            raise
+        finally:
+            client.timeout = None
+            unit.transactions += client.transactions - transactions
+        unit.consecutive_errors = 0
+        return result
+
+    def poll(self, func):
+        """Call func(unit) for the next unit, returning (unit, result)"""
+        unit = self.next_unit()
+        return unit, self.run(unit, lambda: func(unit))
@@ -0,0 +1,80 @@
+# rdserialtool
+# Copyright (C) 2019 Ryan Finnie
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import logging
+import math
+import time
+
+# When a tick overruns into the following period(s):
+# skip: run the late tick immediately, drop any further missed ticks
+# catch-up: run every missed tick back-to-back until on schedule again
+POLICY_SKIP = 'skip'
+POLICY_CATCH_UP = 'catch-up'
+POLICIES = (POLICY_SKIP, POLICY_CATCH_UP)
+
+
+class Scheduler:
+    """Fixed-rate tick scheduler
+
+    Deadlines are absolute points on the monotonic clock, spaced
+    interval seconds apart from the first tick, so time spent doing
+    work between ticks does not accumulate as drift.
+    """
+    def __init__(self, interval, policy=POLICY_SKIP, clock=time.monotonic, sleep=time.sleep):
+        if policy not in POLICIES:
+            raise ValueError('Invalid scheduler policy', policy)
+        self.interval = interval
+        self.policy = policy
+        self.clock = clock
+        self.sleep = sleep
+        self.ticks = 0
+        self.late = 0
+        self.missed = 0
+        self.skipped = 0
+        self.deadline = self.clock()
+
+    def advance(self):
+        """Advance to the next tick, returning the seconds until it is due"""
+        self.ticks += 1
+        self.skipped = 0
+        if self.interval <= 0:
+            return 0
+        self.deadline += self.interval
+        now = self.clock()
+        if now < self.deadline:
+            return self.deadline - now
+
+        self.late += 1
+        if self.policy == POLICY_CATCH_UP:
+            return 0
+        self.skipped = math.floor((now - self.deadline) / self.interval)
+        if self.skipped > 0:
+            self.deadline += self.skipped * self.interval
+            self.missed += self.skipped
+            logging.warning('Collection overran, skipped {} tick(s)'.format(self.skipped))
+        return 0
+
+    def wait(self):
+        """Wait for the next tick, returning the number of ticks skipped"""
+        delay = self.advance()
+        if delay > 0:
+            self.sleep(delay)
+        return self.skipped
+
+    def __str__(self):
+        return '{} ticks, {} late, {} missed'.format(self.ticks, self.late, self.missed)
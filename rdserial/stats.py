@@ -0,0 +1,124 @@
+# rdserialtool
+# Copyright (C) 2019 Ryan Finnie
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# Latency histograms for the phases of a collection (quiet period
+# wait, send, time to first byte, receive, decode, format, callback),
+# timed with time.perf_counter().
+
+import math
+import time
+
+# Bucket i holds durations in [2**i, 2**(i+1)) microseconds; the last
+# bucket holds everything longer.
+BUCKETS = 26
+
+# Phases, in the order they happen in a collection.  first_byte is the
+# time from the end of sending until the start of the response (the
+# first byte, or first 5 bytes of a Modbus response) has arrived, and
+# receive until all of it has.
+PHASES = ('quiet_wait', 'send', 'first_byte', 'receive', 'decode', 'format', 'callback')
+
+
+class Histogram:
+    """Log2-bucketed histogram of durations, in constant space"""
+    __slots__ = ('buckets', 'count', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, seconds):
+        us = seconds * 1e6
+        bucket = min(int(math.log2(us)), BUCKETS - 1) if us >= 1 else 0
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    @property
+    def mean(self):
+        return (self.total / self.count) if self.count else None
+
+    def percentile(self, p):
+        """Estimate of the pth percentile, from the bucket it falls in"""
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                # Geometric middle of the bucket, clamped to what was seen
+                estimate = (2 ** (bucket + 0.5)) / 1e6
+                return min(max(estimate, self.min), self.max)
+        return self.max
+
+
+class Stats:
+    def __init__(self, interval=None, clock=time.monotonic):
+        self.histograms = {}
+        self.interval = interval
+        self.clock = clock
+        self._next_line = None if not interval else clock() + interval
+
+    def due(self):
+        """Whether a periodic stats line is due, every interval seconds"""
+        if self._next_line is None:
+            return False
+        now = self.clock()
+        if now < self._next_line:
+            return False
+        self._next_line = now + self.interval
+        return True
+
+    def record(self, phase, seconds):
+        histogram = self.histograms.get(phase)
+        if histogram is None:
+            histogram = self.histograms[phase] = Histogram()
+        histogram.record(seconds)
+
+    def _phases(self):
+        return [x for x in PHASES if x in self.histograms] + sorted(x for x in self.histograms if x not in PHASES)
+
+    def line(self):
+        """One-line summary: mean and p99 milliseconds of each phase"""
+        return ', '.join(
+            '{} {:.2f}/{:.2f}ms'.format(
+                phase, self.histograms[phase].mean * 1000, self.histograms[phase].percentile(99) * 1000,
+            ) for phase in self._phases()
+        )
+
+    def summary(self):
+        """Table of count, mean, percentiles and max milliseconds of each phase"""
+        lines = ['{:12s} {:>8s} {:>9s} {:>9s} {:>9s} {:>9s} {:>9s}'.format(
+            'phase (ms)', 'count', 'mean', 'p50', 'p90', 'p99', 'max',
+        )]
+        for phase in self._phases():
+            histogram = self.histograms[phase]
+            lines.append('{:12s} {:8d} {:9.3f} {:9.3f} {:9.3f} {:9.3f} {:9.3f}'.format(
+                phase, histogram.count, histogram.mean * 1000,
+                histogram.percentile(50) * 1000, histogram.percentile(90) * 1000,
+                histogram.percentile(99) * 1000, histogram.max * 1000,
+            ))
+        return lines
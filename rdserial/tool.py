@@ -24,9 +24,22 @@ import time
 
 from rdserial import __version__
 import rdserial.device
+import rdserial.device.replay
+import rdserial.dps
+import rdserial.scheduler
+import rdserial.um
 import rdserial.um.tool
 import rdserial.dps.tool
 
+def parse_speed(string):
+    if string == 'max':
+        return None
+    val = float(string)
+    if val <= 0:
+        raise argparse.ArgumentTypeError('Must be positive, or "max"')
+    return val
+
+
 def parse_args(argv=None, address_required=True, command_required=True):
     """Parse user arguments."""
     if argv is None:
@@ -67,6 +80,14 @@ def parse_args(argv=None, address_required=True, command_required=True):
             '--serial-device', '-s',
             help='Serial filename (e.g. /dev/rfcomm0) of the device',
         )
+        device_group.add_argument(
+            '--fleet',
+            help='JSON file listing multiple devices to poll together, outputting device-tagged JSON',
+        )
+        device_group.add_argument(
+            '--replay',
+            help='Replay a --record-raw recording instead of connecting to a device',
+        )
 
     parser.add_argument(
         '--bluetooth-port', type=int, default=1,
@@ -77,8 +98,22 @@ def parse_args(argv=None, address_required=True, command_required=True):
         help='Serial port baud rate',
     )
     parser.add_argument(
-        '--connect-delay', type=float, default=0.3,
-        help='Seconds to wait after connecting to the serial port',
+        '--connect-delay', type=float, default=0.0,
+        help='Seconds to wait after connecting, before probing the device',
+    )
+    parser.add_argument(
+        '--probe-timeout', type=float, default=0.25,
+        help='Seconds to wait for the first answer to a readiness probe after connecting, '
+             'doubling on each retry (0 to not probe)',
+    )
+    parser.add_argument(
+        '--reconnect-max-delay', type=float, default=30.0,
+        help='In watch and daemon modes, reconnect a dropped link, waiting up to this many seconds '
+             'between attempts (0 to not reconnect)',
+    )
+    parser.add_argument(
+        '--timeout', type=float, default=5.0,
+        help='Seconds to wait for a response from the device (0 to wait forever)',
     )
     parser.add_argument(
         '--json', action='store_true',
@@ -92,6 +127,46 @@ def parse_args(argv=None, address_required=True, command_required=True):
         '--watch-seconds', type=float, default=2.0,
         help='Number of seconds between collections in watch mode',
     )
+    parser.add_argument(
+        '--watch-policy', choices=rdserial.scheduler.POLICIES, default=rdserial.scheduler.POLICY_SKIP,
+        help='Whether to skip or catch up on collections missed when one overruns in watch mode',
+    )
+    parser.add_argument(
+        '--record-raw',
+        help='Record all bytes sent to and received from the device to this file',
+    )
+    parser.add_argument(
+        '--speed', type=parse_speed, default=1.0,
+        help='Replay speed, as a multiple of the recorded pace, or "max"',
+    )
+    parser.add_argument(
+        '--capture',
+        help='Append each sample to this binary capture file',
+    )
+    parser.add_argument(
+        '--metrics-port', type=int, default=None,
+        help='Serve Prometheus metrics of the latest sample on this HTTP port',
+    )
+    parser.add_argument(
+        '--metrics-address', default='127.0.0.1',
+        help='Address to serve metrics on',
+    )
+    parser.add_argument(
+        '--daemon', metavar='SOCKET',
+        help='Stay connected, serving samples and commands on this Unix domain socket (see rdserial.daemon)',
+    )
+    parser.add_argument(
+        '--daemon-max-age', type=float, default=1.0,
+        help='Seconds old a sample may be and still be served by --daemon without collecting a new one',
+    )
+    parser.add_argument(
+        '--stats', action='store_true',
+        help='Time each phase of collection, logging a summary at exit',
+    )
+    parser.add_argument(
+        '--stats-interval', type=float, default=60.0,
+        help='Seconds between stats lines in watch mode with --stats (0 for none)',
+    )
     parser.add_argument(
         '--trend-points', type=int, default=5,
         help='Number of points to remember for determining a trend in watch mode',
@@ -103,7 +178,7 @@ def parse_args(argv=None, address_required=True, command_required=True):
 
     args = parser.parse_args(args=argv[1:])
 
-    if command_required and args.command is None:
+    if command_required and args.command is None and not getattr(args, 'fleet', None):
         parser.error('Command required')
 
     return args
@@ -135,13 +210,16 @@ class RDSerialTool:
                     write_json,
                     watch,
                     watch_seconds,
-                    trend_points):
+                    trend_points,
+                    timeout):
         address_required = bluetooth_address is None
         device_required = device is None
         self.args = parse_args(address_required=address_required, command_required=device_required)
         if not address_required:
             self.args.bluetooth_address = bluetooth_address
             self.args.serial_device = None
+            self.args.fleet = None
+            self.args.replay = None
         if not device_required:
             self.args.command = device
         if connect_delay is not None:
@@ -162,6 +240,33 @@ class RDSerialTool:
             self.args.trend_points = trend_points
         if bluetooth_port is not None:
             self.args.bluetooth_port = bluetooth_port
+        if timeout is not None:
+            self.args.timeout = timeout
+
+    def wait_ready(self, timeout=None):
+        """Probe the device until it answers, instead of waiting a fixed time
+
+        Probes go straight to the transport, so they are never part of a
+        --record-raw recording, even after a reconnect.
+        """
+        transport = self.transport
+
+        def probe(probe_timeout):
+            if self.args.command == 'dps':
+                unit = self.args.bus_unit[0].unit if self.args.bus_unit else self.args.modbus_unit
+                return rdserial.dps.probe(transport, probe_timeout, unit=unit, baudrate=self.args.baud)
+            return rdserial.um.probe(transport, probe_timeout, device_type=self.args.command.upper())
+
+        seconds, probes = rdserial.device.wait_ready(
+            transport, probe, timeout=timeout, probe_timeout=self.args.probe_timeout,
+        )
+        logging.info('Device ready after %.3fs (%d probe(s))', seconds, probes)
+
+    def ready(self):
+        """Wait for a newly (re)connected device to be ready"""
+        time.sleep(self.args.connect_delay)
+        if self.args.probe_timeout > 0:
+            self.wait_ready(self.args.timeout if self.args.timeout > 0 else None)
 
     def main(self,
              bluetooth_address=None,
@@ -175,7 +280,8 @@ class RDSerialTool:
              write_json=None,
              watch=None,
              watch_seconds=None,
-             trend_points=None):
+             trend_points=None,
+             timeout=None):
         """Connects to the specified device"""
 
         self._setup_args(bluetooth_address,
@@ -188,18 +294,36 @@ class RDSerialTool:
                          write_json,
                          watch,
                          watch_seconds,
-                         trend_points)
+                         trend_points,
+                         timeout)
         self._setup_logging()
 
         logging.info('rdserialtool %s', __version__)
         logging.info('Copyright (C) 2019 Ryan Finnie')
         logging.info('')
 
-        if self.args.serial_device:
+        if self.args.fleet:
+            # Imported here, as binding the name rdserial locally would
+            # shadow the module for the rest of main().
+            from rdserial import fleet
+            return fleet.main(self.args, callback)
+
+        timeout = self.args.timeout if self.args.timeout > 0 else None
+        if self.args.replay:
+            self.socket = rdserial.device.replay.Replay(self.args.replay, speed=self.args.speed)
+            if self.socket.command and self.socket.command != self.args.command:
+                logging.warning('Recording is of a {}, not a {}'.format(self.socket.command, self.args.command))
+            logging.info('Replaying %s %s', self.args.command.upper(), self.args.replay)
+            # Replay until the recording ends, paced by the recording
+            # rather than by the watch interval.
+            self.args.watch = True
+            self.args.watch_seconds = 0
+        elif self.args.serial_device:
             logging.info('Connecting to %s %s', self.args.command.upper(), self.args.serial_device)
             self.socket = rdserial.device.Serial(
                 self.args.serial_device,
                 baudrate=self.args.baud,
+                timeout=timeout,
             )
         else:
             logging.info('Connecting to %s %s',
@@ -208,11 +332,19 @@ class RDSerialTool:
             self.socket = rdserial.device.Bluetooth(
                 self.args.bluetooth_address,
                 port=self.args.bluetooth_port,
+                timeout=timeout,
             )
+        # The transport itself, whatever self.socket is later wrapped in
+        self.transport = self.socket
         self.socket.connect()
+        # Recordings start once the device is ready, and replays (which
+        # are always ready) are not probed
+        if not self.args.replay:
+            self.ready()
+        if self.args.record_raw:
+            self.socket = rdserial.device.replay.Recorder(self.socket, self.args.record_raw, command=self.args.command)
         logging.info('Connection established')
         logging.info('')
-        time.sleep(self.args.connect_delay)
 
         if self.args.command in ('um24c', 'um25c', 'um34c'):
             tool = rdserial.um.tool.Tool(self, callback)
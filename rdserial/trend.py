@@ -0,0 +1,161 @@
+# rdserialtool
+# Copyright (C) 2019 Ryan Finnie
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import collections
+import math
+
+TREND_UP = '\u2197'
+TREND_DOWN = '\u2198'
+TREND_FLAT = ' '
+TOLERANCE = 1e-9
+
+
+class RollingWindow:
+    """Fixed-size window over the last size values
+
+    Pushing a value and reading the mean, min, max or standard deviation
+    are all (amortized) constant time, regardless of size: the values
+    live in a ring buffer with running sums, and min/max come from
+    monotonic queues.  The running sums are recomputed from the buffer
+    each time it wraps, so floating point error cannot build up.
+    """
+    __slots__ = ('size', 'values', 'index', 'count', 'total', 'total_sq', '_pushed', '_min', '_max')
+
+    def __init__(self, size, fill=None):
+        if size < 1:
+            raise ValueError('Window size must be at least 1', size)
+        self.size = size
+        self.values = [0] * size
+        self.index = 0
+        self.count = 0
+        self.total = 0
+        self.total_sq = 0
+        self._pushed = 0
+        # (push sequence, value) pairs; values increasing in _min,
+        # decreasing in _max.
+        self._min = collections.deque()
+        self._max = collections.deque()
+        if fill is not None:
+            self.values = [fill] * size
+            self.count = size
+            self.total = fill * size
+            self.total_sq = fill * fill * size
+            self._pushed = size
+            self._min.append((size - 1, fill))
+            self._max.append((size - 1, fill))
+
+    def push(self, value):
+        if self.count == self.size:
+            old = self.values[self.index]
+            self.total -= old
+            self.total_sq -= old * old
+        else:
+            self.count += 1
+        self.values[self.index] = value
+        self.total += value
+        self.total_sq += value * value
+        self.index += 1
+        if self.index == self.size:
+            self.index = 0
+            self.total = sum(self.values)
+            self.total_sq = sum(x * x for x in self.values)
+
+        seq = self._pushed
+        self._pushed += 1
+        expired = seq - self.size
+        queue = self._min
+        while queue and queue[-1][1] >= value:
+            queue.pop()
+        queue.append((seq, value))
+        if queue[0][0] <= expired:
+            queue.popleft()
+        queue = self._max
+        while queue and queue[-1][1] <= value:
+            queue.pop()
+        queue.append((seq, value))
+        if queue[0][0] <= expired:
+            queue.popleft()
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def mean(self):
+        if not self.count:
+            return None
+        if self._min[0][1] == self._max[0][1]:
+            # Constant window; exact, unlike total / count
+            return self._min[0][1]
+        return self.total / self.count
+
+    @property
+    def min(self):
+        return self._min[0][1] if self._min else None
+
+    @property
+    def max(self):
+        return self._max[0][1] if self._max else None
+
+    @property
+    def stddev(self):
+        """Population standard deviation of the window"""
+        if not self.count:
+            return None
+        mean = self.mean
+        return math.sqrt(max(self.total_sq / self.count - mean * mean, 0))
+
+
+class Trends:
+    """A RollingWindow of the last points values of each field"""
+    def __init__(self, points):
+        self.points = points
+        self.windows = {}
+
+    def __contains__(self, name):
+        return name in self.windows
+
+    def __getitem__(self, name):
+        return self.windows[name]
+
+    def direction(self, name, value):
+        """Return an arrow for value against the field's rolling mean, then add it
+
+        A field's first value fills its window, so it starts flat.
+        """
+        window = self.windows.get(name)
+        if window is None:
+            self.windows[name] = RollingWindow(self.points, fill=value)
+            return TREND_FLAT
+        mean = window.mean
+        window.push(value)
+        # Running sums are inexact; within rounding error counts as flat
+        if abs(value - mean) <= TOLERANCE * max(abs(value), 1):
+            return TREND_FLAT
+        elif value > mean:
+            return TREND_UP
+        else:
+            return TREND_DOWN
+
+    def stats(self, name):
+        window = self.windows[name]
+        return {
+            'mean': window.mean,
+            'min': window.min,
+            'max': window.max,
+            'stddev': window.stddev,
+        }
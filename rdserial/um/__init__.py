@@ -30,11 +30,99 @@ CHARGING_APP0_5A = 6
 CHARGING_DCP1_5A = 7
 CHARGING_SAMSUNG = 8
 
+# Every frame is FRAME_SIZE bytes, starting with the model's start
+# marker and ending with END_MARKER
+FRAME_SIZE = 130
+START_MARKERS = {
+    'UM24C': 0x0963,
+    'UM25C': 0x09c9,
+    'UM34C': 0x0d4c,
+}
+END_MARKER = 0xfff1
+
+_marker = struct.Struct('>H')
+
+
+def valid_frame(data, device_type=None):
+    """Whether data is a frame, with the start marker (of device_type,
+    if given) and end marker in place"""
+    if len(data) != FRAME_SIZE:
+        return False
+    start = _marker.unpack_from(data, 0)[0]
+    if device_type is not None:
+        if start != START_MARKERS.get(device_type):
+            return False
+    elif start not in START_MARKERS.values():
+        return False
+    return _marker.unpack_from(data, FRAME_SIZE - 2)[0] == END_MARKER
+
+
+def find_frame(data, start=0):
+    """Offset of the first start marker in data at or after start, or -1"""
+    offsets = [
+        offset for offset in (bytes(data).find(_marker.pack(marker), start) for marker in START_MARKERS.values())
+        if offset >= 0
+    ]
+    return min(offsets) if offsets else -1
+
+
+def _resync(data):
+    """Generator behind resync(): yields the number of bytes to read next,
+    is sent them, and returns (frame, skipped)"""
+    buf = bytearray(data)
+    offset = 0
+    while True:
+        offset = find_frame(buf, offset + 1)
+        if offset < 0 or offset >= FRAME_SIZE:
+            break
+        need = offset + FRAME_SIZE - len(buf)
+        if need > 0:
+            buf += yield need
+        if valid_frame(buf[offset:offset + FRAME_SIZE]):
+            return bytes(buf[offset:offset + FRAME_SIZE]), offset
+    return None, len(buf)
+
+
+def resync(socket, data, timeout=None):
+    """Recover the frame from a misaligned read
+
+    data is a FRAME_SIZE read which isn't a valid frame, e.g. as stray
+    bytes or the tail of an earlier, interrupted frame came first.  The
+    frame is taken to start at the next start marker, and the rest of
+    it is read; it is accepted if its end marker is in place.  Returns
+    the frame and the number of bytes skipped, or (None, skipped) if no
+    frame turns up within FRAME_SIZE bytes, in which case any input
+    still arriving is discarded.
+    """
+    steps = _resync(data)
+    try:
+        need = next(steps)
+        while True:
+            need = steps.send(socket.recv(need, timeout=timeout))
+    except StopIteration as stop:
+        frame, skipped = stop.value
+    if frame is None:
+        socket.discard_input()
+    return frame, skipped
+
+
+def resynced(frame, skipped, source):
+    """Return a frame from resync(), logging the bytes skipped, or raise
+    ValueError if none was found"""
+    if frame is None:
+        raise ValueError('Lost frame alignment; discarded input after {} byte(s)'.format(skipped))
+    logging.warning('{}: Resynchronised, skipping {} byte(s)'.format(source, skipped))
+    return frame
+
+
+def probe(socket, timeout, device_type=None):
+    """Request a frame, returning whether a valid one arrives within timeout"""
+    socket.send(b'\xf0')
+    return valid_frame(socket.recv(FRAME_SIZE, timeout=timeout), device_type)
+
 
 class DataGroup:
-    group = 0
-    amp_hours = 0
-    watt_hours = 0
+    __slots__ = ('group', 'amp_hours', 'watt_hours')
 
     def __repr__(self):
         return ('<DataGroup {}: {:0.03f}Ah, {:0.03f}Wh>'.format(
@@ -43,11 +131,137 @@ class DataGroup:
             self.watt_hours,
         ))
 
-    def __init__(self, group=0):
+    def __init__(self, group=0, amp_hours=0, watt_hours=0):
         self.group = group
+        self.amp_hours = amp_hours
+        self.watt_hours = watt_hours
 
 
 class Response:
+    # 'divisor' converts the raw integer to the unit in the description;
+    # 'multiplied' divisors are further multiplied by device_multiplier
+    # (the UM25C reports volts and amps with an extra decimal place).
+    field_properties = {
+        'start': {
+            'description': 'Start bytes',
+            'position': 0,
+            'length': 2,
+        },
+        'volts': {
+            'description': 'Volts',
+            'position': 2,
+            'length': 2,
+            'divisor': 100,
+            'multiplied': True,
+        },
+        'amps': {
+            'description': 'Amps',
+            'position': 4,
+            'length': 2,
+            'divisor': 1000,
+            'multiplied': True,
+        },
+        'watts': {
+            'description': 'Watts',
+            'position': 6,
+            'length': 4,
+            'divisor': 1000,
+        },
+        'temp_c': {
+            'description': 'Temperature (Celsius)',
+            'position': 10,
+            'length': 2,
+        },
+        'temp_f': {
+            'description': 'Temperature (Fahrenheit)',
+            'position': 12,
+            'length': 2,
+        },
+        'data_group_selected': {
+            'description': 'Currently selected data group',
+            'position': 14,
+            'length': 2,
+        },
+        'data_line_positive_volts': {
+            'description': 'Positive data line volts',
+            'position': 96,
+            'length': 2,
+            'divisor': 100,
+        },
+        'data_line_negative_volts': {
+            'description': 'Negative data line volts',
+            'position': 98,
+            'length': 2,
+            'divisor': 100,
+        },
+        'charging_mode': {
+            'description': 'Charging mode',
+            'position': 100,
+            'length': 2,
+        },
+        'record_amphours': {
+            'description': 'Recorded amp-hours',
+            'position': 102,
+            'length': 4,
+            'divisor': 1000,
+        },
+        'record_watthours': {
+            'description': 'Recorded watt-hours',
+            'position': 106,
+            'length': 4,
+            'divisor': 1000,
+        },
+        'record_threshold': {
+            'description': 'Recording threshold (Amps)',
+            'position': 110,
+            'length': 2,
+            'divisor': 100,
+        },
+        'record_seconds': {
+            'description': 'Recorded time (Seconds)',
+            'position': 112,
+            'length': 4,
+        },
+        'recording': {
+            'description': 'Recording',
+            'position': 116,
+            'length': 2,
+            'bool': True,
+        },
+        'screen_timeout': {
+            'description': 'Screen timeout (Minutes)',
+            'position': 118,
+            'length': 2,
+        },
+        'screen_brightness': {
+            'description': 'Screen brightness',
+            'position': 120,
+            'length': 2,
+        },
+        'resistance': {
+            'description': 'Resistance (Ohms)',
+            'position': 122,
+            'length': 4,
+            'divisor': 10,
+        },
+        'screen_selected': {
+            'description': 'Currently selected screen',
+            'position': 126,
+            'length': 2,
+        },
+        'end': {
+            'description': 'End bytes',
+            'position': 128,
+            'length': 2,
+        },
+    }
+
+    # 10 data groups of amp-hours and watt-hours (1/1000 units) at 16-95
+    data_group_position = 16
+    data_group_count = 10
+
+    __slots__ = ('device_type', 'device_multiplier', 'collection_time', 'data_groups') + tuple(field_properties)
+
     def __repr__(self):
         return ('<Response: {} at {}, {:0.02f}V, {:0.03f}A>'.format(
             self.device_type,
@@ -63,202 +277,88 @@ class Response:
         else:
             self.device_multiplier = 1
 
-        self.field_properties = {
-            'start': {
-                'description': 'Start bytes',
-                'position': 0,
-                'length': 2,
-                'from_int': lambda x: x,
-                'to_int': lambda x: int(x),
-            },
-            'volts': {
-                'description': 'Volts',
-                'position': 2,
-                'length': 2,
-                'from_int': lambda x: x / (100 * self.device_multiplier),
-                'to_int': lambda x: int(x * (100 * self.device_multiplier)),
-            },
-            'amps': {
-                'description': 'Amps',
-                'position': 4,
-                'length': 2,
-                'from_int': lambda x: x / (1000 * self.device_multiplier),
-                'to_int': lambda x: int(x * (1000 * self.device_multiplier)),
-            },
-            'watts': {
-                'description': 'Watts',
-                'position': 6,
-                'length': 4,
-                'from_int': lambda x: x / 1000,
-                'to_int': lambda x: int(x * 1000),
-            },
-            'temp_c': {
-                'description': 'Temperature (Celsius)',
-                'position': 10,
-                'length': 2,
-                'from_int': lambda x: x,
-                'to_int': lambda x: int(x),
-            },
-            'temp_f': {
-                'description': 'Temperature (Fahrenheit)',
-                'position': 12,
-                'length': 2,
-                'from_int': lambda x: x,
-                'to_int': lambda x: int(x),
-            },
-            'data_group_selected': {
-                'description': 'Currently selected data group',
-                'position': 14,
-                'length': 2,
-                'from_int': lambda x: x,
-                'to_int': lambda x: int(x),
-            },
-            'data_line_positive_volts': {
-                'description': 'Positive data line volts',
-                'position': 96,
-                'length': 2,
-                'from_int': lambda x: x / 100,
-                'to_int': lambda x: int(x * 100),
-            },
-            'data_line_negative_volts': {
-                'description': 'Negative data line volts',
-                'position': 98,
-                'length': 2,
-                'from_int': lambda x: x / 100,
-                'to_int': lambda x: int(x * 100),
-            },
-            'charging_mode': {
-                'description': 'Charging mode',
-                'position': 100,
-                'length': 2,
-                'from_int': lambda x: x,
-                'to_int': lambda x: int(x),
-            },
-            'record_amphours': {
-                'description': 'Recorded amp-hours',
-                'position': 102,
-                'length': 4,
-                'from_int': lambda x: x / 1000,
-                'to_int': lambda x: int(x * 1000),
-            },
-            'record_watthours': {
-                'description': 'Recorded watt-hours',
-                'position': 106,
-                'length': 4,
-                'from_int': lambda x: x / 1000,
-                'to_int': lambda x: int(x * 1000),
-            },
-            'record_threshold': {
-                'description': 'Recording threshold (Amps)',
-                'position': 110,
-                'length': 2,
-                'from_int': lambda x: x / 100,
-                'to_int': lambda x: int(x * 100),
-            },
-            'record_seconds': {
-                'description': 'Recorded time (Seconds)',
-                'position': 112,
-                'length': 4,
-                'from_int': lambda x: x,
-                'to_int': lambda x: int(x),
-            },
-            'recording': {
-                'description': 'Recording',
-                'position': 116,
-                'length': 2,
-                'from_int': lambda x: bool(x),
-                'to_int': lambda x: int(x),
-            },
-            'screen_timeout': {
-                'description': 'Screen timeout (Minutes)',
-                'position': 118,
-                'length': 2,
-                'from_int': lambda x: x,
-                'to_int': lambda x: int(x),
-            },
-            'screen_brightness': {
-                'description': 'Screen brightness',
-                'position': 120,
-                'length': 2,
-                'from_int': lambda x: x,
-                'to_int': lambda x: int(x),
-            },
-            'resistance': {
-                'description': 'Resistance (Ohms)',
-                'position': 122,
-                'length': 4,
-                'from_int': lambda x: x / 10,
-                'to_int': lambda x: int(x * 10),
-            },
-            'screen_selected': {
-                'description': 'Currently selected screen',
-                'position': 126,
-                'length': 2,
-                'from_int': lambda x: x,
-                'to_int': lambda x: int(x),
-            },
-            'end': {
-                'description': 'End bytes',
-                'position': 128,
-                'length': 2,
-                'from_int': lambda x: x,
-                'to_int': lambda x: int(x),
-            },
-        }
-
         if collection_time is None:
             collection_time = datetime.datetime.now()
         self.collection_time = collection_time
-        for name in self.field_properties:
-            setattr(self, name, 0)
-        self.data_groups = [DataGroup(x) for x in range(10)]
 
         if data:
             self.load(data)
+        else:
+            for name in self.field_properties:
+                setattr(self, name, 0)
+            self.data_groups = [DataGroup(x) for x in range(self.data_group_count)]
 
-    def dump(self):
-        data = bytearray(130)
-        for name in self.field_properties:
-            pos = self.field_properties[name]['position']
-            pos_len = self.field_properties[name]['length']
-            if pos_len == 2:
-                pack_format = '>H'
-            elif pos_len == 4:
-                pack_format = '>L'
+    @classmethod
+    def _compile(cls):
+        """Compile the frame layout into a single struct, plus field conversions"""
+        fields = sorted(cls.field_properties.items(), key=lambda x: x[1]['position'])
+        pack_format = '>'
+        pos = 0
+        index = 0
+        int_fields = []
+        bool_fields = []
+        scaled_fields = []
+        for name, properties in fields:
+            if pos == cls.data_group_position:
+                cls._data_group_index = index
+                pack_format += '{}L'.format(cls.data_group_count * 2)
+                pos += cls.data_group_count * 8
+                index += cls.data_group_count * 2
+            assert(properties['position'] == pos)
+            pack_format += {2: 'H', 4: 'L'}[properties['length']]
+            if properties.get('bool'):
+                bool_fields.append((name, index))
+            elif 'divisor' in properties:
+                scaled_fields.append((name, index, properties['divisor'], properties.get('multiplied', False)))
             else:
-                pack_format = 'B'
-            conversion_dump = self.field_properties[name]['to_int']
-            data[pos:pos+pos_len] = struct.pack(pack_format, conversion_dump(getattr(self, name)))
+                int_fields.append((name, index))
+            pos += properties['length']
+            index += 1
+        cls._struct = struct.Struct(pack_format)
+        assert(cls._struct.size == 130)
+        cls._int_fields = tuple(int_fields)
+        cls._bool_fields = tuple(bool_fields)
+        cls._scaled_fields = {}
+        for multiplier in (1, 10):
+            cls._scaled_fields[multiplier] = tuple(
+                (name, index, divisor * (multiplier if multiplied else 1))
+                for name, index, divisor, multiplied in scaled_fields
+            )
+
+    def dump(self):
+        values = [0] * (len(self.field_properties) + (self.data_group_count * 2))
+        for name, index in self._int_fields:
+            values[index] = int(getattr(self, name))
+        for name, index in self._bool_fields:
+            values[index] = int(getattr(self, name))
+        for name, index, divisor in self._scaled_fields[self.device_multiplier]:
+            values[index] = int(round(getattr(self, name) * divisor))
 
         for data_group in self.data_groups:
             if (data_group.group > 9) or (data_group.group < 0):
                 continue
-            pos = 16 + (data_group.group * 8)
-            data[pos:pos+4] = struct.pack('>L', int(data_group.amp_hours * 1000))
-            data[pos+4:pos+8] = struct.pack('>L', int(data_group.watt_hours * 1000))
-        return bytes(data)
+            index = self._data_group_index + (data_group.group * 2)
+            values[index] = int(round(data_group.amp_hours * 1000))
+            values[index+1] = int(round(data_group.watt_hours * 1000))
+        return self._struct.pack(*values)
 
     def load(self, data):
         if len(data) != 130:
             raise ValueError('Invalid data length', data)
-        logging.debug('Start: 0x{:02x}{:02x}, end: 0x{:02x}{:02x}'.format(data[0], data[1], data[128], data[129]))
-        for name in self.field_properties:
-            pos = self.field_properties[name]['position']
-            pos_len = self.field_properties[name]['length']
-            if pos_len == 2:
-                pack_format = '>H'
-            elif pos_len == 4:
-                pack_format = '>L'
-            else:
-                pack_format = 'B'
-            conversion_load = self.field_properties[name]['from_int']
-            val = conversion_load(struct.unpack(pack_format, data[pos:pos+pos_len])[0])
-            setattr(self, name, val)
-
-        self.data_groups = []
-        for i in range(10):
-            data_group = DataGroup(i)
-            pos = 16 + (i * 8)
-            data_group.amp_hours = struct.unpack('>L', data[pos:pos+4])[0] / 1000
-            data_group.watt_hours = struct.unpack('>L', data[pos+4:pos+8])[0] / 1000
-            self.data_groups.append(data_group)
+        values = self._struct.unpack(data)
+        for name, index in self._int_fields:
+            setattr(self, name, values[index])
+        for name, index in self._bool_fields:
+            setattr(self, name, bool(values[index]))
+        for name, index, divisor in self._scaled_fields[self.device_multiplier]:
+            setattr(self, name, values[index] / divisor)
+        logging.debug('Start: 0x{:04x}, end: 0x{:04x}'.format(self.start, self.end))
+
+        index = self._data_group_index
+        self.data_groups = [
+            DataGroup(i, values[index + (i * 2)] / 1000, values[index + (i * 2) + 1] / 1000)
+            for i in range(self.data_group_count)
+        ]
+
+
+Response._compile()
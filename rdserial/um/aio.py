@@ -0,0 +1,76 @@
+# rdserialtool
+# Copyright (C) 2019 Ryan Finnie
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import asyncio
+import datetime
+import logging
+
+import rdserial.um
+import rdserial.scheduler
+
+
+async def probe(socket, timeout, device_type=None):
+    """Request a frame, returning whether a valid one arrives within timeout"""
+    await socket.send(b'\xf0')
+    return rdserial.um.valid_frame(await socket.recv(rdserial.um.FRAME_SIZE, timeout=timeout), device_type)
+
+
+async def resync(socket, data, timeout=None):
+    """Recover the frame from a misaligned read, as rdserial.um.resync()"""
+    steps = rdserial.um._resync(data)
+    try:
+        need = next(steps)
+        while True:
+            need = steps.send(await socket.recv(need, timeout=timeout))
+    except StopIteration as stop:
+        frame, skipped = stop.value
+    if frame is None:
+        socket.discard_input()
+    return frame, skipped
+
+
+class Poller:
+    """Poll a UM series meter over an rdserial.device.aio transport"""
+    def __init__(self, socket, device_type='UM24C'):
+        self.socket = socket
+        self.device_type = device_type
+        self.resyncs = 0
+
+    async def poll(self):
+        await self.socket.send(b'\xf0')
+        data = await self.socket.recv(rdserial.um.FRAME_SIZE)
+        if not rdserial.um.valid_frame(data):
+            self.resyncs += 1
+            data = rdserial.um.resynced(*await resync(self.socket, data), self.socket)
+        return rdserial.um.Response(
+            data,
+            collection_time=datetime.datetime.now(),
+            device_type=self.device_type,
+        )
+
+    async def watch(self, interval, callback, policy=rdserial.scheduler.POLICY_SKIP):
+        """Poll every interval seconds until cancelled, passing each Response to callback"""
+        scheduler = rdserial.scheduler.Scheduler(interval, policy=policy, clock=asyncio.get_event_loop().time)
+        while True:
+            try:
+                callback(await self.poll())
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception('{}: An exception has occurred'.format(self.socket))
+            await asyncio.sleep(scheduler.advance())
@@ -21,9 +21,15 @@ import json
 import time
 import datetime
 import logging
-import statistics
 
 import rdserial.um
+import rdserial.capture
+import rdserial.daemon
+import rdserial.device
+import rdserial.metrics
+import rdserial.scheduler
+import rdserial.stats
+import rdserial.trend
 
 
 def add_subparsers(subparsers):
@@ -120,31 +126,57 @@ class ToolModule:
             else:
                 return
 class Tool:
+    # Seconds to wait for a command to take effect (when --timeout is
+    # 0), and times to resend it
+    command_timeout = 1.0
+    command_retries = 3
+    # Commands which step from the current state rather than set one,
+    # so are never resent: a late confirmation would mean a double step
+    toggle_commands = ('next_screen', 'next_data_group', 'previous_screen')
+    # Seconds to wait after commands which cannot be confirmed
+    command_delay = 0.5
+    # Arguments send_commands() acts on, where the model has them
+    command_options = (
+        'next_screen', 'rotate_screen', 'next_data_group', 'previous_screen', 'clear_data_group',
+        'set_data_group', 'set_record_threshold', 'set_screen_brightness', 'set_screen_timeout',
+    )
+    # Arguments changing what collect() reads
+    read_options = ()
+
     def __init__(self, parent=None, callback=None):
-        self.trends = {}
+        self.trends = None
+        self.scheduler = None
+        self.capture = None
+        self.metrics = None
+        self.stats = None
+        self.polls = 0
+        self.resyncs = 0
+        self.reconnects = 0
+        self.reconnector = None
+        self.ready = None
+        # Raw frame of the latest poll, for captures
+        self.last_frame = None
+        self.now = datetime.datetime.now
+        self.clock = time.monotonic
         if parent is not None:
             self.args = parent.args
             self.socket = parent.socket
+            # Waits for the device to be ready after reconnecting
+            self.ready = getattr(parent, 'ready', None)
+            # Replayed recordings supply their recorded clocks
+            self.now = getattr(self.socket, 'now', self.now)
+            self.clock = getattr(self.socket, 'clock', self.clock)
         self.callback = callback
 
     def trend_s(self, name, value):
         if not self.args.watch:
             return ''
 
-        if name in self.trends:
-            trend = statistics.mean(self.trends[name])
-            self.trends[name] = self.trends[name][1:] + [value]
-            if value > trend:
-                return '\u2197'
-            elif value < trend:
-                return '\u2198'
-            else:
-                return ' '
-        else:
-            self.trends[name] = [value for x in range(self.args.trend_points)]
-            return ' '
+        if self.trends is None:
+            self.trends = rdserial.trend.Trends(self.args.trend_points)
+        return self.trends.direction(name, value)
 
-    def get_json(self, response):
+    def get_dict(self, response):
         out = {x: getattr(response, x) for x in response.field_properties}
         out['data_groups'] = [{'amp_hours': x.amp_hours, 'watt_hours': x.watt_hours} for x in response.data_groups]
         out['collection_time'] = (response.collection_time - datetime.datetime.fromtimestamp(0)).total_seconds()
@@ -160,7 +192,10 @@ class Tool:
             rdserial.um.CHARGING_SAMSUNG: 'Samsung',
         }
         out['charging_mode_pretty'] = charging_map[response.charging_mode]
-        return json.dumps(out, sort_keys=True)
+        return out
+
+    def get_json(self, response):
+        return json.dumps(self.get_dict(response), sort_keys=True)
 
     def print_json(self, response):
         print(self.get_json(response))
@@ -257,63 +292,244 @@ class Tool:
         if response.collection_time:
             print('Collection time: {}'.format(response.collection_time))
 
-    def send_commands(self):
-        for arg, command_val in [
-            ('next_screen', b'\xf1'),
-            ('rotate_screen', b'\xf2'),
-            ('next_data_group', b'\xf3'),
-            ('previous_screen', b'\xf3'),
-            ('clear_data_group', b'\xf4'),
-            ('set_data_group', lambda x: bytes([0xa0 + x])),
-            ('set_record_threshold', lambda x: bytes([0xb0 + int(x * 100)])),
-            ('set_screen_brightness', lambda x: bytes([0xd0 + x])),
-            ('set_screen_timeout', lambda x: bytes([0xe0 + x])),
+    def poll(self, timeout=None):
+        """Request and return one Response"""
+        self.polls += 1
+        if self.stats is None:
+            self.socket.send(b'\xf0')
+            data = self.socket.recv(rdserial.um.FRAME_SIZE, timeout=timeout)
+        else:
+            data = self.timed_request(timeout=timeout)
+        if not rdserial.um.valid_frame(data):
+            data = self.resync(data, timeout=timeout)
+        self.last_frame = data
+        decode_start = time.perf_counter()
+        response = rdserial.um.Response(
+            data,
+            collection_time=self.now(),
+            device_type=self.args.command.upper(),
+        )
+        if self.stats is not None:
+            self.stats.record('decode', time.perf_counter() - decode_start)
+        if self.reconnector is not None:
+            self.reconnector.success()
+        return response
+
+    def resync(self, data, timeout=None):
+        """Recover the frame from a misaligned read, as rdserial.um.resync()
+
+        Once out of step, every later read would be misaligned too, so
+        this is done as soon as a frame doesn't look like one.
+        """
+        self.resyncs += 1
+        return rdserial.um.resynced(*rdserial.um.resync(self.socket, data, timeout=timeout), self.socket)
+
+    def timed_request(self, timeout=None):
+        """Request a frame as poll() does, timing each phase"""
+        start = time.perf_counter()
+        self.socket.send(b'\xf0')
+        sent = time.perf_counter()
+        data = bytearray(rdserial.um.FRAME_SIZE)
+        # The first byte is read on its own, to time its arrival
+        self.socket.recv_into(data, 1, timeout=timeout)
+        first_byte = time.perf_counter()
+        if timeout is not None:
+            timeout = max(timeout - (first_byte - sent), 0.01)
+        self.socket.recv_into(memoryview(data)[1:], rdserial.um.FRAME_SIZE - 1, timeout=timeout)
+        self.stats.record('send', sent - start)
+        self.stats.record('first_byte', first_byte - sent)
+        self.stats.record('receive', time.perf_counter() - sent)
+        return bytes(data)
+
+    def confirm_timeout(self):
+        """Seconds to wait for a command to take effect"""
+        return self.args.timeout if self.args.timeout > 0 else self.command_timeout
+
+    def poll_confirm(self, before, confirm, arg_val):
+        """Poll until confirm() accepts a Response, or the confirm timeout"""
+        deadline = time.monotonic() + self.confirm_timeout()
+        while time.monotonic() < deadline:
+            try:
+                response = self.poll(timeout=max(deadline - time.monotonic(), 0.01))
+            except TimeoutError:
+                # The meter may have eaten the poll; drop any late reply
+                self.socket.discard_input()
+                continue
+            if confirm(before, response, arg_val):
+                return response
+        return None
+
+    def poll_confirm_once(self, before, confirm, arg_val):
+        """Poll once, returning the Response if confirm() accepts it"""
+        try:
+            response = self.poll(timeout=self.confirm_timeout())
+        except TimeoutError:
+            self.socket.discard_input()
+            return None
+        return response if confirm(before, response, arg_val) else None
+
+    def send_commands(self, args=None):
+        """Send the commands given in args (by default, the command line's)"""
+        # Each command is confirmed by polling the meter until the
+        # affected field reflects it, as the meter sometimes eats
+        # commands sent in quick succession.  confirm(before, after,
+        # value) compares the Responses before and after the command;
+        # commands with no visible effect fall back to a fixed delay.
+        def data_group_cleared(before, after, x):
+            data_group = after.data_groups[after.data_group_selected]
+            before_group = before.data_groups[after.data_group_selected]
+            return (data_group.amp_hours == 0) or (data_group.amp_hours < before_group.amp_hours)
+
+        if args is None:
+            args = self.args
+
+        response = None
+        for arg, command_val, confirm in [
+            ('next_screen', b'\xf1', lambda before, after, x: after.screen_selected != before.screen_selected),
+            ('rotate_screen', b'\xf2', None),
+            ('next_data_group', b'\xf3', lambda before, after, x: after.data_group_selected != before.data_group_selected),
+            ('previous_screen', b'\xf3', lambda before, after, x: after.screen_selected != before.screen_selected),
+            ('clear_data_group', b'\xf4', data_group_cleared),
+            ('set_data_group', lambda x: bytes([0xa0 + x]), lambda before, after, x: after.data_group_selected == x),
+            ('set_record_threshold', lambda x: bytes([0xb0 + int(round(x * 100))]),
+                lambda before, after, x: abs(after.record_threshold - x) < 0.005),
+            ('set_screen_brightness', lambda x: bytes([0xd0 + x]), lambda before, after, x: after.screen_brightness == x),
+            ('set_screen_timeout', lambda x: bytes([0xe0 + x]), lambda before, after, x: after.screen_timeout == x),
         ]:
-            if not hasattr(self.args, arg):
+            if not hasattr(args, arg):
                 continue
-            arg_val = getattr(self.args, arg)
+            arg_val = getattr(args, arg)
             if (arg_val is None) or (arg_val is False):
                 continue
             if type(command_val) != bytes:
-                command_val = command_val(getattr(self.args, arg))
-            logging.info('Setting {} to {}'.format(arg, getattr(self.args, arg)))
-            self.socket.send(command_val)
-            # Sometimes you can send multiple commands quickly, but sometimes
-            # it'll eat commands.  Sleeping 0.5s between commands is safe.
-            time.sleep(0.5)
+                command_val = command_val(arg_val)
+            logging.info('Setting {} to {}'.format(arg, arg_val))
+
+            if confirm is None:
+                self.socket.send(command_val)
+                time.sleep(self.command_delay)
+                response = None
+                continue
+
+            if response is None:
+                response = self.poll_confirm(None, lambda before, after, x: True, None)
+                if response is None:
+                    raise TimeoutError('No response from meter')
+            toggle = arg in self.toggle_commands
+            for attempt in range(1 if toggle else self.command_retries + 1):
+                self.socket.send(command_val)
+                confirmed = self.poll_confirm(response, confirm, arg_val)
+                if confirmed is None and toggle:
+                    # Give a slow link one more poll to show the step
+                    confirmed = self.poll_confirm_once(response, confirm, arg_val)
+                if confirmed is not None:
+                    response = confirmed
+                    break
+                if not toggle:
+                    logging.debug('{} not confirmed, retrying'.format(arg))
+            else:
+                logging.warning('Could not confirm {} was set to {}'.format(arg, arg_val))
+                response = None
 
     def loop(self):
+        self.scheduler = rdserial.scheduler.Scheduler(self.args.watch_seconds, policy=self.args.watch_policy)
         while True:
             try:
-                self.socket.send(b'\xf0')
-                response = rdserial.um.Response(
-                    self.socket.recv(130),
-                    collection_time=datetime.datetime.now(),
-                    device_type=self.args.command.upper(),
-                )
+                response = self.collect()
+                callback_start = time.perf_counter()
                 if self.callback:
                     self.callback(self.get_json(response))
+                if self.metrics is not None:
+                    self.metrics.update(self.get_dict(response))
+                format_start = time.perf_counter()
                 if self.args.json:
                     self.print_json(response)
                 else:
                     self.print_human(response)
+                if self.stats is not None:
+                    self.stats.record('callback', format_start - callback_start)
+                    self.stats.record('format', time.perf_counter() - format_start)
             except KeyboardInterrupt:
                 raise
-            except Exception:
+            except EOFError:
+                # End of a replayed recording
+                return
+            except Exception as e:
                 if self.args.watch:
                     logging.exception('An exception has occurred')
+                    self.recover(e)
                 else:
                     raise
             if self.args.watch:
                 if not self.args.json:
                     print()
-                time.sleep(self.args.watch_seconds)
+                if self.stats is not None and self.stats.due():
+                    logging.info('Stats: {}'.format(self.stats.line()))
+                self.scheduler.wait()
             else:
                 return
 
+    def recover(self, error):
+        """Reconnect if error means the link to the meter has dropped"""
+        if self.reconnector is not None and self.reconnector.failure(error):
+            self.reconnects += 1
+
+    def collect(self, args=None):
+        """Collect one sample, as the watch loop and rdserial.daemon do
+
+        Unlike the polls confirming commands, samples are captured, with
+        their collection time.  There are no read_options, so args (from
+        rdserial.daemon) changes nothing.
+        """
+        response = self.poll()
+        if self.capture is not None:
+            self.capture.write(
+                self.last_frame, monotonic=self.clock(), wall=response.collection_time.timestamp(),
+            )
+        return response
+
+    def start_metrics(self):
+        self.metrics = rdserial.metrics.Metrics(labels={'device': self.args.command})
+        self.metrics.counter('transactions', 'Polls of the meter', lambda: self.polls)
+        self.metrics.counter('resyncs', 'Misaligned frames from the meter', lambda: self.resyncs)
+        self.metrics.counter('reconnects', 'Reconnections to the device', lambda: self.reconnects)
+        self.metrics.counter(
+            'overruns', 'Watch mode collections which overran their interval',
+            lambda: self.scheduler.late if self.scheduler is not None else 0,
+        )
+        metrics_server = rdserial.metrics.MetricsServer(
+            self.metrics, self.args.metrics_port, address=self.args.metrics_address,
+        )
+        metrics_server.start()
+        return metrics_server
+
     def main(self):
+        if self.args.stats:
+            self.stats = rdserial.stats.Stats(interval=(self.args.stats_interval if self.args.watch else None))
+        if self.args.capture:
+            self.capture = rdserial.capture.CaptureWriter(self.args.capture, self.args.command.upper())
+        metrics_server = None
+        if self.args.metrics_port is not None:
+            metrics_server = self.start_metrics()
+        if (self.args.watch or self.args.daemon) and not self.args.replay and self.args.reconnect_max_delay > 0:
+            self.reconnector = rdserial.device.Reconnector(
+                self.socket, ready=self.ready, max_delay=self.args.reconnect_max_delay,
+            )
         try:
             self.send_commands()
-            self.loop()
+            if self.args.daemon:
+                rdserial.daemon.Daemon(self, self.args.daemon, max_age=self.args.daemon_max_age).serve()
+            else:
+                self.loop()
         except KeyboardInterrupt:
             pass
+        finally:
+            if self.capture is not None:
+                self.capture.close()
+            if metrics_server is not None:
+                metrics_server.stop()
+        if self.args.watch and self.scheduler is not None:
+            logging.info('Schedule: {}'.format(self.scheduler))
+        if self.stats is not None:
+            for line in self.stats.summary():
+                logging.info(line)
@@ -31,7 +31,7 @@ setup(
     author_email='ryan@finnie.org',
     url='https://github.com/rfinnie/rdserialtool',
     download_url='https://github.com/rfinnie/rdserialtool',
-    packages=find_packages(),
+    packages=find_packages(exclude=['tests']),
     classifiers=[
         'Development Status :: 4 - Beta',
         'Intended Audience :: Science/Research',
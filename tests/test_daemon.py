@@ -0,0 +1,54 @@
+# rdserialtool
+# Copyright (C) 2019 Ryan Finnie
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import unittest
+
+import rdserial.daemon
+
+
+def parse_args(*argv):
+    return rdserial.daemon.parse_args(['rdserial-daemon', '/tmp/rdserial.sock'] + list(argv))
+
+
+class TestParseArgs(unittest.TestCase):
+    def test_read(self):
+        args = parse_args('dps')
+        self.assertEqual(args.options, {})
+        self.assertTrue(args.read_only)
+
+    def test_false_values_sent(self):
+        for argv, options in (
+            (['--off'], {'set_output_state': False}),
+            (['--set-output-state', 'no'], {'set_output_state': False}),
+            (['--set-key-lock', 'off'], {'set_key_lock': False}),
+        ):
+            args = parse_args('dps', *argv)
+            self.assertEqual(args.options, options)
+            self.assertFalse(args.read_only)
+
+    def test_flags_not_given(self):
+        args = parse_args('um25c', '--next-screen')
+        self.assertEqual(args.options, {'next_screen': True})
+
+    def test_groups_read(self):
+        args = parse_args('dps', '--group', '1', '--group', '2')
+        self.assertEqual(args.options, {'group': [1, 2]})
+        self.assertTrue(args.read_only)
+        args = parse_args('dps', '--all-groups')
+        self.assertEqual(args.options, {'all_groups': True})
+        self.assertTrue(args.read_only)
@@ -0,0 +1,102 @@
+# rdserialtool
+# Copyright (C) 2019 Ryan Finnie
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import unittest
+
+import rdserial.device
+
+
+class FlakyTransport:
+    """Transport whose connect() fails a given number of times"""
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.connects = 0
+        self.closes = 0
+
+    def connect(self):
+        self.connects += 1
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionRefusedError('Connection refused')
+        return True
+
+    def close(self):
+        self.closes += 1
+
+    def __str__(self):
+        return 'flaky'
+
+
+class TestReconnector(unittest.TestCase):
+    def make_reconnector(self, transport, **kwargs):
+        self.delays = []
+        return rdserial.device.Reconnector(transport, sleep=self.delays.append, **kwargs)
+
+    def test_backoff(self):
+        transport = FlakyTransport(failures=5)
+        reconnector = self.make_reconnector(transport, delay=0.5, max_delay=2.0)
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(reconnector.reconnect(), 6)
+        self.assertEqual(self.delays, [0.5, 1.0, 2.0, 2.0, 2.0, 2.0])
+        self.assertEqual(transport.connects, 6)
+        self.assertEqual(reconnector.reconnects, 1)
+
+    def test_backoff_restarts(self):
+        transport = FlakyTransport(failures=2)
+        reconnector = self.make_reconnector(transport, delay=0.5, max_delay=2.0)
+        with self.assertLogs(level='WARNING'):
+            reconnector.reconnect()
+            reconnector.reconnect()
+        self.assertEqual(self.delays, [0.5, 1.0, 2.0, 0.5])
+
+    def test_ready(self):
+        results = [TimeoutError('Device not ready'), None]
+
+        def ready():
+            result = results.pop(0)
+            if result is not None:
+                raise result
+
+        reconnector = self.make_reconnector(FlakyTransport(), ready=ready, delay=1.0)
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(reconnector.reconnect(), 2)
+        self.assertEqual(self.delays, [1.0, 2.0])
+
+    def test_connection_error(self):
+        reconnector = self.make_reconnector(FlakyTransport())
+        with self.assertLogs(level='WARNING'):
+            self.assertTrue(reconnector.failure(ConnectionResetError('Connection reset')))
+        self.assertEqual(reconnector.reconnects, 1)
+
+    def test_other_errors(self):
+        reconnector = self.make_reconnector(FlakyTransport())
+        self.assertFalse(reconnector.failure(ValueError('Bad frame')))
+        self.assertEqual(reconnector.reconnects, 0)
+
+    def test_timeouts(self):
+        reconnector = self.make_reconnector(FlakyTransport(), max_timeouts=3)
+        self.assertFalse(reconnector.failure(TimeoutError()))
+        self.assertFalse(reconnector.failure(TimeoutError()))
+        reconnector.success()
+        self.assertEqual(reconnector.timeouts, 0)
+        self.assertFalse(reconnector.failure(TimeoutError()))
+        self.assertFalse(reconnector.failure(TimeoutError()))
+        with self.assertLogs(level='WARNING'):
+            self.assertTrue(reconnector.failure(TimeoutError()))
+        self.assertEqual(reconnector.timeouts, 0)
+        self.assertEqual(reconnector.reconnects, 1)
@@ -0,0 +1,75 @@
+# rdserialtool
+# Copyright (C) 2019 Ryan Finnie
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import unittest
+
+import rdserial.dps
+import rdserial.emulator
+import rdserial.modbus
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_client(settings_ttl=None):
+    emulator = rdserial.emulator.DPSEmulator()
+    modbus_client = rdserial.modbus.RTUClient(rdserial.emulator.Loopback(emulator), baudrate=115200)
+    clock = Clock()
+    client = rdserial.dps.Client(modbus_client, settings_ttl=settings_ttl, clock=clock)
+    return client, emulator, clock
+
+
+class TestWriteChanged(unittest.TestCase):
+    read_ranges = [(0x00, 2)]
+
+    def test_change_single_round_trip(self):
+        client, emulator, _ = make_client(settings_ttl=60.0)
+        registers = client.write_changed({0x00: 330}, read_ranges=self.read_ranges)
+        self.assertEqual(registers[0x00], 330)
+        self.assertEqual(emulator.registers[0x00], 330)
+        self.assertEqual(client.modbus_client.transactions, 1)
+
+    def test_unchanged_within_ttl(self):
+        client, _, _ = make_client(settings_ttl=60.0)
+        client.write_changed({0x00: 330}, read_ranges=self.read_ranges)
+        client.write_changed({0x00: 330}, read_ranges=self.read_ranges)
+        # Answered from the cache entirely
+        self.assertEqual(client.modbus_client.transactions, 1)
+
+    def test_panel_change_after_ttl(self):
+        client, emulator, clock = make_client(settings_ttl=60.0)
+        client.write_changed({0x00: 330}, read_ranges=self.read_ranges)
+        emulator.registers[0x00] = 1200
+        clock.now = 61.0
+        registers = client.write_changed({0x00: 330}, read_ranges=self.read_ranges)
+        self.assertEqual(registers[0x00], 330)
+        self.assertEqual(emulator.registers[0x00], 330)
+        self.assertEqual(client.modbus_client.transactions, 2)
+
+    def test_no_ttl_always_written(self):
+        client, emulator, _ = make_client()
+        client.write_changed({0x00: 330}, read_ranges=self.read_ranges)
+        emulator.registers[0x00] = 1200
+        client.write_changed({0x00: 330}, read_ranges=self.read_ranges)
+        self.assertEqual(emulator.registers[0x00], 330)
+        self.assertEqual(client.modbus_client.transactions, 2)
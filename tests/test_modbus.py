@@ -0,0 +1,184 @@
+# rdserialtool
+# Copyright (C) 2019 Ryan Finnie
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import random
+import unittest
+
+import rdserial.emulator
+import rdserial.modbus
+
+
+class FlakyReadWriteEmulator(rdserial.emulator.DPSEmulator):
+    """Unit whose first read/write multiple registers (0x17) requests
+    go unanswered (by default, all of them), or are answered with
+    exception_code"""
+    def __init__(self, failures=None, exception_code=None, **kwargs):
+        super().__init__(**kwargs)
+        self.failures = failures
+        self.exception_code = exception_code
+
+    def handle(self, frame):
+        if frame[1] == 0x17 and self.failures != 0:
+            if self.failures is not None:
+                self.failures -= 1
+            if self.exception_code is not None:
+                return self._exception(0x17, self.exception_code)
+            return None
+        return super().handle(frame)
+
+
+def make_client(emulator_class=rdserial.emulator.DPSEmulator, **kwargs):
+    emulator = emulator_class(**kwargs)
+    link = rdserial.emulator.Link()
+    client = rdserial.modbus.RTUClient(rdserial.emulator.Loopback(emulator, link=link), baudrate=115200)
+    return client, emulator, link
+
+
+class TestFrames(unittest.TestCase):
+    def test_crc(self):
+        self.assertEqual(rdserial.modbus.modbus_crc(b'\x01\x03\x00\x00\x00\x01'), 0x0a84)
+
+    def test_encode_read_registers(self):
+        buf = bytearray(rdserial.modbus.FRAME_SIZE)
+        size = rdserial.modbus.encode_read_registers(buf, 0, 1, unit=1)
+        self.assertEqual(bytes(buf[:size]), b'\x01\x03\x00\x00\x00\x01\x84\x0a')
+
+    def test_check_crc(self):
+        frame = bytearray(b'\x01\x03\x00\x00\x00\x01\x84\x0a')
+        rdserial.modbus.check_crc(frame, len(frame))
+        frame[3] ^= 0x01
+        with self.assertRaises(rdserial.modbus.CRCError):
+            rdserial.modbus.check_crc(frame, len(frame))
+
+
+class TestRTUClient(unittest.TestCase):
+    def test_read_registers(self):
+        client, emulator, _ = make_client(model=5015)
+        self.assertEqual(client.read_registers(0x0b, 2), [5015, 14])
+        self.assertEqual(client.transactions, 1)
+
+    def test_write_register(self):
+        client, emulator, _ = make_client()
+        client.write_register(0x00, 1234)
+        self.assertEqual(emulator.registers[0x00], 1234)
+        self.assertEqual(client.read_registers(0x00, 1), [1234])
+
+    def test_write_registers(self):
+        client, emulator, _ = make_client()
+        client.write_registers(0x00, [330, 500])
+        self.assertEqual(emulator.registers[0x00:0x02], [330, 500])
+
+    def test_read_register_map(self):
+        client, _, _ = make_client()
+        registers = client.read_register_map([(0x00, 2), (0x0b, 2)], max_gap=10)
+        self.assertEqual(client.transactions, 1)
+        # The registers in the gap are read along the way
+        self.assertEqual(sorted(registers), list(range(0x00, 0x0d)))
+        self.assertEqual(registers[0x0b], 5005)
+
+    def test_bad_crc(self):
+        client, _, link = make_client()
+        random.seed(0)
+        link.corrupt = 1.0
+        with self.assertRaises(rdserial.modbus.CRCError):
+            client.read_registers(0x00, 4)
+        self.assertEqual(client.crc_errors, 1)
+        link.corrupt = 0.0
+        client.socket.discard_input()
+        self.assertEqual(len(client.read_registers(0x00, 4)), 4)
+
+    def test_exception_response(self):
+        client, _, _ = make_client()
+        with self.assertRaises(rdserial.modbus.ExceptionResponse) as cm:
+            client.read_registers(0xfe, 4)
+        self.assertEqual((cm.exception.function, cm.exception.code), (0x03, 0x02))
+        # Only the exception frame was sent, so nothing is left over
+        self.assertEqual(len(client.read_registers(0x00, 1)), 1)
+
+    def test_unexpected_unit(self):
+        client, _, _ = make_client(unit=2)
+        with self.assertRaises(TimeoutError):
+            client.read_registers(0x00, 1, unit=1)
+        self.assertEqual(client.read_registers(0x00, 1, unit=2), [500])
+
+
+class TestReadWriteRegisters(unittest.TestCase):
+    def test_read_write(self):
+        client, emulator, _ = make_client()
+        self.assertEqual(client.read_write_registers(0x00, 2, 0x00, [330, 200]), [330, 200])
+        self.assertEqual(emulator.registers[0x00:0x02], [330, 200])
+        self.assertEqual(client.transactions, 1)
+        self.assertEqual(client.read_write_unsupported, set())
+
+    def test_no_read_write(self):
+        client, emulator, _ = make_client(read_write=False)
+        self.assertEqual(client.read_write_registers(0x00, 2, 0x00, [330, 200]), [330, 200])
+        self.assertEqual(emulator.registers[0x00:0x02], [330, 200])
+        # 0x17, answered "illegal function", then a write and a read
+        self.assertEqual(client.transactions, 3)
+        self.assertEqual(client.read_write_unsupported, {1})
+        client.read_write_registers(0x00, 2, 0x00, [340, 200])
+        self.assertEqual(client.transactions, 5)
+        self.assertEqual(emulator.registers[0x00], 340)
+
+    def test_read_write_ignored(self):
+        client, emulator, _ = make_client(emulator_class=FlakyReadWriteEmulator)
+        for attempt in range(rdserial.modbus.READ_WRITE_MAX_TIMEOUTS):
+            self.assertEqual(client.read_write_registers(0x00, 2, 0x00, [330 + attempt, 200]), [330 + attempt, 200])
+            self.assertEqual(emulator.registers[0x00], 330 + attempt)
+        # Unanswered 0x17, then a write and a read, each time
+        self.assertEqual(client.transactions, 3 * rdserial.modbus.READ_WRITE_MAX_TIMEOUTS)
+        self.assertEqual(client.read_write_unsupported, {1})
+        transactions = client.transactions
+        client.read_write_registers(0x00, 2, 0x00, [340, 200])
+        self.assertEqual(client.transactions - transactions, 2)
+
+    def test_read_write_timeout_then_success(self):
+        client, emulator, _ = make_client(emulator_class=FlakyReadWriteEmulator, failures=1)
+        self.assertEqual(client.read_write_registers(0x00, 2, 0x00, [330, 200]), [330, 200])
+        self.assertEqual(client.transactions, 3)
+        # One lost frame doesn't turn 0x17 off
+        self.assertEqual(client.read_write_unsupported, set())
+        self.assertEqual(client.read_write_registers(0x00, 2, 0x00, [340, 200]), [340, 200])
+        self.assertEqual(client.transactions, 4)
+
+    def test_read_write_timeouts_reset(self):
+        client, _, _ = make_client(
+            emulator_class=FlakyReadWriteEmulator, failures=rdserial.modbus.READ_WRITE_MAX_TIMEOUTS - 1,
+        )
+        for attempt in range(rdserial.modbus.READ_WRITE_MAX_TIMEOUTS):
+            client.read_write_registers(0x00, 2, 0x00, [330, 200])
+        client.socket.emulator.failures = rdserial.modbus.READ_WRITE_MAX_TIMEOUTS - 1
+        for attempt in range(rdserial.modbus.READ_WRITE_MAX_TIMEOUTS - 1):
+            client.read_write_registers(0x00, 2, 0x00, [330, 200])
+        # Never READ_WRITE_MAX_TIMEOUTS in a row
+        self.assertEqual(client.read_write_unsupported, set())
+
+    def test_read_write_other_exception(self):
+        # Server device busy: fall back this once only
+        client, _, _ = make_client(emulator_class=FlakyReadWriteEmulator, failures=1, exception_code=0x06)
+        self.assertEqual(client.read_write_registers(0x00, 2, 0x00, [330, 200]), [330, 200])
+        self.assertEqual(client.read_write_unsupported, set())
+        transactions = client.transactions
+        client.read_write_registers(0x00, 2, 0x00, [340, 200])
+        self.assertEqual(client.transactions - transactions, 1)
+
+    def test_read_write_illegal_function(self):
+        client, _, _ = make_client(emulator_class=FlakyReadWriteEmulator, exception_code=0x01)
+        self.assertEqual(client.read_write_registers(0x00, 2, 0x00, [330, 200]), [330, 200])
+        self.assertEqual(client.read_write_unsupported, {1})
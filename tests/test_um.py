@@ -0,0 +1,151 @@
+# rdserialtool
+# Copyright (C) 2019 Ryan Finnie
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import argparse
+import asyncio
+import struct
+import unittest
+
+import rdserial.emulator
+import rdserial.tool
+import rdserial.um
+import rdserial.um.aio
+import rdserial.um.tool
+
+
+def make_loopback(device_type='UM25C'):
+    return rdserial.emulator.Loopback(rdserial.emulator.UMEmulator(device_type))
+
+
+def frame(loopback):
+    loopback.send(b'\xf0')
+    return loopback.recv(rdserial.um.FRAME_SIZE)
+
+
+class TestValidFrame(unittest.TestCase):
+    def test_valid(self):
+        data = frame(make_loopback())
+        self.assertTrue(rdserial.um.valid_frame(data))
+        self.assertTrue(rdserial.um.valid_frame(data, 'UM25C'))
+        self.assertFalse(rdserial.um.valid_frame(data, 'UM24C'))
+
+    def test_invalid(self):
+        data = frame(make_loopback())
+        self.assertFalse(rdserial.um.valid_frame(data[1:]))
+        self.assertFalse(rdserial.um.valid_frame(b'\x00' + data[1:]))
+        self.assertFalse(rdserial.um.valid_frame(data[:-1] + b'\x00'))
+
+
+class TestResync(unittest.TestCase):
+    def setUp(self):
+        self.loopback = make_loopback()
+        self.expected = frame(self.loopback)
+
+    def resync(self, pending):
+        """Queue pending bytes, then a frame, and resync from the first read"""
+        self.loopback._pending += pending
+        self.loopback.send(b'\xf0')
+        return rdserial.um.resync(self.loopback, self.loopback.recv(rdserial.um.FRAME_SIZE))
+
+    def test_stray_prefix(self):
+        data, skipped = self.resync(b'\x01\x02\x03')
+        self.assertEqual(skipped, 3)
+        self.assertTrue(rdserial.um.valid_frame(data))
+        self.assertEqual(len(self.loopback._pending), 0)
+
+    def test_truncated_frame(self):
+        # The tail of a frame whose start was lost
+        data, skipped = self.resync(self.expected[60:])
+        self.assertEqual(skipped, 70)
+        self.assertTrue(rdserial.um.valid_frame(data))
+
+    def test_false_start_marker(self):
+        # A start marker which isn't followed by a frame's end marker
+        marker = struct.pack('>H', rdserial.um.START_MARKERS['UM25C'])
+        data, skipped = self.resync(b'\x00' * 10 + marker + b'\x00' * 28)
+        self.assertEqual(skipped, 40)
+        self.assertTrue(rdserial.um.valid_frame(data))
+
+    def test_no_frame(self):
+        self.loopback._pending += b'\x00' * 300
+        data, skipped = rdserial.um.resync(self.loopback, self.loopback.recv(rdserial.um.FRAME_SIZE))
+        self.assertIsNone(data)
+        self.assertEqual(len(self.loopback._pending), 0)
+
+
+class AsyncLoopback:
+    """rdserial.device.aio transport interface over a Loopback"""
+    def __init__(self, loopback):
+        self.loopback = loopback
+
+    async def send(self, request):
+        return self.loopback.send(request)
+
+    async def recv(self, size, timeout=None):
+        return self.loopback.recv(size, timeout=timeout)
+
+    def discard_input(self):
+        self.loopback.discard_input()
+
+    def __str__(self):
+        return 'aio loopback'
+
+
+class TestPollerResync(unittest.TestCase):
+    def test_poll(self):
+        loopback = make_loopback()
+        poller = rdserial.um.aio.Poller(AsyncLoopback(loopback), device_type='UM25C')
+        loopback._pending += b'\xff' * 7
+        with self.assertLogs(level='WARNING'):
+            response = asyncio.run(poller.poll())
+        self.assertAlmostEqual(response.volts, 5.1, places=1)
+        self.assertEqual(poller.resyncs, 1)
+
+    def test_poll_lost(self):
+        loopback = make_loopback()
+        poller = rdserial.um.aio.Poller(AsyncLoopback(loopback), device_type='UM25C')
+        loopback._pending += b'\x00' * 300
+        with self.assertRaises(ValueError):
+            asyncio.run(poller.poll())
+        self.assertEqual(len(loopback._pending), 0)
+
+
+class TestToolResync(unittest.TestCase):
+    def make_tool(self, loopback):
+        args = rdserial.tool.parse_args(['rdserialtool', '--serial-device', '/dev/null', 'um25c'])
+        return rdserial.um.tool.Tool(argparse.Namespace(args=args, socket=loopback))
+
+    def test_poll(self):
+        loopback = make_loopback()
+        tool = self.make_tool(loopback)
+        loopback._pending += b'\xff' * 7
+        with self.assertLogs(level='WARNING'):
+            response = tool.poll()
+        self.assertAlmostEqual(response.volts, 5.1, places=1)
+        self.assertEqual(tool.resyncs, 1)
+        # Back in step
+        tool.poll()
+        self.assertEqual(tool.resyncs, 1)
+
+    def test_poll_lost(self):
+        loopback = make_loopback()
+        tool = self.make_tool(loopback)
+        loopback._pending += b'\x00' * 300
+        with self.assertRaises(ValueError):
+            tool.poll()
+        self.assertAlmostEqual(tool.poll().volts, 5.1, places=1)
@@ -1,19 +1,132 @@
 #!/usr/bin/env python3
+import argparse
 import datetime
-import json
 import os
 import sys
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 
-def plot_history(history):
-    amps = [data['amps']*1000 for data in history]
-    timestamps = [datetime.datetime.fromtimestamp(data['collection_time']).strftime("%Y-%m-%dT%H:%M:%S.%f") for data in history]
-    amp_hours = [data['data_groups'][data['data_group_selected']]['amp_hours']*1000 for data in history]
+import rdserial.capture
+import rdserial.history
+import rdserial.um
+
+try:
+    import numpy
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+
+def load_history(filename):
+    """Load (timestamps, mA, mAh) arrays from a binary capture or JSON history
+
+    Binary captures are memory-mapped, so only the columns plotted are
+    ever read from disk.  Without NumPy, these are plain lists.
+    """
+    with open(filename, 'rb') as f:
+        is_capture = f.read(len(rdserial.capture.MAGIC)) == rdserial.capture.MAGIC
+    if not HAS_NUMPY:
+        return load_history_lists(filename, is_capture)
+    if not is_capture:
+        history = rdserial.history.read_history(filename)
+        timestamps = numpy.fromiter((data['collection_time'] for data in history), dtype=float, count=len(history))
+        amps = numpy.fromiter((data['amps'] * 1000 for data in history), dtype=float, count=len(history))
+        amp_hours = numpy.fromiter((
+            data['data_groups'][data['data_group_selected']]['amp_hours'] * 1000 for data in history
+        ), dtype=float, count=len(history))
+        return timestamps, amps, amp_hours
+
+    device_type, groups, records = rdserial.capture.load_numpy(filename)
+    if device_type == 'DPS':
+        raise ValueError('Only UM captures can be plotted', filename)
+    properties = rdserial.um.Response.field_properties['amps']
+    divisor = properties['divisor'] * (10 if device_type == 'UM25C' else 1)
+    amps = records['amps'] * (1000 / divisor)
+    # The selected group's counter, for each record; counters are in mAh
+    data_groups = numpy.stack([
+        records['dg_{}_amp_hours'.format(group)] for group in range(rdserial.um.Response.data_group_count)
+    ], axis=1)
+    selected = numpy.minimum(records['data_group_selected'], rdserial.um.Response.data_group_count - 1)
+    amp_hours = data_groups[numpy.arange(len(records)), selected].astype(float)
+    return numpy.asarray(records['wall']), amps, amp_hours
+
+
+def load_history_lists(filename, is_capture):
+    if not is_capture:
+        history = rdserial.history.read_history(filename)
+        return (
+            [data['collection_time'] for data in history],
+            [data['amps'] * 1000 for data in history],
+            [data['data_groups'][data['data_group_selected']]['amp_hours'] * 1000 for data in history],
+        )
+    timestamps, amps, amp_hours = [], [], []
+    with rdserial.capture.CaptureReader(filename) as reader:
+        if reader.device_type == 'DPS':
+            raise ValueError('Only UM captures can be plotted', filename)
+        for record in reader:
+            response = record.decode()
+            timestamps.append(record.wall)
+            amps.append(response.amps * 1000)
+            amp_hours.append(response.data_groups[response.data_group_selected].amp_hours * 1000)
+    return timestamps, amps, amp_hours
+
+
+def lttb(x, y, threshold):
+    """Largest-Triangle-Three-Buckets: indices of threshold points
+    which keep the visual shape (including peaks) of y over x"""
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return numpy.arange(n)
+    indices = numpy.empty(threshold, dtype=numpy.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+    # threshold - 2 buckets between the fixed first and last points
+    edges = numpy.linspace(1, n - 1, threshold - 1).astype(numpy.int64)
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        area = numpy.abs(
+            (x[a] - avg_x) * (y[start:end] - y[a]) -
+            (x[a] - x[start:end]) * (avg_y - y[a])
+        )
+        a = start + area.argmax()
+        indices[i + 1] = a
+    return indices
+
+
+def minmax(x, y, threshold):
+    """Indices of the min and max of y in each of threshold / 2 buckets"""
+    n = len(x)
+    if threshold >= n or threshold < 2:
+        return numpy.arange(n)
+    indices = []
+    for bucket in numpy.array_split(numpy.arange(n), threshold // 2):
+        values = y[bucket]
+        indices += [bucket[values.argmin()], bucket[values.argmax()]]
+    return numpy.unique(indices)
+
+
+def plot_history(timestamps, amps, amp_hours, points=2000, method='lttb'):
+    if HAS_NUMPY:
+        downsample = {'lttb': lttb, 'minmax': minmax}[method]
+        amps_idx = downsample(timestamps, amps, points)
+        amp_hours_idx = downsample(timestamps, amp_hours, points)
+    else:
+        # Plotted in full
+        amps_idx = amp_hours_idx = range(len(timestamps))
+
+    def local_times(indices):
+        return [datetime.datetime.fromtimestamp(timestamps[i]) for i in indices]
+
     fig = go.Figure()
     fig = make_subplots(specs=[[{"secondary_y": True}]])
-    fig.add_trace(go.Scatter(x=timestamps, y=amps, name='Amps'), secondary_y=False)
-    fig.add_trace(go.Scatter(x=timestamps, y=amp_hours, name='mAh'), secondary_y=True)
+    fig.add_trace(go.Scatter(x=local_times(amps_idx), y=[amps[i] for i in amps_idx], name='Amps'), secondary_y=False)
+    fig.add_trace(go.Scatter(
+        x=local_times(amp_hours_idx), y=[amp_hours[i] for i in amp_hours_idx], name='mAh',
+    ), secondary_y=True)
     fig.update_layout(title='Device charging', xaxis_title='Time', yaxis_title='mA')
     fig.update_yaxes(rangemode="tozero", secondary_y=False)
     fig.update_yaxes(rangemode="tozero", title='mAh', secondary_y=True)
@@ -21,17 +134,27 @@ def plot_history(history):
 
 
 def main():
-    if len(sys.argv) > 1:
-        json_file = sys.argv[1]
-    else:
-        json_file = os.path.join(os.path.dirname(os.path.realpath(sys.argv[0])), 'charge.json')
-    charge_history = []
+    parser = argparse.ArgumentParser(description='Plot a charge history or capture')
+    parser.add_argument(
+        'history_file', nargs='?',
+        default=os.path.join(os.path.dirname(os.path.realpath(sys.argv[0])), 'charge.jsonl'),
+        help='JSON Lines history or binary capture (--capture) file',
+    )
+    parser.add_argument(
+        '--points', type=int, default=2000,
+        help='Downsample each series to about this many points',
+    )
+    parser.add_argument(
+        '--method', choices=('lttb', 'minmax'), default='lttb',
+        help='Downsampling method',
+    )
+    args = parser.parse_args()
     try:
-        with open(json_file, 'r') as file:
-            charge_history = json.load(file)
+        timestamps, amps, amp_hours = load_history(args.history_file)
     except Exception as e:
         print(e)
-    plot_history(charge_history)
+        timestamps = amps = amp_hours = []
+    plot_history(timestamps, amps, amp_hours, points=args.points, method=args.method)
 
 if __name__ == '__main__':
     main()